@@ -0,0 +1,316 @@
+import sys
+from array import array
+import numpy as np
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+class ArrayTrie:
+  '''
+  A trie with the same API and results as Trie, but with its nodes stored in flat int32 arrays rather than as one
+  TrieNode object (with its own children dict) per token, so a trie over millions of UMIs is a few arrays instead of
+  tens of millions of objects, and pickles as such.
+  Node n has the token numbered node_tokens[n] (see tokens), its first child, and the next child of its parent, so the
+  children of a node are a linked list in the order they were inserted, and every search visits them in the same order
+  as Trie's children dicts. object_nums[n] indexes the trie_object stored at the node in trie_objects, or is -1 if no
+  word ends there. Node 0 is the root, which stores no token
+  '''
+
+  narrow_query_max_nodes = 2048 # full_query_with_errors searches that visit more nodes than this are redone a level at a time
+
+  def __init__(self):
+    self._clear()
+
+  def _clear(self):
+    self.tokens = [] # the token (e.g. character) of each token number
+    self.token_nums = {} # token: token number
+    self.node_tokens = array('i', [-1])
+    self.first_child = array('i', [-1])
+    self.next_sibling = array('i', [-1])
+    self.object_nums = array('i', [-1])
+    self.trie_objects = []
+
+  def __setstate__(self, state):
+    if 'root' in state:
+      # pickled when tries were built from TrieNodes: rebuild the arrays from them, keeping the order of each node's children
+      root = state.pop('root')
+      self.__dict__.update(state)
+      self._clear()
+      nodes = [(root, 0)]
+      while nodes:
+        (node, node_num) = nodes.pop()
+        for child in node.children.values():
+          child_num = self._add_child(node_num, self._token_num(child.token))
+          if child.is_end:
+            self._set_trie_object(child_num, child.trie_object)
+          nodes.append((child, child_num))
+    else:
+      self.__dict__.update(state)
+
+  def _token_num(self, token):
+    token_num = self.token_nums.get(token)
+    if token_num == None:
+      token_num = len(self.tokens)
+      self.tokens.append(token)
+      self.token_nums[token] = token_num
+    return token_num
+
+  def _child(self, node_num, token):
+    '''
+    The child of node_num with token, or -1 if it has none
+    '''
+    token_num = self.token_nums.get(token, -1)
+    child_num = self.first_child[node_num]
+    while (child_num >= 0) and (self.node_tokens[child_num] != token_num):
+      child_num = self.next_sibling[child_num]
+    return child_num
+
+  def _children(self, node_num):
+    '''
+    List of the children of node_num, in the order they were inserted
+    '''
+    child_nums = []
+    child_num = self.first_child[node_num]
+    while child_num >= 0:
+      child_nums.append(child_num)
+      child_num = self.next_sibling[child_num]
+    return child_nums
+
+  def _add_child(self, node_num, token_num, last_child_num = -1):
+    '''
+    Append a new child with token_num to the children of node_num, after last_child_num if that is given, or its last child
+    '''
+    child_num = len(self.node_tokens)
+    self.node_tokens.append(token_num)
+    self.first_child.append(-1)
+    self.next_sibling.append(-1)
+    self.object_nums.append(-1)
+    if last_child_num < 0:
+      last_child_num = self.first_child[node_num]
+      while (last_child_num >= 0) and (self.next_sibling[last_child_num] >= 0):
+        last_child_num = self.next_sibling[last_child_num]
+    if last_child_num < 0:
+      self.first_child[node_num] = child_num
+    else:
+      self.next_sibling[last_child_num] = child_num
+    return child_num
+
+  def _remove_child(self, node_num, child_num):
+    '''
+    Unlink child_num (and so everything below it) from the children of node_num. Its nodes are left unused in the arrays
+    '''
+    if self.first_child[node_num] == child_num:
+      self.first_child[node_num] = self.next_sibling[child_num]
+    else:
+      sibling_num = self.first_child[node_num]
+      while self.next_sibling[sibling_num] != child_num:
+        sibling_num = self.next_sibling[sibling_num]
+      self.next_sibling[sibling_num] = self.next_sibling[child_num]
+
+  def _set_trie_object(self, node_num, trie_object):
+    if self.object_nums[node_num] < 0:
+      self.object_nums[node_num] = len(self.trie_objects)
+      self.trie_objects.append(trie_object)
+    else:
+      self.trie_objects[self.object_nums[node_num]] = trie_object
+
+  def _trie_object(self, node_num):
+    return self.trie_objects[self.object_nums[node_num]]
+
+  def insert(self, word, trie_object = None):
+    '''
+    Insert a word into the trie
+    '''
+    if trie_object == None:
+      trie_object = word # if nothing to store was passed, store the word itself
+    node_num = 0
+    for token in word:
+      token_num = self._token_num(token)
+      # look for a child with the token, remembering the last child, which a new child is linked after
+      last_child_num = -1
+      child_num = self.first_child[node_num]
+      while (child_num >= 0) and (self.node_tokens[child_num] != token_num):
+        last_child_num = child_num
+        child_num = self.next_sibling[child_num]
+      if child_num < 0:
+        child_num = self._add_child(node_num, token_num, last_child_num)
+      node_num = child_num
+    self._set_trie_object(node_num, trie_object) # mark the end of a word, and store a reference to the object it represents
+
+  def _depth_first_search(self, node_num, prefix):
+    if self.object_nums[node_num] >= 0:
+      self.output.append((prefix, self._trie_object(node_num)))
+    for child_num in self._children(node_num):
+      self._depth_first_search(child_num, prefix + self.tokens[self.node_tokens[child_num]])
+
+  def prefix_query(self, prefix):
+    '''
+    Given an input (a prefix), retrieve all words stored in the trie with that prefix, sorted by their trie_objects, largest first
+    '''
+    self.output = []
+    node_num = 0
+    for token in prefix:
+      node_num = self._child(node_num, token)
+      if node_num < 0:
+        return [] # cannot find the prefix
+    self._depth_first_search(node_num, prefix)
+    return sorted(self.output, key = lambda prefix: prefix[1], reverse = True)
+
+  def full_query(self, word):
+    '''
+    Given an input (a word), follow it through the trie, returning (word, trie_object) for the first word stored
+    along its path, or an empty list if there is none
+    '''
+    node_num = 0
+    for token_num, token in enumerate(word):
+      node_num = self._child(node_num, token)
+      if node_num < 0:
+        return [] # not in the trie
+      if self.object_nums[node_num] >= 0:
+        return (word[0:(token_num + 1)], self._trie_object(node_num)) # Success!
+    return [] # ran out of characters before finding a match
+
+  def full_query_with_errors(self, word, max_errors, destructive = False):
+    '''
+    Given a query word, retrieve all entries that match the query from the trie, with max_errors allowed, as a dict
+    of word: {'trie_object', 'num_errors'} in depth first order.
+    If destructive is True, when a word is matched (even inexactly), it is removed from the trie, as is any node
+    (below the root's children) left with no children once its own have been searched.
+    Neither search recurses: paths are only followed while they are within max_errors, and result words are only
+    built when they are matched. A search first walks the trie with an explicit stack, which is quickest while few
+    paths are within max_errors; if it visits more than narrow_query_max_nodes, it is redone expanding all the paths
+    a level at a time with array operations. The matches are only removed once they have all been found
+    '''
+    self.result = {}
+    if (len(word) < 1) or (max_errors < 0):
+      return self.result
+    query_token_nums = [self.token_nums.get(token, -1) for token in word] # -1 for tokens not in the trie, which match no node
+    matches = self._narrow_query_with_errors(query_token_nums, max_errors)
+    if matches == None:
+      matches = self._wide_query_with_errors(query_token_nums, max_errors)
+    for path, num_errors in matches:
+      self.result[''.join([self.tokens[self.node_tokens[node_num]] for node_num in path])] = {
+        'trie_object': self.trie_objects[self.object_nums[path[-1]]],
+        'num_errors': num_errors
+      }
+    if destructive:
+      for path, num_errors in matches:
+        # remove the match, and then any node (below the root's children) it leaves with no children
+        for depth in range(len(path) - 1, 0, -1):
+          self._remove_child(path[depth - 1], path[depth])
+          if self.first_child[path[depth - 1]] >= 0:
+            break
+    return self.result
+
+  def _narrow_query_with_errors(self, query_token_nums, max_errors):
+    '''
+    List of (path, num_errors) of the matches, in depth first order, where path is the list of nodes from a root
+    child to the match, or None if more than narrow_query_max_nodes nodes were visited
+    '''
+    node_tokens = self.node_tokens
+    first_child = self.first_child
+    next_sibling = self.next_sibling
+    object_nums = self.object_nums
+    word_length = len(query_token_nums)
+    path = [0]*(word_length + 1) # the nodes from the root to the node being searched
+    nodes = [(0, 0, 0)] # (node_num, depth, num_errors) of each node to search, where depth is its number of tokens
+    matches = []
+    num_visited = 0
+    while nodes:
+      (node_num, depth, num_errors) = nodes.pop()
+      num_visited += 1
+      if num_visited > self.narrow_query_max_nodes:
+        return None
+      path[depth] = node_num
+      if depth > 0:
+        if object_nums[node_num] >= 0:
+          matches.append((path[1:(depth + 1)], num_errors))
+          continue
+        if depth == word_length:
+          continue
+      query_token_num = query_token_nums[depth]
+      if num_errors == max_errors:
+        # no errors left, so only the exact child can match
+        child_num = first_child[node_num]
+        while (child_num >= 0) and (node_tokens[child_num] != query_token_num):
+          child_num = next_sibling[child_num]
+        if child_num >= 0:
+          nodes.append((child_num, depth + 1, num_errors))
+      else:
+        # push the children in reverse, so they are searched in the order they were inserted
+        child_nodes = []
+        child_num = first_child[node_num]
+        while child_num >= 0:
+          child_nodes.append((child_num, depth + 1, num_errors + (node_tokens[child_num] != query_token_num)))
+          child_num = next_sibling[child_num]
+        nodes.extend(reversed(child_nodes))
+    return matches
+
+  def _wide_query_with_errors(self, query_token_nums, max_errors):
+    '''
+    As _narrow_query_with_errors, but expanding every path within max_errors a level at a time
+    '''
+    # the arrays are only viewed here, as array.arrays can't grow while they are, which nothing in a search does
+    node_tokens = np.frombuffer(self.node_tokens, dtype = np.int32)
+    first_child = np.frombuffer(self.first_child, dtype = np.int32)
+    next_sibling = np.frombuffer(self.next_sibling, dtype = np.int32)
+    object_nums = np.frombuffer(self.object_nums, dtype = np.int32)
+    # each level holds the nodes at that depth within max_errors, the index in the level above of each one's parent,
+    # and its position among its parent's children, from which the depth first order of the matches is sorted out
+    levels = []
+    matches = [] # (depth, indexes in its level, num_errors) of the matches at each depth
+    nodes = np.zeros(1, dtype = np.int32)
+    num_errors = np.zeros(1, dtype = np.int32)
+    node_indexes = np.zeros(1, dtype = np.int64) # index of each of nodes in its level
+    for depth, query_token_num in enumerate(query_token_nums):
+      level_nodes = []
+      level_parents = []
+      level_child_nums = []
+      parents = np.arange(len(nodes))
+      children = first_child[nodes]
+      child_num = 0
+      while len(children) > 0:
+        has_child = children >= 0
+        children = children[has_child]
+        parents = parents[has_child]
+        level_nodes.append(children)
+        level_parents.append(parents)
+        level_child_nums.append(np.full(len(children), child_num, dtype = np.int32))
+        children = next_sibling[children]
+        child_num += 1
+      children = np.concatenate(level_nodes)
+      parents = np.concatenate(level_parents)
+      child_nums = np.concatenate(level_child_nums)
+      child_num_errors = num_errors[parents] + (node_tokens[children] != query_token_num)
+      within_errors = child_num_errors <= max_errors
+      children = children[within_errors]
+      child_num_errors = child_num_errors[within_errors]
+      levels.append((children, node_indexes[parents[within_errors]], child_nums[within_errors]))
+      is_end = object_nums[children] >= 0
+      if is_end.any():
+        matches.append((depth, np.flatnonzero(is_end), child_num_errors[is_end]))
+      nodes = children[~is_end]
+      num_errors = child_num_errors[~is_end]
+      node_indexes = np.flatnonzero(~is_end)
+      if len(nodes) == 0:
+        break
+    if len(matches) == 0:
+      return []
+    # the node and child number at each depth of the path to each match, padded beyond the match, as no match is
+    # the prefix of another, and the depth first order of the matches
+    match_paths = []
+    match_child_nums = []
+    match_num_errors = []
+    for depth, indexes, depth_num_errors in matches:
+      paths = np.zeros((len(indexes), len(query_token_nums)), dtype = np.int64)
+      path_child_nums = np.zeros((len(indexes), len(query_token_nums)), dtype = np.int64)
+      for path_depth in range(depth, -1, -1):
+        (children, parent_indexes, child_nums) = levels[path_depth]
+        paths[:, path_depth] = children[indexes]
+        path_child_nums[:, path_depth] = child_nums[indexes]
+        indexes = parent_indexes[indexes]
+      match_paths.extend([path[0:(depth + 1)] for path in paths.tolist()])
+      match_child_nums.append(path_child_nums)
+      match_num_errors.extend(depth_num_errors.tolist())
+    match_child_nums = np.concatenate(match_child_nums)
+    return [(match_paths[match_num], match_num_errors[match_num]) for match_num in np.lexsort(match_child_nums.T[::-1]).tolist()]
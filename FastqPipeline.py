@@ -0,0 +1,160 @@
+import queue
+import sys
+import threading
+import time
+import zlib
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import fastq_reader
+
+_end_of_data = None # sentinel passed down the queues when a stage has finished
+
+class PipelineStage:
+  '''
+  Timing and queue depth statistics for one stage of a FastqPipeline
+  '''
+
+  def __init__(self, name):
+    self.name = name
+    self.items = 0
+    self.busy_time = 0.0 # time spent doing the stage's own work
+    self.input_stall_time = 0.0 # time spent waiting for the previous stage (input queue empty)
+    self.output_stall_time = 0.0 # time spent waiting for the next stage (output queue full)
+    self.queue_depth_total = 0 # input queue depth, summed over each item taken, for the mean
+    self.queue_depth_max = 0
+
+  def __str__(self):
+    mean_queue_depth = self.queue_depth_total/self.items if self.items else 0
+    return f'{self.name}: {self.items} items, busy {self.busy_time:.2f}s, stalled on input {self.input_stall_time:.2f}s, ' \
+      f'stalled on output {self.output_stall_time:.2f}s, input queue depth mean {mean_queue_depth:.1f} max {self.queue_depth_max}'
+
+class FastqPipeline:
+  '''
+  Threaded FASTQ ingest. A decompression thread inflates the raw gzip data (zlib releases the GIL while
+  it does so), a parser thread splits the inflated blocks into batches of four-line records, and the
+  caller indexes the batches yielded by batches(). Stages are joined by bounded queues, so inflation
+  overlaps with indexing, and the slowest stage sets the pace. report() shows which stage that is:
+  the stage with the least stall time is the bottleneck
+  '''
+
+  def __init__(self, fastq_filename, raw_block_size = 1 << 20, max_queued_blocks = 8, max_queued_batches = 4):
+    self.fastq_filename = fastq_filename
+    self.raw_block_size = raw_block_size
+    self.block_queue = queue.Queue(max_queued_blocks)
+    self.batch_queue = queue.Queue(max_queued_batches)
+    self.stages = [PipelineStage('decompress'), PipelineStage('parse'), PipelineStage('index')]
+    self._stopping = threading.Event()
+    self._error = None
+
+  def batches(self):
+    '''
+    Generator yielding (read_id_lines, sequences) batches, as for fastq_reader.read_fastq_batches.
+    Time between batches is counted as the index stage being busy
+    '''
+    threads = [threading.Thread(target = self._run_stage, args = (self._decompress,), daemon = True),
+      threading.Thread(target = self._run_stage, args = (self._parse,), daemon = True)]
+    for thread in threads:
+      thread.start()
+    index_stage = self.stages[2]
+    try:
+      while True:
+        batch = self._get(self.batch_queue, index_stage)
+        if batch is _end_of_data:
+          break
+        index_stage.items += 1
+        start_time = time.perf_counter()
+        yield batch
+        index_stage.busy_time += time.perf_counter() - start_time
+    finally:
+      self._stopping.set() # also stops the other stages if the caller stops early
+      for thread in threads:
+        thread.join()
+    if self._error != None:
+      raise self._error
+
+  def report(self):
+    return '\n'.join(str(stage) for stage in self.stages)
+
+  def _run_stage(self, stage_function):
+    try:
+      stage_function()
+    except BaseException as error: # including SystemExit from the parser, which should end the main thread
+      self._error = error
+      self._stopping.set()
+
+  def _get(self, from_queue, stage):
+    depth = from_queue.qsize()
+    stage.queue_depth_total += depth
+    stage.queue_depth_max = max(stage.queue_depth_max, depth)
+    start_time = time.perf_counter()
+    while True:
+      try:
+        item = from_queue.get(timeout = 0.1)
+        break
+      except queue.Empty:
+        if self._stopping.is_set():
+          item = _end_of_data
+          break
+    stage.input_stall_time += time.perf_counter() - start_time
+    return item
+
+  def _put(self, to_queue, item, stage):
+    start_time = time.perf_counter()
+    while not self._stopping.is_set():
+      try:
+        to_queue.put(item, timeout = 0.1)
+        break
+      except queue.Full:
+        pass
+    stage.output_stall_time += time.perf_counter() - start_time
+
+  def _decompress(self):
+    stage = self.stages[0]
+    with open(self.fastq_filename, 'rb') as raw_file:
+      decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) # gzip format
+      in_member = False # whether decompressor has been given any of its member's data yet
+      while not self._stopping.is_set():
+        start_time = time.perf_counter()
+        raw_block = raw_file.read(self.raw_block_size)
+        if not raw_block:
+          # as gzip.open would, fail on a file that ends part way through a member, rather than silently losing the reads in the rest of it
+          if in_member and not decompressor.eof:
+            sys.exit(f'{self.fastq_filename} ends part way through a gzip member, so is probably truncated. Exiting.')
+          break
+        blocks = []
+        while raw_block:
+          blocks.append(decompressor.decompress(raw_block))
+          in_member = True
+          if not decompressor.eof:
+            break
+          # a gzip file may be several concatenated members (e.g. BGZF), each needing a new decompressor, which is
+          # given whatever follows the member in this raw block, and then the following raw blocks
+          raw_block = decompressor.unused_data
+          decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+          in_member = False
+        block = b''.join(blocks)
+        stage.busy_time += time.perf_counter() - start_time
+        if block:
+          stage.items += 1
+          self._put(self.block_queue, block, stage)
+    self._put(self.block_queue, _end_of_data, stage)
+
+  def _parse(self):
+    stage = self.stages[1]
+    remainder = b''
+    while True:
+      block = self._get(self.block_queue, stage)
+      if (block is _end_of_data) or self._stopping.is_set():
+        break
+      stage.items += 1
+      start_time = time.perf_counter()
+      read_id_lines, sequences, remainder = fastq_reader.split_fastq_block(remainder + block)
+      stage.busy_time += time.perf_counter() - start_time
+      if read_id_lines:
+        self._put(self.batch_queue, (read_id_lines, sequences), stage)
+    if not self._stopping.is_set():
+      for batch in fastq_reader.final_fastq_batch(remainder):
+        self._put(self.batch_queue, batch, stage)
+    self._put(self.batch_queue, _end_of_data, stage)
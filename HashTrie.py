@@ -3,13 +3,14 @@ import sys
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
-from Trie import Trie
+from ArrayTrie import ArrayTrie
 
-class HashTrie(Trie):
+class HashTrie(ArrayTrie):
   '''
   A HashTrie uses a dictionary to store refences to objects stored in the trie.
   This allows constant time exact match retrieval. The trie is only traversed when doing
   inexact matching.
+  The trie itself is an ArrayTrie, which gives the same results as a Trie of TrieNodes, in a fraction of the memory.
   '''
   
   def __init__(self):
@@ -0,0 +1,455 @@
+import sys
+import time
+import collections
+import numpy as np
+import scipy.sparse
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import packed_seq
+from ReadNgramHash import seq_ngrams
+
+# bound on the number of (query, seq) similarities held at once by query_many
+max_block_similarities = 1 << 24
+# bound on the number of (query ngram, seq ngram) pairs compared at once when ordering matches by first shared ngram
+max_block_ngram_comparisons = 1 << 24
+
+class NgramIndex:
+  '''
+  Compact, read-only inverted ngram index built from a ReadNgramHash once ingest is finished.
+  umi_well_seqs get dense integer ids, in the order they were inserted, and the postings for each ngram
+  are stored CSR style: posting_seq_ids[posting_offsets[ngram_id]:posting_offsets[ngram_id + 1]] are the
+  ids of the umi_well_seqs containing the ngram (in ascending order), and posting_counts the number of
+  times each contains it. Queries accumulate shared ngram counts with array operations over the posting
+  slices, and give the same matches, in the same order, as ReadNgramHash.
+  umi_well_seqs can be deleted, which just marks them as no longer alive. Once more than max_dead_fraction of them are
+  dead, the index is compacted: dead umi_well_seqs are dropped from the sequence table and the postings, and the rest
+  renumbered in the same order, so queries only scan live postings
+  '''
+
+  num_deleted = 0 # defaults for indexes pickled before these were added
+  max_dead_fraction = 0.25
+  num_compactions = 0
+
+  def __init__(self, read_ngram_hash):
+    self.seq_length = read_ngram_hash.seq_length
+    self.ngram_length = read_ngram_hash.ngram_length
+    self.packed = read_ngram_hash.packed
+    # sequence table
+    keys = list(read_ngram_hash.umi_well_seq_hash)
+    self.seqs = np.array([read_ngram_hash._umi_well_seq(key).encode('ascii') for key in keys], dtype = f'S{self.seq_length}')
+    self.alive = np.ones(len(keys), dtype = bool)
+    self.num_deleted = 0
+    self.max_dead_fraction = read_ngram_hash.max_dead_fraction
+    self.num_compactions = 0
+    seq_ids = {key: seq_id for seq_id, key in enumerate(keys)}
+    # postings
+    self.ngram_ids = {ngram: ngram_id for ngram_id, ngram in enumerate(read_ngram_hash.ngram_hash)}
+    # dtypes are those scipy.sparse uses, so the postings can be used as a sparse matrix without copying them
+    posting_lengths = [len(ngram_entries) for ngram_entries in read_ngram_hash.ngram_hash.values()]
+    num_postings = sum(posting_lengths)
+    index_dtype = np.int32 if max(num_postings, len(keys)) <= np.iinfo(np.int32).max else np.int64
+    self.posting_offsets = np.zeros(len(posting_lengths) + 1, dtype = index_dtype)
+    np.cumsum(posting_lengths, out = self.posting_offsets[1:])
+    self.posting_seq_ids = np.fromiter((seq_ids[key] for ngram_entries in read_ngram_hash.ngram_hash.values() for key in ngram_entries),
+      dtype = index_dtype, count = num_postings)
+    occurrences = (lambda num_occurrences : num_occurrences) if self.packed else len
+    self.posting_counts = np.fromiter((occurrences(ngram_entry) for ngram_entries in read_ngram_hash.ngram_hash.values() for ngram_entry in ngram_entries.values()),
+      dtype = np.int32, count = num_postings)
+    # for looking up seq_ids by umi_well_seq
+    self._sorted_seq_ids = np.argsort(self.seqs, kind = 'stable').astype(np.int32)
+    self._scores = None # accumulator for shared ngram counts, reused across queries
+    self._posting_matrix_cache = None # the postings viewed as a sparse ngram x seq matrix, for query_many
+    self._histogram_matrix_cache = None # and transposed, for histogram_intersections
+    self.set_stop_list()
+
+  # the arrays making up the index, apart from alive, which is all an index needs to be rebuilt with from_arrays
+  array_names = ('seqs', 'posting_offsets', 'posting_seq_ids', 'posting_counts', '_sorted_seq_ids', 'stop_ngram_ids', 'stop_max_counts')
+
+  @classmethod
+  def from_arrays(cls, seq_length, ngram_length, packed, ngram_ids, arrays):
+    '''
+    An index using the given arrays (a dict with an entry for each of array_names), e.g. those of another index, or memory-mapped from disk,
+    without copying them. All umi_well_seqs are alive
+    '''
+    ngram_index = cls.__new__(cls)
+    ngram_index.seq_length = seq_length
+    ngram_index.ngram_length = ngram_length
+    ngram_index.packed = packed
+    ngram_index.ngram_ids = ngram_ids
+    for array_name in cls.array_names:
+      setattr(ngram_index, array_name, arrays[array_name])
+    ngram_index.alive = np.ones(len(ngram_index.seqs), dtype = bool)
+    ngram_index.num_deleted = 0
+    ngram_index.max_dead_fraction = 1.0 # never compact, as the arrays may be shared
+    ngram_index.num_compactions = 0
+    ngram_index._scores = None
+    ngram_index._posting_matrix_cache = None
+    ngram_index._histogram_matrix_cache = None
+    ngram_index._stop_ngram_nums = {int(ngram_id): stop_num for stop_num, ngram_id in enumerate(ngram_index.stop_ngram_ids)}
+    ngram_index.reset_query_stats()
+    return ngram_index
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_scores'] = None # scratch space and views of the postings; no need to save them
+    state['_posting_matrix_cache'] = None
+    state['_histogram_matrix_cache'] = None
+    return state
+
+  def __len__(self):
+    return int(np.count_nonzero(self.alive))
+
+  def posting_lengths(self):
+    '''
+    Array of the number of umi_well_seqs containing each ngram, by ngram_id
+    '''
+    return np.diff(self.posting_offsets)
+
+  def set_stop_list(self, max_posting_fraction = None, stop_ngrams = ()):
+    '''
+    Stop over-frequent ngrams being counted by query_many: those in more than max_posting_fraction of all umi_well_seqs,
+    and any given (as str) in stop_ngrams. Matches are unchanged, as the threshold is lowered to allow for the stopped
+    ngrams a query skips, and the candidates are then rescored exactly, by looking them up in the skipped postings.
+    Must be set before the index is shared with an NgramQueryPool
+    '''
+    posting_lengths = self.posting_lengths()
+    stop_ngram_ids = set(self.ngram_ids[ngram] for stop_ngram in stop_ngrams for ngram in self._ngrams(stop_ngram, 1) if ngram in self.ngram_ids)
+    if max_posting_fraction != None:
+      stop_ngram_ids.update(np.flatnonzero(posting_lengths > max_posting_fraction*len(self.seqs)).tolist())
+    # most frequent first, as those are the ones most worth skipping
+    self.stop_ngram_ids = np.array(sorted(stop_ngram_ids, key = lambda ngram_id : posting_lengths[ngram_id], reverse = True), dtype = np.int64)
+    self.stop_max_counts = np.array([self.posting_counts[self.posting_offsets[ngram_id]:self.posting_offsets[ngram_id + 1]].max(initial = 0) \
+      for ngram_id in self.stop_ngram_ids], dtype = np.int64)
+    self._stop_ngram_nums = {int(ngram_id): stop_num for stop_num, ngram_id in enumerate(self.stop_ngram_ids)}
+    self.reset_query_stats()
+
+  def reset_query_stats(self):
+    self.query_stats = collections.Counter() # postings visited and skipped, rescoring lookups and time, over all query_many calls
+    self.stop_ngram_skips = np.zeros(len(self.stop_ngram_ids), dtype = np.int64) # queries skipping each stopped ngram
+
+  def add_query_stats(self, query_stats, stop_ngram_skips):
+    '''
+    Add the query statistics from another copy of this index, e.g. in an NgramQueryPool worker
+    '''
+    self.query_stats.update(query_stats)
+    self.stop_ngram_skips += stop_ngram_skips
+
+  def stop_list_report(self):
+    '''
+    Report of the stopped ngrams, and the query work skipping them saved
+    '''
+    posting_lengths = self.posting_lengths()
+    ngram_strs = {ngram_id: ngram for ngram, ngram_id in self.ngram_ids.items()}
+    lines = [f'{len(self.stop_ngram_ids)} stopped ngrams:']
+    for ngram_id, max_count, num_skips in zip(self.stop_ngram_ids.tolist(), self.stop_max_counts.tolist(), self.stop_ngram_skips.tolist()):
+      ngram = ngram_strs[ngram_id]
+      if isinstance(ngram, int):
+        ngram = packed_seq.unpack_seq(ngram, self.ngram_length)
+      lines.append(f'\t{ngram}: in {posting_lengths[ngram_id]} umi_well_seqs ({posting_lengths[ngram_id]/max(1, len(self.seqs)):.1%}), ' \
+        f'at most {max_count} times each, skipped by {num_skips} queries')
+    postings_visited = self.query_stats['postings_visited']
+    postings_skipped = self.query_stats['postings_skipped']
+    skipped_fraction = postings_skipped/max(1, postings_visited + postings_skipped)
+    lines.append(f'Postings visited: {postings_visited}, skipped: {postings_skipped} ({skipped_fraction:.1%} of the scanning work), ' \
+      f'looked up again for rescoring: {self.query_stats["rescore_lookups"]}')
+    query_time = self.query_stats['query_time']
+    lines.append(f'Query time: {query_time:.2f}s, of which rescoring {self.query_stats["rescore_time"]:.2f}s. ' \
+      f'Estimated time saved: {query_time*skipped_fraction/max(1e-9, 1 - skipped_fraction) - self.query_stats["rescore_time"]:.2f}s')
+    return '\n'.join(lines)
+
+  def seq_id(self, umi_well_seq):
+    '''
+    The id of umi_well_seq, or None if it is not in the index
+    '''
+    seq_id = self.seq_ids([umi_well_seq])[0]
+    return int(seq_id) if seq_id >= 0 else None
+
+  def seq_ids(self, umi_well_seqs):
+    '''
+    Array of the ids of umi_well_seqs, with -1 for any not in the index
+    '''
+    umi_well_seqs = np.array([umi_well_seq.encode('ascii') for umi_well_seq in umi_well_seqs], dtype = self.seqs.dtype)
+    positions = np.minimum(np.searchsorted(self.seqs, umi_well_seqs, sorter = self._sorted_seq_ids), max(0, len(self.seqs) - 1))
+    seq_ids = self._sorted_seq_ids[positions] if len(self.seqs) else np.zeros(len(umi_well_seqs), dtype = np.int32)
+    return np.where((len(self.seqs) > 0) & (self.seqs[seq_ids] == umi_well_seqs), seq_ids, -1)
+
+  def umi_well_seqs(self, seq_ids):
+    return [umi_well_seq.decode('ascii') for umi_well_seq in self.seqs[seq_ids].tolist()]
+
+  def delete(self, umi_well_seq):
+    seq_id = self.seq_id(umi_well_seq) # NB umi_well_seq *must* be in the index
+    if self.alive[seq_id]:
+      self.alive[seq_id] = False
+      self.num_deleted += 1
+      if self.num_deleted > self.max_dead_fraction*len(self.seqs):
+        self.compact()
+
+  def compact(self):
+    '''
+    Drop the dead umi_well_seqs from the sequence table and the postings, renumbering the live ones in the same order.
+    Ngram ids are unchanged (ngrams no live umi_well_seq has keep an empty posting list), and postings stay in
+    seq_id order, so queries give the same matches, in the same order. New arrays are made, so any copies shared
+    with an NgramQueryPool are left as they were
+    '''
+    if self.num_deleted == 0:
+      return
+    new_seq_ids = np.cumsum(self.alive) - 1
+    live_postings = self.alive[self.posting_seq_ids]
+    live_posting_offsets = np.zeros(len(self.posting_seq_ids) + 1, dtype = np.int64)
+    np.cumsum(live_postings, out = live_posting_offsets[1:])
+    self.posting_offsets = live_posting_offsets[self.posting_offsets].astype(self.posting_offsets.dtype)
+    self.posting_seq_ids = new_seq_ids[self.posting_seq_ids[live_postings]].astype(self.posting_seq_ids.dtype)
+    self.posting_counts = self.posting_counts[live_postings]
+    self.seqs = self.seqs[self.alive]
+    self._sorted_seq_ids = np.argsort(self.seqs, kind = 'stable').astype(np.int32)
+    self.alive = np.ones(len(self.seqs), dtype = bool)
+    self.stop_max_counts = np.array([self.posting_counts[self.posting_offsets[ngram_id]:self.posting_offsets[ngram_id + 1]].max(initial = 0) \
+      for ngram_id in self.stop_ngram_ids], dtype = np.int64)
+    self._scores = None
+    self._posting_matrix_cache = None
+    self._histogram_matrix_cache = None
+    self.num_deleted = 0
+    self.num_compactions += 1
+
+  def umi_well_seq_query(self, query_umi_well_seq, min_similarity_fraction = 0.8, sort_result = False):
+    similarities = self.query_many([query_umi_well_seq], min_similarity_fraction)
+    return(self._matches((similarities.indices, similarities.data), sort_result))
+
+  def seq_ngram_query(self, query_seq, min_similarity_fraction = 0.8, sort_result = False):
+    min_similarity = min_similarity_fraction*(len(query_seq) - self.ngram_length)
+    return(self._matches(self.shared_ngram_counts(self._ngrams(query_seq, len(query_seq) - self.ngram_length), min_similarity), sort_result))
+
+  def query_many(self, query_umi_well_seqs, min_similarity_fraction = 0.8):
+    '''
+    Sparse len(query_umi_well_seqs) x len(seqs) CSR matrix of shared ngram counts, with one row per query holding its live
+    matches. All of the queries are scored together, as the product of a sparse query x ngram count matrix and the
+    ngram x seq posting matrix. The column indices in each row are left in the order first matched (i.e. they are not
+    sorted), so that row i gives exactly the matches, in the same order, of umi_well_seq_query(query_umi_well_seqs[i])
+    '''
+    # the product has a row for every seq sharing any ngram with a query, so bound its size by scoring in blocks
+    start_time = time.perf_counter()
+    block_size = max(1, max_block_similarities // max(1, len(self.seqs)))
+    blocks = [self._query_block(query_umi_well_seqs[start:(start + block_size)], min_similarity_fraction) for start in range(0, len(query_umi_well_seqs), block_size)]
+    row_offsets = np.zeros(len(query_umi_well_seqs) + 1, dtype = np.int64)
+    np.cumsum(np.concatenate([np.zeros(0, dtype = np.int64)] + [row_lengths for row_lengths, seq_ids, scores in blocks]), out = row_offsets[1:])
+    self.query_stats['query_time'] += time.perf_counter() - start_time
+    return scipy.sparse.csr_matrix((np.concatenate([np.zeros(0, dtype = np.int32)] + [scores for row_lengths, seq_ids, scores in blocks]),
+      np.concatenate([np.zeros(0, dtype = np.int32)] + [seq_ids for row_lengths, seq_ids, scores in blocks]), row_offsets),
+      shape = (len(query_umi_well_seqs), len(self.seqs)))
+
+  def _query_block(self, query_umi_well_seqs, min_similarity_fraction):
+    '''
+    The (row_lengths, seq_ids, scores) of the rows of query_many for a block of queries
+    '''
+    num_ngrams = self.seq_length - self.ngram_length
+    min_similarity = min_similarity_fraction*num_ngrams
+    num_queries = len(query_umi_well_seqs)
+    query_ngram_ids = []
+    query_row_offsets = [0]
+    min_candidate_similarities = np.full(num_queries, min_similarity)
+    skipped_counts = np.zeros((num_queries, len(self.stop_ngram_ids)), dtype = np.int32) # stopped ngrams each query skipped
+    for query_num, query_umi_well_seq in enumerate(query_umi_well_seqs):
+      ngram_ids = [ngram_id for ngram_id in map(self.ngram_ids.get, self._ngrams(query_umi_well_seq, num_ngrams)) if ngram_id != None]
+      if self._stop_ngram_nums:
+        ngram_ids, min_candidate_similarities[query_num] = self._skip_stop_ngrams(ngram_ids, min_similarity, skipped_counts[query_num])
+      query_ngram_ids.extend(ngram_ids)
+      query_row_offsets.append(len(query_ngram_ids))
+    posting_lengths = self.posting_lengths()
+    self.query_stats['postings_visited'] += int(posting_lengths[query_ngram_ids].sum())
+    self.query_stats['postings_skipped'] += int((skipped_counts*posting_lengths[self.stop_ngram_ids]).sum())
+    self.stop_ngram_skips += np.count_nonzero(skipped_counts, axis = 0)
+    query_matrix = scipy.sparse.csr_matrix((np.ones(len(query_ngram_ids), dtype = np.int32), query_ngram_ids, query_row_offsets),
+      shape = (num_queries, len(self.ngram_ids))) # repeated query ngrams are summed by the product
+    similarities = (query_matrix @ self._posting_matrix()).tocoo()
+    keep = (similarities.data > min_candidate_similarities[similarities.row]) & self.alive[similarities.col]
+    query_nums, seq_ids, scores = similarities.row[keep], similarities.col[keep], similarities.data[keep]
+    if self._stop_ngram_nums:
+      start_time = time.perf_counter()
+      scores = scores + self._stop_ngram_scores(skipped_counts, query_nums, seq_ids)
+      keep = scores > min_similarity
+      query_nums, seq_ids, scores = query_nums[keep], seq_ids[keep], scores[keep]
+      self.query_stats['rescore_time'] += time.perf_counter() - start_time
+    # queries visit postings in ngram order, and postings are in seq_id order, so matches were first seen in order of
+    # the first query ngram each match shares with its query, then seq_id
+    order = np.lexsort((seq_ids, self._first_shared_ngrams(query_umi_well_seqs, query_nums, seq_ids), query_nums))
+    return (np.bincount(query_nums, minlength = num_queries), seq_ids[order].astype(np.int32), scores[order].astype(np.int32))
+
+  def _skip_stop_ngrams(self, ngram_ids, min_similarity, skipped_counts):
+    '''
+    Remove stopped ngrams from a query's ngram_ids, most frequent first, as long as a umi_well_seq must still share one of
+    the remaining ngrams to be a match, i.e. while the most the skipped ones could add to its similarity is at most
+    min_similarity. Records the skipped ngrams in skipped_counts, and returns the remaining ngram_ids, and the
+    similarity a candidate must now exceed from them alone
+    '''
+    query_stop_counts = collections.Counter(ngram_id for ngram_id in ngram_ids if ngram_id in self._stop_ngram_nums)
+    max_skipped_similarity = 0
+    for stop_num in sorted(self._stop_ngram_nums[ngram_id] for ngram_id in query_stop_counts):
+      ngram_id = int(self.stop_ngram_ids[stop_num])
+      max_similarity = query_stop_counts[ngram_id]*self.stop_max_counts[stop_num]
+      if max_skipped_similarity + max_similarity > min_similarity:
+        break
+      max_skipped_similarity += max_similarity
+      skipped_counts[stop_num] = query_stop_counts[ngram_id]
+    if max_skipped_similarity == 0:
+      return (ngram_ids, min_similarity)
+    return ([ngram_id for ngram_id in ngram_ids if (ngram_id not in self._stop_ngram_nums) or (skipped_counts[self._stop_ngram_nums[ngram_id]] == 0)],
+      min_similarity - max_skipped_similarity)
+
+  def _stop_ngram_scores(self, skipped_counts, query_nums, seq_ids):
+    '''
+    The similarities skipped stopped ngrams add to each (query_nums[i], seq_ids[i]) candidate, looked up in their sorted postings
+    '''
+    stop_ngram_scores = np.zeros(len(seq_ids), dtype = np.int64)
+    for stop_num in np.flatnonzero(skipped_counts.any(axis = 0)):
+      start, end = self.posting_offsets[self.stop_ngram_ids[stop_num]], self.posting_offsets[self.stop_ngram_ids[stop_num] + 1]
+      query_skipped_counts = skipped_counts[query_nums, stop_num]
+      lookups = query_skipped_counts > 0
+      positions = start + np.minimum(np.searchsorted(self.posting_seq_ids[start:end], seq_ids[lookups]), end - start - 1)
+      found = self.posting_seq_ids[positions] == seq_ids[lookups]
+      stop_ngram_scores[lookups] += query_skipped_counts[lookups]*np.where(found, self.posting_counts[positions], 0)
+      self.query_stats['rescore_lookups'] += int(np.count_nonzero(lookups))
+    return stop_ngram_scores
+
+  def distance_query_candidates(self, query_umi_well_seq, min_shared):
+    '''
+    The live umi_well_seqs (as str) containing at least min_shared of the ngram positions of query_umi_well_seq,
+    in seq_id order (see ReadNgramHash.umi_well_seq_distance_query)
+    '''
+    if min_shared <= 0:
+      return self.umi_well_seqs(np.flatnonzero(self.alive))
+    query_ngram_counts = collections.Counter(self._ngrams(query_umi_well_seq, self.seq_length - self.ngram_length))
+    ngram_ids = np.array([self.ngram_ids.get(ngram, -1) for ngram in query_ngram_counts], dtype = np.int64)
+    query_counts = np.array(list(query_ngram_counts.values()), dtype = np.int64)
+    query_counts, ngram_ids = query_counts[ngram_ids >= 0], ngram_ids[ngram_ids >= 0]
+    starts = self.posting_offsets[ngram_ids]
+    ends = self.posting_offsets[ngram_ids + 1]
+    # rarest ngrams first: a seq in none of the postings of the first few can't have enough of the rest to be a candidate
+    rarest_first = np.argsort(ends - starts, kind = 'stable')
+    starts, ends, query_counts = starts[rarest_first], ends[rarest_first], query_counts[rarest_first]
+    remaining_counts = query_counts[::-1].cumsum()[::-1] # of this ngram and all the more common ones
+    num_visited = int(np.count_nonzero(remaining_counts >= min_shared))
+    seq_ids = np.unique(np.concatenate([np.zeros(0, dtype = self.posting_seq_ids.dtype)] + \
+      [self.posting_seq_ids[start:end] for start, end in zip(starts[:num_visited], ends[:num_visited])]))
+    seq_ids = seq_ids[self.alive[seq_ids]]
+    # the rest are only looked up for these candidates, in the sorted postings
+    num_shared = np.zeros(len(seq_ids), dtype = np.int64)
+    for start, end, query_count in zip(starts, ends, query_counts):
+      if end > start:
+        positions = start + np.minimum(np.searchsorted(self.posting_seq_ids[start:end], seq_ids), end - start - 1)
+        num_shared += query_count*(self.posting_seq_ids[positions] == seq_ids)
+    return self.umi_well_seqs(seq_ids[num_shared >= min_shared])
+
+  def histogram_intersections(self, query_umi_well_seqs, query_nums, seq_ids):
+    '''
+    Array of the histogram intersections, sum(min(h_q, h_s)), of the ngram histograms of query_umi_well_seqs[query_nums[i]]
+    and seqs[seq_ids[i]] for each i, computed together from the sparse (ngram_id, count) histograms of the seqs
+    '''
+    num_ngrams = self.seq_length - self.ngram_length
+    missing_ngram_id = len(self.ngram_ids) # a column for query ngrams no seq has
+    query_histograms = np.zeros((len(query_umi_well_seqs), missing_ngram_id + 1), dtype = np.int32)
+    for query_num, query_umi_well_seq in enumerate(query_umi_well_seqs):
+      query_ngram_ids = [self.ngram_ids.get(ngram, missing_ngram_id) for ngram in self._ngrams(query_umi_well_seq, num_ngrams)]
+      query_histograms[query_num] = np.bincount(query_ngram_ids, minlength = missing_ngram_id + 1)
+    histograms = self._histogram_matrix()
+    seq_ids = np.asarray(seq_ids, dtype = np.int64)
+    starts = histograms.indptr[seq_ids]
+    lengths = histograms.indptr[seq_ids + 1] - starts
+    positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    bin_mins = np.minimum(histograms.data[positions], query_histograms[np.repeat(np.asarray(query_nums, dtype = np.int64), lengths), histograms.indices[positions]])
+    return np.bincount(np.repeat(np.arange(len(seq_ids)), lengths), weights = bin_mins, minlength = len(seq_ids)).astype(np.int64)
+
+  def _histogram_matrix(self):
+    '''
+    The ngram histogram of every seq, as a sparse ngram x seq CSC matrix, i.e. the postings transposed so that
+    indices[indptr[seq_id]:indptr[seq_id + 1]] are the ngram ids of the seq, and data the count of each
+    '''
+    if self._histogram_matrix_cache is None:
+      self._histogram_matrix_cache = self._posting_matrix().tocsc()
+    return self._histogram_matrix_cache
+
+  def _posting_matrix(self):
+    if self._posting_matrix_cache is None:
+      self._posting_matrix_cache = scipy.sparse.csr_matrix((self.posting_counts, self.posting_seq_ids, self.posting_offsets),
+        shape = (len(self.ngram_ids), len(self.seqs)))
+    return self._posting_matrix_cache
+
+  def _first_shared_ngrams(self, query_umi_well_seqs, query_nums, seq_ids):
+    '''
+    For each (query_nums[i], seq_ids[i]) match, the offset of the first query ngram that is also an ngram of the matched seq.
+    Equal ngram keys are equal substrings, so this compares the ngram windows of the raw bytes, each packed into a
+    single value, for blocks of matches with at most max_block_ngram_comparisons (query ngram, seq ngram) pairs
+    '''
+    num_ngrams = self.seq_length - self.ngram_length
+    query_bytes = np.array([query_umi_well_seq.encode('ascii') for query_umi_well_seq in query_umi_well_seqs], dtype = self.seqs.dtype)
+    query_nums = np.asarray(query_nums, dtype = np.int64)
+    seq_ids = np.asarray(seq_ids, dtype = np.int64)
+    first_shared = np.zeros(len(seq_ids), dtype = np.int64)
+    block_size = max(1, max_block_ngram_comparisons // max(1, num_ngrams*num_ngrams))
+    for block_start in range(0, len(seq_ids), block_size):
+      block_end = block_start + block_size
+      query_keys = self._ngram_window_keys(query_bytes[query_nums[block_start:block_end]], num_ngrams)
+      match_keys = self._ngram_window_keys(self.seqs[seq_ids[block_start:block_end]], num_ngrams)
+      shared = (query_keys[:, :, np.newaxis] == match_keys[:, np.newaxis, :]).any(axis = 2)
+      first_shared[block_start:block_end] = shared.argmax(axis = 1)
+    return first_shared
+
+  def _ngram_window_keys(self, seqs, num_ngrams):
+    '''
+    (len(seqs), num_ngrams) array of the bytes of each ngram window of a fixed-width bytes array of seqs, packed into a
+    uint64 if they fit, or viewed as one void value if not, so equal keys are equal ngrams
+    '''
+    windows = np.lib.stride_tricks.sliding_window_view(seqs.view(np.uint8).reshape(-1, self.seq_length), self.ngram_length, axis = 1)[:, :num_ngrams]
+    if self.ngram_length > 8:
+      return np.ascontiguousarray(windows).view(np.dtype((np.void, self.ngram_length)))[:, :, 0]
+    keys = np.zeros(windows.shape[0:2], dtype = np.uint64)
+    for ngram_base in range(self.ngram_length):
+      keys <<= np.uint64(8)
+      keys |= windows[:, :, ngram_base]
+    return keys
+
+  def _ngrams(self, seq, num_ngrams):
+    return(seq_ngrams(seq, num_ngrams, self.ngram_length, self.seq_length, self.packed))
+
+  def _matches(self, seq_ids_and_counts, sort_result):
+    '''
+    List of (umi_well_seq, count) tuples, as returned by the ReadNgramHash query methods
+    '''
+    (seq_ids, counts) = seq_ids_and_counts
+    matches = list(zip(self.umi_well_seqs(seq_ids), counts.tolist()))
+    if sort_result:
+      matches = sorted(matches, key = lambda match : match[1], reverse = True)
+    return(matches)
+
+  def shared_ngram_counts(self, query_ngrams, min_similarity):
+    '''
+    Ids and shared ngram counts of the live umi_well_seqs sharing more than min_similarity ngram matches with
+    query_ngrams (as for ReadNgramHash._shared_ngram_counts), in the order they were first matched
+    '''
+    query_ngram_counts = {}
+    for ngram in query_ngrams:
+      query_ngram_counts[ngram] = query_ngram_counts.get(ngram, 0) + 1
+    if self._scores is None:
+      self._scores = np.zeros(len(self.seqs), dtype = np.int32)
+    scores = self._scores
+    matched_seq_id_slices = []
+    for ngram, query_ngram_count in query_ngram_counts.items():
+      ngram_id = self.ngram_ids.get(ngram)
+      if ngram_id == None:
+        continue
+      start, end = self.posting_offsets[ngram_id], self.posting_offsets[ngram_id + 1]
+      seq_ids = self.posting_seq_ids[start:end]
+      scores[seq_ids] += self.posting_counts[start:end]*np.int32(query_ngram_count) # seq_ids are unique within a posting list, so no need for np.add.at
+      matched_seq_id_slices.append(seq_ids)
+    if not matched_seq_id_slices:
+      return (np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int32))
+    matched_seq_ids = np.concatenate(matched_seq_id_slices)
+    matched_scores = scores[matched_seq_ids]
+    scores[matched_seq_ids] = 0 # reset the accumulator for the next query
+    keep = (matched_scores > min_similarity) & self.alive[matched_seq_ids]
+    matched_seq_ids = matched_seq_ids[keep]
+    matched_scores = matched_scores[keep]
+    # remove repeats, keeping the first occurrence of each match, in order
+    first_positions = np.sort(np.unique(matched_seq_ids, return_index = True)[1])
+    return (matched_seq_ids[first_positions], matched_scores[first_positions])
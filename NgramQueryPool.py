@@ -0,0 +1,91 @@
+import collections
+import multiprocessing
+import sys
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import parallel_ingest
+from NgramIndex import NgramIndex
+
+_worker_index = None # the NgramIndex each worker process queries, on the arrays it inherited by fork
+
+class NgramQueryPool:
+  '''
+  Answers umi_well_seq queries against a frozen ReadNgramHash in parallel. The worker processes are forked, so
+  they inherit the arrays of its NgramIndex (or their memory maps, for a hash loaded with array_store) without
+  copying them, as numpy arrays' data pages are never written, and each scores blocks of queries with
+  NgramIndex.query_many on an NgramIndex of those arrays. Results come back to the calling process in query
+  order, so the sequential parts of clustering stay there.
+  With one worker (or a ReadNgramHash that is not frozen), queries are answered in the calling process
+  '''
+
+  def __init__(self, read_ngram_hash, num_workers = parallel_ingest.default_num_workers, block_size = 256):
+    self.read_ngram_hash = read_ngram_hash
+    self.block_size = block_size
+    self.num_workers = num_workers if read_ngram_hash.ngram_index != None else 1
+    self._pool = None
+    if self.num_workers <= 1:
+      return
+    ngram_index = read_ngram_hash.ngram_index
+    # the workers' seq_ids are those of the arrays as they are now, which stay the same even if read_ngram_hash's index
+    # is compacted, as compaction makes new arrays (so these are only held twice once it has been)
+    self._pool_index = NgramIndex.from_arrays(ngram_index.seq_length, ngram_index.ngram_length, ngram_index.packed, ngram_index.ngram_ids,
+      {array_name: getattr(ngram_index, array_name) for array_name in NgramIndex.array_names})
+    # fork, as for parallel_ingest.map_shards, which also means the index is not pickled to be passed to the workers
+    self._pool = multiprocessing.get_context('fork').Pool(self.num_workers, initializer = _attach_worker, initargs = (self._pool_index,))
+
+  def close(self):
+    if self._pool != None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  def umi_well_seq_queries(self, query_umi_well_seqs, min_similarity_fraction = 0.8, skip = None):
+    '''
+    Generator yielding the matches for each of query_umi_well_seqs in turn, as umi_well_seq_query would return them
+    at the time they are yielded, i.e. without any umi_well_seqs deleted since the block was scored.
+    Queries for which skip(query_umi_well_seq) is True when their block is sent to the workers are not scored,
+    and None is yielded for them. Up to two blocks per worker are scored ahead of the one being yielded
+    '''
+    pending = collections.deque()
+    max_pending = 2*self.num_workers if self._pool != None else 1 # in this process, score each block only when it is needed
+    next_block_start = 0
+    while True:
+      while (next_block_start < len(query_umi_well_seqs)) and (len(pending) < max_pending):
+        block_end = min(len(query_umi_well_seqs), next_block_start + self.block_size)
+        query_block = [query_umi_well_seq for query_umi_well_seq in query_umi_well_seqs[next_block_start:block_end] \
+          if (skip == None) or not skip(query_umi_well_seq)]
+        pending.append((next_block_start, block_end, query_block, self._score_block(query_block, min_similarity_fraction)))
+        next_block_start = block_end
+      if len(pending) == 0:
+        break
+      (block_start, block_end, query_block, block_result) = pending.popleft()
+      block_matches = dict(zip(query_block, self._block_matches(block_result)))
+      for query_umi_well_seq in query_umi_well_seqs[block_start:block_end]:
+        if query_umi_well_seq not in block_matches:
+          yield None
+          continue
+        yield [match for match in block_matches[query_umi_well_seq] if match[0] in self.read_ngram_hash]
+
+  def _score_block(self, query_block, min_similarity_fraction):
+    if self._pool == None:
+      return self.read_ngram_hash.query_many(query_block, min_similarity_fraction)
+    return self._pool.apply_async(_query_many, (query_block, min_similarity_fraction))
+
+  def _block_matches(self, block_result):
+    if self._pool == None:
+      return block_result
+    (similarities, query_stats, stop_ngram_skips) = block_result.get()
+    self.read_ngram_hash.ngram_index.add_query_stats(query_stats, stop_ngram_skips)
+    return [self._pool_index._matches((similarities.indices[start:end], similarities.data[start:end]), False) \
+      for start, end in zip(similarities.indptr[:-1], similarities.indptr[1:])]
+
+def _attach_worker(pool_index):
+  global _worker_index
+  _worker_index = pool_index
+
+def _query_many(query_umi_well_seqs, min_similarity_fraction):
+  _worker_index.reset_query_stats()
+  similarities = _worker_index.query_many(query_umi_well_seqs, min_similarity_fraction)
+  return (similarities, _worker_index.query_stats, _worker_index.stop_ngram_skips) # the statistics are added to the parent's index
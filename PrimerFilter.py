@@ -0,0 +1,124 @@
+import csv
+import sys
+import time
+import numpy as np
+
+class PrimerFilter:
+  '''
+  Streaming black-list of primer (dimer) seqs, applied to umi_well_seqs as they are read, before they are inserted
+  into a ReadNgramHash. A umi_well_seq matches a primer when their shared ngram count, as ReadNgramHash.seq_ngram_query
+  counts it (every pair of equal ngram occurrences, over the primer's and the umi_well_seq's indexed ngram offsets),
+  is more than min_similarity_fraction of the primer's ngrams. So excluding matches here leaves the same ReadNgramHash
+  as deleting seq_ngram_query's matches for each primer once it has been built, but without indexing them first.
+  All the primers' ngrams are compiled into one table, giving for each possible ngram the number of times each primer
+  has it, so a batch of umi_well_seqs is checked against every primer at once by summing the rows of its ngrams.
+  As most umi_well_seqs share few ngrams with any primer, they are first screened with the table's row totals, and
+  only those that could match some primer are checked against each one.
+  Each excluded umi_well_seq is counted against the first primer, in exclude_seqs order, that it matches
+  '''
+
+  def __init__(self, exclude_seqs, ngram_length = 6, min_similarity_fraction = 0.8):
+    self.exclude_seqs = dict(exclude_seqs) # seq_name: seq
+    self.seq_names = list(self.exclude_seqs)
+    self.ngram_length = ngram_length
+    self.min_similarity_fraction = min_similarity_fraction
+    for seq_name, seq in self.exclude_seqs.items():
+      if (len(seq) <= ngram_length) or seq.strip('ACGT'):
+        sys.exit(f'Black-listed sequence {seq_name} ({seq}) must be more than {ngram_length} bases of ACGT. Exiting.')
+    # the number of shared ngrams a umi_well_seq must exceed to match each primer
+    self.min_shared = np.array([min_similarity_fraction*(len(seq) - ngram_length) for seq in self.exclude_seqs.values()])
+    # ngrams are numbered in base 5, with any base other than ACGT as digit 4, which no primer ngram has
+    self.ngram_counts = np.zeros((5**ngram_length, len(self.seq_names)), dtype = np.int32)
+    for seq_num, seq in enumerate(self.exclude_seqs.values()):
+      np.add.at(self.ngram_counts[:, seq_num], _ngram_ids(_base_codes[np.frombuffer(seq.encode('ascii'), dtype = np.uint8)][np.newaxis, :], ngram_length)[0], 1)
+    # no umi_well_seq can match a primer without sharing more than the least min_shared ngrams with all the primers together
+    self.any_ngram_counts = self.ngram_counts.sum(axis = 1).astype(np.int32)
+    self.min_any_shared = self.min_shared.min() if len(self.seq_names) > 0 else np.inf
+    self.excluded_reads = {seq_name: 0 for seq_name in self.seq_names}
+    self.excluded_umi_well_seqs = {seq_name: 0 for seq_name in self.seq_names}
+    self.num_checked = 0
+    self.filter_time = 0.0
+
+  def __str__(self):
+    return(f'PrimerFilter: {len(self.seq_names)} black-listed sequences, ngram_length = {self.ngram_length}, min_similarity_fraction = {self.min_similarity_fraction}')
+
+  def matching_seq_nums(self, umi_well_seqs):
+    '''
+    Array of the number of the first primer each of umi_well_seqs (str or bytes) matches, or -1 where it matches none
+    '''
+    if len(umi_well_seqs) == 0:
+      return np.zeros(0, dtype = np.int64)
+    if isinstance(umi_well_seqs[0], str):
+      umi_well_seqs = [umi_well_seq.encode('ascii') for umi_well_seq in umi_well_seqs]
+    seq_lengths = np.fromiter(map(len, umi_well_seqs), dtype = np.int64, count = len(umi_well_seqs))
+    max_seq_length = int(seq_lengths.max())
+    if (seq_lengths == max_seq_length).all():
+      seqs = np.frombuffer(b''.join(umi_well_seqs), dtype = np.uint8).reshape(len(umi_well_seqs), max_seq_length)
+    else:
+      seqs = np.frombuffer(b''.join([umi_well_seq.ljust(max_seq_length, b'N') for umi_well_seq in umi_well_seqs]), dtype = np.uint8).reshape(len(umi_well_seqs), max_seq_length)
+    if max_seq_length <= self.ngram_length:
+      return np.full(len(umi_well_seqs), -1, dtype = np.int64)
+    ngram_ids = _ngram_ids(_base_codes[seqs], self.ngram_length)
+    if not (seq_lengths == max_seq_length).all():
+      # only the ngrams a ReadNgramHash indexes for each umi_well_seq, i.e. not those reaching into the padding,
+      # which are given the id of an ngram of all non-ACGT bases, which no primer has
+      ngram_ids[np.arange(ngram_ids.shape[1]) >= (seq_lengths - self.ngram_length)[:, np.newaxis]] = 5**self.ngram_length - 1
+    seq_nums = np.full(len(umi_well_seqs), -1, dtype = np.int64)
+    candidates = np.flatnonzero(self.any_ngram_counts[ngram_ids].sum(axis = 1) > self.min_any_shared)
+    if len(candidates) > 0:
+      matches = self.ngram_counts[ngram_ids[candidates]].sum(axis = 1) > self.min_shared
+      seq_nums[candidates] = np.where(matches.any(axis = 1), matches.argmax(axis = 1), -1)
+    return seq_nums
+
+  def exclude(self, umi_well_seqs, counts = None):
+    '''
+    Boolean array of which of umi_well_seqs to keep, i.e. those matching no primer. The excluded ones are added
+    to the per-primer counts, as counts[i] reads for umi_well_seqs[i] (1 each if counts is None)
+    '''
+    start_time = time.perf_counter()
+    seq_nums = self.matching_seq_nums(umi_well_seqs)
+    keep = seq_nums < 0
+    if not keep.all():
+      read_counts = np.ones(len(seq_nums), dtype = np.int64) if counts is None else np.asarray(counts, dtype = np.int64)
+      excluded_reads = np.bincount(seq_nums[~keep], weights = read_counts[~keep], minlength = len(self.seq_names))
+      excluded_umi_well_seqs = np.bincount(seq_nums[~keep], minlength = len(self.seq_names))
+      for seq_num, seq_name in enumerate(self.seq_names):
+        self.excluded_reads[seq_name] += int(excluded_reads[seq_num])
+        self.excluded_umi_well_seqs[seq_name] += int(excluded_umi_well_seqs[seq_num])
+    self.num_checked += len(umi_well_seqs)
+    self.filter_time += time.perf_counter() - start_time
+    return keep
+
+  def report(self):
+    '''
+    The reads excluded by each primer, and the time spent checking umi_well_seqs
+    '''
+    lines = [f'{seq_name} ({self.exclude_seqs[seq_name]}): {self.excluded_reads[seq_name]} reads excluded ({self.excluded_umi_well_seqs[seq_name]} distinct umi_well_seqs)' \
+      for seq_name in self.seq_names]
+    lines.append(f'{self.num_checked} umi_well_seqs checked in {self.filter_time:.2f}s')
+    return('\n'.join(lines))
+
+def read_exclude_seqs(exclude_seqs_filename, name_colname = 'Name', seq_colname = 'Sequence'):
+  '''
+  Black-list of primer (dimer) seqs, as a dict of seq_name: seq, from a CSV file with name_colname and seq_colname columns
+  '''
+  with open(exclude_seqs_filename, newline = '') as exclude_seqs_file:
+    rows = list(csv.DictReader(exclude_seqs_file))
+  if (len(rows) > 0) and ((name_colname not in rows[0]) or (seq_colname not in rows[0])):
+    sys.exit(f'{exclude_seqs_filename} must have {name_colname} and {seq_colname} columns. Exiting.')
+  return({row[name_colname].strip(): row[seq_colname].strip().upper() for row in rows if row[seq_colname].strip()})
+
+_base_codes = np.full(256, 4, dtype = np.int32)
+_base_codes[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(4)
+
+def _ngram_ids(codes, ngram_length):
+  '''
+  (seq, offset) array of the base 5 ids of the ngrams at offsets 0 to seq_length - ngram_length - 1 of each row of codes,
+  i.e. the ngrams a ReadNgramHash indexes
+  '''
+  num_ngrams = codes.shape[1] - ngram_length
+  ngram_ids = np.zeros((codes.shape[0], num_ngrams), dtype = np.int32)
+  for base_num in range(ngram_length):
+    ngram_ids *= 5
+    ngram_ids += codes[:, base_num:(base_num + num_ngrams)]
+  return ngram_ids
@@ -1,30 +1,96 @@
 import sys
+import math
+import zlib
+import functools
+import operator
+import collections
 import Levenshtein
+import numpy as np
 
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
+import packed_seq
+import array_store
 from ReadData import ReadData
         
 class ReadNgramHash:
   '''
   Hash storing ReadData objects, indexed by ngrams, with entries being lists of
   tuples of the corresponding ReadData object and the offset the ngram for that
-  object started from
+  object started from.
+  If packed is True, ACGT-only umi_well_seqs are stored as 2-bit packed ints, ngrams as packed ints, and
+  ngram entries as occurrence counts rather than lists of offsets (see packed_seq). umi_well_seqs containing
+  other characters (e.g. N) are kept as str. All methods still take and return umi_well_seqs as str.
+  index_scheme chooses the terms each umi_well_seq is indexed by (see index_schemes). The default, 'ngrams', indexes
+  every ngram; 'minimizers' only the (minimizer_window, ngram_length)-minimizers, and 'spaced_seeds' the bases picked out
+  by each of spaced_seeds (patterns of 1s for bases used, and 0s for bases ignored, so substitutions there don't matter)
+  at every seed_step'th offset. Queries compare the terms each scheme gives, and only 'ngrams' hashes can be frozen.
+  min_similarity_fraction means the same number of substitutions tolerated in every scheme (see _min_similarity).
+  A substitution can change as many minimizers as a umi_well_seq has, so once any are tolerated (below about 0.77 for
+  32/6), a minimizer query matches every umi_well_seq sharing a single minimizer: on 100k umi_well_seqs at 0.7, with
+  the defaults, ngrams and spaced seeds both found every 1 substitution query (with 0.8 and 2.1 matches each), but
+  minimizers matched 22k umi_well_seqs per query
   '''
 
+  index_schemes = ('ngrams', 'minimizers', 'spaced_seeds')
+
+  packed = False # defaults for hashes pickled before these were added
+  ngram_index = None
+  max_ngram_histogram_cache_size = 1 << 16
+  ngram_histogram_cache_hits = 0
+  ngram_histogram_cache_misses = 0
+  num_distance_candidates = 0
+  index_scheme = 'ngrams'
+  max_dead_fraction = 0.25
+  num_compactions = 0
+
   # methods
-  def __init__(self, seq_length, ngram_length = 6, store_reads = False, build_ngram_histogram_cache = True):
+  def __init__(self, seq_length, ngram_length = 6, store_reads = False, build_ngram_histogram_cache = False, packed = False, max_ngram_histogram_cache_size = 1 << 16,
+    index_scheme = 'ngrams', minimizer_window = 4, spaced_seeds = ('11011011', '10110111'), seed_step = 3, max_dead_fraction = 0.25):
+    if index_scheme not in ReadNgramHash.index_schemes:
+      sys.exit(f'Unknown index_scheme {index_scheme}. Must be one of {ReadNgramHash.index_schemes}. Exiting.')
     self.seq_length = seq_length
     self.ngram_length = ngram_length
+    self.index_scheme = index_scheme
+    self.minimizer_window = minimizer_window
+    self.spaced_seeds = spaced_seeds
+    self.seed_step = seed_step
     self.store_reads = store_reads
     self.build_ngram_histogram_cache = build_ngram_histogram_cache
+    self.packed = packed
     self.umi_well_seq_hash = {}
     self.ngram_hash = {}
-    self.ngram_histogram_cache = {}
+    # least recently used ngram histograms, most recent last. Most umi_well_seqs have no repeated ngrams, and
+    # histogram_intersection_matches doesn't need their histograms at all, so this can be small
+    self.max_ngram_histogram_cache_size = max_ngram_histogram_cache_size
+    self.ngram_histogram_cache = collections.OrderedDict()
+    self.ngram_histogram_cache_hits = 0
+    self.ngram_histogram_cache_misses = 0
+    self.repeated_ngram_keys = set() # keys of the few umi_well_seqs containing an ngram more than once
+    self.ngram_index = None # the NgramIndex replacing ngram_hash, once frozen
+    # deleted umi_well_seqs stay in ngram_hash until more than max_dead_fraction of the keys there are deleted ones,
+    # when it is compacted. Queries skip them, as they are no longer in umi_well_seq_hash
+    self.max_dead_fraction = max_dead_fraction
+    self.deleted_keys = set()
+    self.num_compactions = 0
     # testing
     self.hist_match_diff = 0
     self.num_hist_ints = 0
+    self.num_distance_candidates = 0
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['ngram_histogram_cache'] = collections.OrderedDict() # rebuilt as needed; no need to save it
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if not isinstance(self.ngram_histogram_cache, collections.OrderedDict): # pickled before the cache was bounded
+      self.ngram_histogram_cache = collections.OrderedDict()
+      self.repeated_ngram_keys = set(key for ngram_entries in self.ngram_hash.values() for key, offsets in ngram_entries.items() if len(offsets) > 1)
+    if 'deleted_keys' not in state: # pickled before deletes were deferred, so deleted keys were removed from ngram_hash
+      self.deleted_keys = set()
 
   def __str__(self):
     import collections
@@ -36,86 +102,331 @@ class ReadNgramHash:
       string_rep += '\n'
     return string_rep
     
+  def _key(self, umi_well_seq):
+    '''
+    The key umi_well_seq is stored under: its packed int if packed and it can be packed, otherwise the str itself
+    '''
+    if self.packed and (len(umi_well_seq) == self.seq_length):
+      packed_umi_well_seq = packed_seq.pack_seq(umi_well_seq)
+      if packed_umi_well_seq != None:
+        return packed_umi_well_seq
+    return umi_well_seq
+
+  def _umi_well_seq(self, key):
+    if isinstance(key, int):
+      return packed_seq.unpack_seq(key, self.seq_length)
+    return key
+
+  def _ngrams(self, seq, num_ngrams):
+    return(seq_ngrams(seq, num_ngrams, self.ngram_length, self.seq_length, self.packed))
+
+  def _seq_length(self, seq):
+    return self.seq_length if isinstance(seq, int) else len(seq)
+
+  def _index_terms(self, seq):
+    '''
+    The terms seq (a str, or a key) is indexed by, under index_scheme
+    '''
+    if self.index_scheme == 'minimizers':
+      return seq_minimizers(self._ngrams(seq, self._seq_length(seq) - self.ngram_length), self.minimizer_window, self.ngram_length)
+    if self.index_scheme == 'spaced_seeds':
+      return seq_spaced_seeds(self._umi_well_seq(seq), self.spaced_seeds, self.seed_step, self.packed)
+    return self._ngrams(seq, self._seq_length(seq) - self.ngram_length)
+
+  def _query_terms(self, seq):
+    '''
+    The terms looked up to query with seq. Spaced seeds are taken at every offset of a query, so that they line up
+    with those indexed at every seed_step'th offset, wherever the match is in the query
+    '''
+    if self.index_scheme == 'spaced_seeds':
+      return seq_spaced_seeds(self._umi_well_seq(seq), self.spaced_seeds, 1, self.packed)
+    return self._index_terms(seq)
+
+  def _num_index_terms(self, seq):
+    '''
+    The number of terms a umi_well_seq matching all of seq would share with it
+    '''
+    if self.index_scheme == 'ngrams':
+      return self._seq_length(seq) - self.ngram_length
+    return len(self._index_terms(seq))
+
+  def _min_similarity(self, seq, min_similarity_fraction):
+    '''
+    The number of terms a match must share with seq to be more similar than min_similarity_fraction. That is a fraction
+    of the ngrams of seq, so it guarantees a match with up to a number of substitutions, each of which loses at most
+    ngram_length ngrams (e.g. 1 for 0.7 of 26 ngrams of 6 bases, which can lose 7). The other schemes lose a different
+    share of their terms to a substitution (see max_terms_per_substitution), so their min_similarity guarantees a
+    match with the same number of substitutions
+    '''
+    num_ngrams = self._seq_length(seq) - self.ngram_length
+    if self.index_scheme == 'ngrams':
+      return min_similarity_fraction*num_ngrams
+    num_substitutions = max(0, math.ceil((1 - min_similarity_fraction)*num_ngrams/self.ngram_length) - 1)
+    return self._num_index_terms(seq) - num_substitutions*max_terms_per_substitution(self.index_scheme, self._seq_length(seq), self.ngram_length,
+      self.minimizer_window, self.spaced_seeds, self.seed_step) - 0.5
+
+  def umi_well_seqs(self):
+    '''
+    Generator yielding every umi_well_seq in the hash, as str, in the order they were first inserted
+    '''
+    if self.packed:
+      return (self._umi_well_seq(key) for key in self.umi_well_seq_hash)
+    return iter(self.umi_well_seq_hash)
+
+  def freeze(self, max_posting_fraction = None, stop_ngrams = ()):
+    '''
+    Replace ngram_hash with a compact, array-backed NgramIndex, which is much faster to query, once all reads
+    have been inserted. Queries and deletes work as before, but no more reads can be inserted.
+    Ngrams in more than max_posting_fraction of umi_well_seqs, and any in stop_ngrams, are skipped by queries
+    where possible, without changing the matches (see NgramIndex.set_stop_list)
+    '''
+    from NgramIndex import NgramIndex
+    if self.index_scheme != 'ngrams':
+      sys.exit(f'Only ReadNgramHashes indexing all ngrams can be frozen, not {self.index_scheme}. Exiting.')
+    if self.ngram_index == None:
+      self.compact() # the index is built from the live umi_well_seqs only
+      self.ngram_index = NgramIndex(self)
+      self.ngram_hash = {}
+    self.ngram_index.set_stop_list(max_posting_fraction, stop_ngrams)
+
+  def save(self, filename):
+    '''
+    Save the hash as an array_store file: the sequence table, read counts and postings of its NgramIndex, and a string
+    table of the ngrams. The hash is frozen first if it isn't already, so only hashes indexing all ngrams, without
+    stored reads, can be saved this way (others can still be pickled)
+    '''
+    if self.store_reads:
+      sys.exit('Cannot save a ReadNgramHash storing reads as an array store. Exiting.')
+    if self.ngram_index == None:
+      self.freeze()
+    self.ngram_index.compact() # only the live umi_well_seqs are saved
+    arrays = {array_name: getattr(self.ngram_index, array_name) for array_name in self.ngram_index.array_names}
+    # umi_well_seq_hash has the same umi_well_seqs as the index, in the same order
+    arrays['counts'] = np.fromiter(self.umi_well_seq_hash.values(), dtype = np.int64, count = len(self.umi_well_seq_hash))
+    arrays['ngrams'] = array_store.string_array(packed_seq.unpack_seq(ngram, self.ngram_length) if isinstance(ngram, int) else ngram for ngram in self.ngram_index.ngram_ids)
+    attributes = {'seq_length': self.seq_length, 'ngram_length': self.ngram_length, 'packed': self.packed, 'max_dead_fraction': self.max_dead_fraction}
+    array_store.save(filename, 'ReadNgramHash', arrays, attributes)
+
+  @classmethod
+  def load(cls, filename):
+    '''
+    A frozen ReadNgramHash from a file made by save(). Its NgramIndex uses the arrays mapped from the file, which are
+    only read from disk as queries need them. Deletes and compaction work as usual, as compaction makes new arrays
+    '''
+    from NgramIndex import NgramIndex
+    (attributes, arrays, kind_version) = array_store.load(filename, 'ReadNgramHash')
+    read_ngram_hash = cls(attributes['seq_length'], attributes['ngram_length'], packed = attributes['packed'], max_dead_fraction = attributes['max_dead_fraction'])
+    keys = [read_ngram_hash._key(umi_well_seq) for umi_well_seq in array_store.strings(arrays['seqs'])]
+    read_ngram_hash.umi_well_seq_hash = dict(zip(keys, arrays['counts'].tolist()))
+    ngrams = array_store.strings(arrays['ngrams'])
+    if read_ngram_hash.packed:
+      ngrams = [ngram if packed_ngram == None else packed_ngram for ngram, packed_ngram in zip(ngrams, map(packed_seq.pack_seq, ngrams))]
+    ngram_index = NgramIndex.from_arrays(read_ngram_hash.seq_length, read_ngram_hash.ngram_length, read_ngram_hash.packed,
+      {ngram: ngram_id for ngram_id, ngram in enumerate(ngrams)}, arrays)
+    ngram_index.max_dead_fraction = read_ngram_hash.max_dead_fraction
+    read_ngram_hash.ngram_index = ngram_index
+    read_ngram_hash.repeated_ngram_keys = set(keys[seq_id] for seq_id in np.unique(arrays['posting_seq_ids'][arrays['posting_counts'] > 1]).tolist())
+    return read_ngram_hash
+
   def insert(self, the_read):
+    if self.ngram_index != None:
+      sys.exit('Cannot insert reads into a frozen ReadNgramHash. Exiting.')
     # track the reads where we've seen this UMI/well_id combo
-    if the_read.umi_well_seq in self.umi_well_seq_hash:
-      if (self.store_reads):
-        self.umi_well_seq_hash[the_read.umi_well_seq].append(the_read)
+    if (self.store_reads):
+      key = self._key(the_read.umi_well_seq)
+      if key in self.umi_well_seq_hash:
+        self.umi_well_seq_hash[key].append(the_read)
       else:
-        self.umi_well_seq_hash[the_read.umi_well_seq] += 1
+        self.umi_well_seq_hash[key] = [the_read]
+        self._reinsert_deleted(key)
+        self._insert_ngrams(key)
     else:
-      if (self.store_reads):
-        self.umi_well_seq_hash[the_read.umi_well_seq] = [the_read]
-      else:
-        self.umi_well_seq_hash[the_read.umi_well_seq] = 1
-      # insert ngrams
-      for offset in range(self.seq_length - self.ngram_length):
-        ngram = the_read.umi_well_seq[offset:(offset + self.ngram_length)]
+      self.insert_umi_well_seq(the_read.umi_well_seq)
+
+  def insert_umi_well_seq(self, umi_well_seq, count = 1):
+    '''
+    Record count reads of umi_well_seq without creating a ReadData object. Only valid when store_reads is False
+    '''
+    if self.ngram_index != None:
+      sys.exit('Cannot insert reads into a frozen ReadNgramHash. Exiting.')
+    key = self._key(umi_well_seq)
+    if key in self.umi_well_seq_hash:
+      self.umi_well_seq_hash[key] += count
+    else:
+      self.umi_well_seq_hash[key] = count
+      self._reinsert_deleted(key)
+      self._insert_ngrams(key)
+
+  def _insert_ngrams(self, key):
+    if self.packed:
+      for ngram in self._index_terms(key):
+        if not (ngram in self.ngram_hash):
+          self.ngram_hash[ngram] = {key : 1}
+        else:
+          ngram_entries = self.ngram_hash[ngram]
+          if key in ngram_entries:
+            ngram_entries[key] += 1
+            self.repeated_ngram_keys.add(key)
+          else:
+            ngram_entries[key] = 1
+    else:
+      for offset, ngram in enumerate(self._index_terms(key)):
         if not (ngram in self.ngram_hash):
-          self.ngram_hash[ngram] = {the_read.umi_well_seq : [offset]}
+          self.ngram_hash[ngram] = {key : [offset]}
         else:
-          if the_read.umi_well_seq in self.ngram_hash[ngram]:
-            self.ngram_hash[ngram][the_read.umi_well_seq].append(offset)
+          if key in self.ngram_hash[ngram]:
+            self.ngram_hash[ngram][key].append(offset)
+            self.repeated_ngram_keys.add(key)
           else:
-            self.ngram_hash[ngram].update({the_read.umi_well_seq : [offset]})
+            self.ngram_hash[ngram].update({key : [offset]})
 
-      if (self.build_ngram_histogram_cache):
-        # Insert the umi_well_seq into the ngram_histogram_cache at build time, so it is saved with the hash before any queries
-        self.get_ngram_histogram(the_read.umi_well_seq)
+    if (self.build_ngram_histogram_cache):
+      # Insert the umi_well_seq into the ngram_histogram_cache at build time (bounded, like any other use of the cache)
+      self._get_key_ngram_histogram(key)
   
   def delete(self, umi_well_seq):
-    del self.umi_well_seq_hash[umi_well_seq] # NB the key umi_well_seq *must* have been inserted before this is called
-    for offset in range(self.seq_length - self.ngram_length):
-      ngram = umi_well_seq[offset:(offset + self.ngram_length)]
-      if umi_well_seq in self.ngram_hash[ngram]: # if there were multiple entries for the ngram for the same umi_well_seq, it could already have been deleted
-        del self.ngram_hash[ngram][umi_well_seq]
-        if len(self.ngram_hash[ngram]) == 0:
-          self.ngram_hash[ngram]
-    
+    '''
+    Delete umi_well_seq. Its ngram_hash entries are left in place (queries skip them) until compact() removes them,
+    which happens once more than max_dead_fraction of the umi_well_seqs in ngram_hash are deleted ones
+    '''
+    key = self._key(umi_well_seq)
+    del self.umi_well_seq_hash[key] # NB the key umi_well_seq *must* have been inserted before this is called
+    self.repeated_ngram_keys.discard(key)
+    if self.ngram_index != None:
+      self.ngram_index.delete(umi_well_seq)
+      return
+    self.deleted_keys.add(key)
+    if len(self.deleted_keys) > self.max_dead_fraction*(len(self.umi_well_seq_hash) + len(self.deleted_keys)):
+      self.compact()
+
+  def compact(self):
+    '''
+    Remove the entries of deleted umi_well_seqs from ngram_hash, and any ngrams left with no entries. The order of
+    the remaining entries is unchanged, so queries give the same matches, in the same order
+    '''
+    if not self.deleted_keys:
+      return
+    deleted_keys = self.deleted_keys
+    for ngram in list(self.ngram_hash):
+      ngram_entries = self.ngram_hash[ngram]
+      if not deleted_keys.isdisjoint(ngram_entries):
+        ngram_entries = {key: ngram_entry for key, ngram_entry in ngram_entries.items() if key not in deleted_keys}
+        if ngram_entries:
+          self.ngram_hash[ngram] = ngram_entries
+        else:
+          del self.ngram_hash[ngram]
+    self.deleted_keys = set()
+    self.num_compactions += 1
+
+  def _reinsert_deleted(self, key):
+    '''
+    Remove the entries left in ngram_hash by a deleted key that is being inserted again
+    '''
+    if key not in self.deleted_keys:
+      return
+    self.deleted_keys.discard(key)
+    for ngram in self._index_terms(key):
+      ngram_entries = self.ngram_hash.get(ngram)
+      if (ngram_entries != None) and (key in ngram_entries): # an ngram repeated in the umi_well_seq is only there once
+        del ngram_entries[key]
+        if len(ngram_entries) == 0:
+          del self.ngram_hash[ngram]
+
+
+  def __contains__(self, umi_well_seq):
+    return self._key(umi_well_seq) in self.umi_well_seq_hash
+
   def num_reads(self, umi_well_seq):
     if (self.store_reads):
-      return(len(self.umi_well_seq_hash[umi_well_seq]))
+      return(len(self.umi_well_seq_hash[self._key(umi_well_seq)]))
     else:
-      return(self.umi_well_seq_hash[umi_well_seq])
+      return(self.umi_well_seq_hash[self._key(umi_well_seq)])
 
   def get_ngram_histogram(self, umi_well_seq):
-    if umi_well_seq not in self.ngram_histogram_cache:
-      ngram_histogram = {}
-      for offset in range(self.seq_length - self.ngram_length):
-        ngram = umi_well_seq[offset:(offset + self.ngram_length)]
-        if ngram in ngram_histogram:
-          ngram_histogram[ngram] += 1
-        else:
-          ngram_histogram[ngram] = 1
-      self.ngram_histogram_cache[umi_well_seq] = ngram_histogram
-    return(self.ngram_histogram_cache[umi_well_seq])
+    return(self._get_key_ngram_histogram(self._key(umi_well_seq)))
+
+  def _get_key_ngram_histogram(self, key):
+    ngram_histogram = self.ngram_histogram_cache.get(key)
+    if ngram_histogram != None:
+      self.ngram_histogram_cache_hits += 1
+      self.ngram_histogram_cache.move_to_end(key)
+      return(ngram_histogram)
+    self.ngram_histogram_cache_misses += 1
+    ngram_histogram = {}
+    for ngram in self._index_terms(key):
+      if ngram in ngram_histogram:
+        ngram_histogram[ngram] += 1
+      else:
+        ngram_histogram[ngram] = 1
+    self.ngram_histogram_cache[key] = ngram_histogram
+    if len(self.ngram_histogram_cache) > self.max_ngram_histogram_cache_size:
+      self.ngram_histogram_cache.popitem(last = False)
+    return(ngram_histogram)
+
+  def _has_repeated_ngrams(self, key):
+    if key in self.umi_well_seq_hash:
+      return key in self.repeated_ngram_keys
+    ngrams = self._index_terms(key) # e.g. a query that was never inserted
+    return len(set(ngrams)) < len(ngrams)
+
+  def _shared_ngram_counts(self, query_ngrams):
+    '''
+    Hash of the number of ngram matches between query_ngrams and each stored umi_well_seq key, counting every pair
+    of matching ngram occurrences, with keys in the order first matched
+    '''
+    match_key_counts = {}
+    for ngram in query_ngrams:
+      ngram_entries = self.ngram_hash.get(ngram, {})
+      if self.packed:
+        for match_key, num_occurrences in ngram_entries.items():
+          match_key_counts[match_key] = match_key_counts.get(match_key, 0) + num_occurrences
+      else:
+        for match_key, offsets in ngram_entries.items():
+          match_key_counts[match_key] = match_key_counts.get(match_key, 0) + len(offsets) #TODO if we're never going to use the offsets, just make the hash-hash entry a count?
+    return(match_key_counts)
     
   def umi_well_seq_query(self, query_umi_well_seq, min_similarity_fraction = 0.8, sort_result = False):
-    min_similarity = min_similarity_fraction*(self.seq_length - self.ngram_length)
+    if self.ngram_index != None:
+      return(self.ngram_index.umi_well_seq_query(query_umi_well_seq, min_similarity_fraction, sort_result))
+    query_key = self._key(query_umi_well_seq)
+    min_similarity = self._min_similarity(query_key, min_similarity_fraction)
     # build a hash of matches
-    match_umi_well_seq_counts = {}
-    for offset in range(self.seq_length - self.ngram_length):
-      ngram = query_umi_well_seq[offset:(offset + self.ngram_length)]
-      for match_umi_well_seq in self.ngram_hash[ngram]:
-        if match_umi_well_seq in match_umi_well_seq_counts:
-          match_umi_well_seq_counts[match_umi_well_seq] += len(self.ngram_hash[ngram][match_umi_well_seq]) #TODO if we're never going to use the offsets, just make the hash-hash entry a count?
-        else:
-          match_umi_well_seq_counts[match_umi_well_seq] = len(self.ngram_hash[ngram][match_umi_well_seq])
+    match_key_counts = self._shared_ngram_counts(self._query_terms(query_key))
     # compute similarities to query
-    matches = [(match_umi_well_seq, match_umi_well_seq_counts[match_umi_well_seq]) \
-      for match_umi_well_seq in match_umi_well_seq_counts if match_umi_well_seq_counts[match_umi_well_seq] > min_similarity]
+    matches = [(self._umi_well_seq(match_key), match_key_counts[match_key]) \
+      for match_key in match_key_counts if (match_key_counts[match_key] > min_similarity) and (match_key in self.umi_well_seq_hash)]
     if sort_result:
       matches = sorted(matches, key = lambda match : match[1], reverse = True)
     return(matches)
 
   def umi_well_seq_query_with_histogram_intersection(self, query_umi_well_seq, min_similarity_fraction = 0.8, sort_result = False):
-    min_similarity = min_similarity_fraction*(self.seq_length - self.ngram_length)
     preliminary_matches = self.umi_well_seq_query(query_umi_well_seq, min_similarity_fraction = min_similarity_fraction, sort_result = False) # Don't want to sort preliminary matches, no matter what.
-    match_similarities = [(match_umi_well_seq, \
-      histogram_intersection( \
-      self.get_ngram_histogram(query_umi_well_seq), \
-      self.get_ngram_histogram(match_umi_well_seq)) \
-      ) for match_umi_well_seq, match_umi_well_seq_count in preliminary_matches]
+    return(self.histogram_intersection_matches(query_umi_well_seq, preliminary_matches, min_similarity_fraction, sort_result))
+
+  def histogram_intersection_matches(self, query_umi_well_seq, preliminary_matches, min_similarity_fraction = 0.8, sort_result = False):
+    '''
+    Rescore the (umi_well_seq, count) preliminary_matches of a query (e.g. from query_many) by ngram histogram intersection,
+    keeping those still more similar than min_similarity_fraction
+    '''
+    min_similarity = self._min_similarity(self._key(query_umi_well_seq), min_similarity_fraction)
+    if self.ngram_index != None:
+      # all of the intersections at once, from the index's sparse histograms
+      match_umi_well_seqs = [match_umi_well_seq for match_umi_well_seq, num_shared_ngrams in preliminary_matches]
+      similarities = self.ngram_index.histogram_intersections([query_umi_well_seq], np.zeros(len(match_umi_well_seqs), dtype = np.int64), \
+        self.ngram_index.seq_ids(match_umi_well_seqs))
+      match_similarities = list(zip(match_umi_well_seqs, similarities.tolist()))
+    else:
+      # when neither umi_well_seq has a repeated ngram, the histogram intersection is the number of shared ngrams, which
+      # is the count in the preliminary match, so the histograms are only needed for umi_well_seqs with repeated ngrams
+      query_key = self._key(query_umi_well_seq)
+      query_has_repeated_ngrams = self._has_repeated_ngrams(query_key)
+      match_similarities = []
+      for match_umi_well_seq, num_shared_ngrams in preliminary_matches:
+        match_key = self._key(match_umi_well_seq)
+        if query_has_repeated_ngrams or self._has_repeated_ngrams(match_key):
+          match_similarities.append((match_umi_well_seq, histogram_intersection(self._get_key_ngram_histogram(query_key), self._get_key_ngram_histogram(match_key))))
+        else:
+          match_similarities.append((match_umi_well_seq, num_shared_ngrams))
     final_matches = [(match_umi_well_seq, similarity) for (match_umi_well_seq, similarity) in match_similarities if similarity > min_similarity]
     self.num_hist_ints += len(preliminary_matches)
     self.hist_match_diff += len(preliminary_matches) - len(final_matches)
@@ -123,25 +434,155 @@ class ReadNgramHash:
       final_matches = sorted(final_matches, key = lambda match : match[1], reverse = True)
     return(final_matches)
     
+  def query_many(self, query_umi_well_seqs, min_similarity_fraction = 0.8, sort_result = False):
+    '''
+    Query with a block of umi_well_seqs at once. Returns a list with the matches for each query, exactly as
+    umi_well_seq_query would return them. Once frozen, all of the queries are scored in one vectorised pass over
+    the postings (see NgramIndex.query_many), which is much faster than querying one at a time
+    '''
+    if self.ngram_index == None:
+      return [self.umi_well_seq_query(query_umi_well_seq, min_similarity_fraction, sort_result) for query_umi_well_seq in query_umi_well_seqs]
+    similarities = self.ngram_index.query_many(query_umi_well_seqs, min_similarity_fraction)
+    return [self.ngram_index._matches((similarities.indices[start:end], similarities.data[start:end]), sort_result) \
+      for start, end in zip(similarities.indptr[:-1], similarities.indptr[1:])]
+
+  def umi_well_seq_distance_query(self, query_umi_well_seq, max_distance, dist_measure = Levenshtein.hamming):
+    '''
+    All umi_well_seqs within max_distance of query_umi_well_seq by dist_measure (Levenshtein.hamming or Levenshtein.distance),
+    as a list of (umi_well_seq, distance) tuples, sorted by distance, then umi_well_seq. Candidates are the umi_well_seqs
+    containing at least min_shared_ngrams of the query's ngram positions, and only they are checked with dist_measure.
+    Query ngrams are taken rarest first, and once the rest are too few to make a new candidate, the umi_well_seqs containing
+    them are only looked up for the candidates already found, rather than all visited
+    '''
+    if self.index_scheme == 'ngrams':
+      min_shared = min_shared_ngrams(self.seq_length, self.ngram_length, max_distance, dist_measure)
+    else:
+      min_shared = 0 # the q-gram lemma only holds for all ngrams, so every umi_well_seq is a candidate
+    if self.ngram_index != None:
+      match_keys = self.ngram_index.distance_query_candidates(query_umi_well_seq, min_shared)
+    else:
+      match_keys = self._distance_query_candidates(self._key(query_umi_well_seq), min_shared)
+    self.num_distance_candidates += len(match_keys)
+    matches = [(match_umi_well_seq, dist_measure(query_umi_well_seq, match_umi_well_seq)) for match_umi_well_seq in map(self._umi_well_seq, match_keys)]
+    return(sorted([match for match in matches if match[1] <= max_distance], key = lambda match : (match[1], match[0])))
+
+  def _distance_query_candidates(self, query_key, min_shared):
+    if min_shared <= 0:
+      return list(self.umi_well_seq_hash) # every umi_well_seq could be within the distance
+    query_ngram_counts = collections.Counter(self._ngrams(query_key, self.seq_length - self.ngram_length))
+    query_ngrams = sorted(query_ngram_counts, key = lambda ngram : len(self.ngram_hash.get(ngram, {})))
+    # a umi_well_seq not in the postings of the rarest ngrams can't have enough of the remaining ones
+    remaining = sum(query_ngram_counts.values())
+    match_keys = {}
+    for ngram in query_ngrams:
+      if remaining < min_shared:
+        break
+      remaining -= query_ngram_counts[ngram]
+      match_keys.update(dict.fromkeys(self.ngram_hash.get(ngram, {})))
+    # count the query ngram positions each candidate has
+    num_shared = dict.fromkeys(match_keys, 0)
+    for ngram, query_ngram_count in query_ngram_counts.items():
+      ngram_entries = self.ngram_hash.get(ngram, {})
+      for match_key in match_keys:
+        if match_key in ngram_entries:
+          num_shared[match_key] += query_ngram_count
+    return [match_key for match_key in match_keys if (num_shared[match_key] >= min_shared) and (match_key in self.umi_well_seq_hash)]
+
   def seq_ngram_query(self, query_seq, min_similarity_fraction = 0.8, sort_result = False):
     # TODO replace umi_well_seq_query with this - at almost zero cost
-    min_similarity = min_similarity_fraction*(len(query_seq) - self.ngram_length)
+    if self.ngram_index != None:
+      return(self.ngram_index.seq_ngram_query(query_seq, min_similarity_fraction, sort_result))
+    min_similarity = self._min_similarity(query_seq, min_similarity_fraction)
     # build a hash of matches
-    match_umi_well_seq_counts = {}
-    for offset in range(len(query_seq) - self.ngram_length):
-      ngram = query_seq[offset:(offset + self.ngram_length)]
-      for match_umi_well_seq in self.ngram_hash[ngram]:
-        if match_umi_well_seq in match_umi_well_seq_counts:
-          match_umi_well_seq_counts[match_umi_well_seq] += len(self.ngram_hash[ngram][match_umi_well_seq]) #TODO if we're never going to use the offsets, just make the hash-hash entry a count?
-        else:
-          match_umi_well_seq_counts[match_umi_well_seq] = len(self.ngram_hash[ngram][match_umi_well_seq])
+    match_key_counts = self._shared_ngram_counts(self._query_terms(query_seq))
     # compute similarities to query
-    matches = [(match_umi_well_seq, match_umi_well_seq_counts[match_umi_well_seq]) \
-      for match_umi_well_seq in match_umi_well_seq_counts if match_umi_well_seq_counts[match_umi_well_seq] > min_similarity]
+    matches = [(self._umi_well_seq(match_key), match_key_counts[match_key]) \
+      for match_key in match_key_counts if (match_key_counts[match_key] > min_similarity) and (match_key in self.umi_well_seq_hash)]
     if sort_result:
       matches = sorted(matches, key = lambda match : match[1], reverse = True)
     return(matches)
     
+def min_shared_ngrams(seq_length, ngram_length, max_distance, dist_measure = Levenshtein.hamming):
+  '''
+  q-gram lemma: the minimum number of the (seq_length - ngram_length) indexed ngram positions of a query that must also be
+  ngrams of any umi_well_seq within max_distance of it. Each substitution changes at most ngram_length of the query's
+  ngrams. With Levenshtein.distance (or any measure that is at least the edit distance), each edit also changes at most
+  ngram_length ngrams, but an unchanged ngram can shift to the one ngram position of a umi_well_seq that isn't indexed
+  '''
+  num_ngrams = seq_length - ngram_length
+  if dist_measure is Levenshtein.hamming:
+    return num_ngrams - max_distance*ngram_length
+  return num_ngrams - max_distance*ngram_length - 1
+
+_minimizer_orders = {} # the order of each ngram seen, by a hash of its bases, so it is the same whether or not packed
+
+def _minimizer_order(ngram, ngram_length):
+  order = _minimizer_orders.get(ngram)
+  if order == None:
+    order = zlib.crc32((packed_seq.unpack_seq(ngram, ngram_length) if isinstance(ngram, int) else ngram).encode('ascii'))
+    _minimizer_orders[ngram] = order
+  return order
+
+def seq_minimizers(ngrams, minimizer_window, ngram_length):
+  '''
+  The (minimizer_window, ngram_length)-minimizers of a seq, given its ngrams: the lowest ngram (in a hashed order, with
+  ties going to the leftmost) in each window of minimizer_window consecutive ngrams, once for each position chosen.
+  Any two seqs sharing a run of minimizer_window + ngram_length - 1 bases share the minimizer of that window
+  '''
+  orders = [_minimizer_order(ngram, ngram_length) for ngram in ngrams]
+  positions = []
+  for window_start in range(max(1, len(ngrams) - minimizer_window + 1)):
+    window_orders = orders[window_start:(window_start + minimizer_window)]
+    position = window_start + window_orders.index(min(window_orders))
+    if (not positions) or (positions[-1] != position):
+      positions.append(position)
+  return [ngrams[position] for position in positions]
+
+@functools.lru_cache(maxsize = None)
+def max_terms_per_substitution(index_scheme, seq_length, ngram_length, minimizer_window, spaced_seeds, seed_step):
+  '''
+  The most terms of a seq of seq_length that a single base substitution can stop a query sharing, under index_scheme:
+  ngram_length ngrams cover a base; a substitution changes the ngrams of up to ngram_length + minimizer_window - 1
+  minimizer windows, each with its own minimizer; and the spaced seed terms lost are those indexed (at every
+  seed_step'th offset) with a 1 over the base
+  '''
+  if index_scheme == 'minimizers':
+    return ngram_length + minimizer_window - 1
+  if index_scheme == 'spaced_seeds':
+    return max([sum([1 for spaced_seed in spaced_seeds for offset in range(0, seq_length - len(spaced_seed) + 1, seed_step) \
+      if (offset <= position < offset + len(spaced_seed)) and (spaced_seed[position - offset] == '1')]) for position in range(seq_length)])
+  return ngram_length
+
+def seq_spaced_seeds(seq, spaced_seeds, seed_step, packed = False):
+  '''
+  The terms of seq (a str) for each of spaced_seeds, at every seed_step'th offset: the seed number and the bases
+  where the seed has a 1. They are packed ints (with the seed number in the high bits) if packed and the bases are ACGT
+  '''
+  terms = []
+  for seed_num, spaced_seed in enumerate(spaced_seeds):
+    seed_positions = [position for position, used in enumerate(spaced_seed) if used == '1']
+    seed_bases = operator.itemgetter(*seed_positions)
+    for offset in range(0, len(seq) - len(spaced_seed) + 1, seed_step):
+      bases = ''.join(seed_bases(seq[offset:(offset + len(spaced_seed))]))
+      packed_bases = packed_seq.pack_seq(bases) if packed else None
+      terms.append(f'{seed_num}:{bases}' if packed_bases == None else (seed_num << (2*len(spaced_seed))) | packed_bases)
+  return terms
+
+def seq_ngrams(seq, num_ngrams, ngram_length, seq_length, packed = False):
+  '''
+  List of the ngrams at offsets 0 to num_ngrams - 1 of seq, which is a str, or a packed key of seq_length bases.
+  When packed, every ACGT-only ngram is a packed int, whatever seq it comes from, so lookups are consistent
+  '''
+  if isinstance(seq, int):
+    return packed_seq.ngram_ids(seq, seq_length, ngram_length, num_ngrams)
+  if packed:
+    packed_query_seq = packed_seq.pack_seq(seq)
+    if packed_query_seq != None:
+      return packed_seq.ngram_ids(packed_query_seq, len(seq), ngram_length, num_ngrams)
+    ngrams = [seq[offset:(offset + ngram_length)] for offset in range(num_ngrams)]
+    return [ngram if packed_ngram == None else packed_ngram for ngram, packed_ngram in zip(ngrams, map(packed_seq.pack_seq, ngrams))]
+  return [seq[offset:(offset + ngram_length)] for offset in range(num_ngrams)]
+
 def histogram_intersection(hist1, hist2):
   similarity = 0
   for entry in hist1.keys():
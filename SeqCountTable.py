@@ -0,0 +1,156 @@
+import collections
+import functools
+import sys
+import numpy as np
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import array_store
+import fastq_reader
+import parallel_ingest
+from FastqPipeline import FastqPipeline
+
+class SeqCountTable:
+  '''
+  Read counts of each distinct (seq, amplicon_id) in a FASTQ run, where seq is the barcode region: the first
+  region_length bases of the read. This is all any of the analyses needs from the reads, so the FASTQ only has to be
+  decompressed once (see ingest-fastq.py), and every index is built from the table.
+  Columns are sorted by seq, then amplicon_num: seqs is a fixed-width bytes array, amplicon_nums index the
+  amplicon_ids string table, counts is uint32, and first_seen gives the order in which each (seq, amplicon_id) was first
+  read, so indexes built from the table can be identical to those built by reading the FASTQ serially
+  '''
+
+  kind_version = 1
+
+  def __init__(self, seqs, amplicon_nums, amplicon_ids, counts, first_seen, region_length, n_read):
+    self.seqs = seqs
+    self.amplicon_nums = amplicon_nums
+    self.amplicon_ids = amplicon_ids # list of str; [''] if amplicon_ids weren't read
+    self.counts = counts
+    self.first_seen = first_seen
+    self.region_length = region_length
+    self.n_read = n_read
+    self.ingest_report = None # FastqPipeline report, if the table was just ingested through one
+
+  def __len__(self):
+    return len(self.seqs)
+
+  def __str__(self):
+    return(f'SeqCountTable: {len(self.seqs)} distinct seqs x amplicon_ids, region_length {self.region_length}, {self.n_read} reads, {len(self.amplicon_ids)} amplicon_ids')
+
+  @classmethod
+  def from_key_counts(cls, key_counts, region_length, include_amplicon_id = True, n_read = None):
+    '''
+    Table of a Counter of b'seq:amplicon_id' (or just b'seq' keys, if not include_amplicon_id) keys, as made by
+    parallel_ingest.count_shard_keys, in the order they were first seen
+    '''
+    keys = list(key_counts)
+    if include_amplicon_id:
+      split_keys = [key.rsplit(b':', 1) for key in keys]
+      seqs = [seq for seq, amplicon_id in split_keys]
+      key_amplicon_ids = [amplicon_id for seq, amplicon_id in split_keys]
+      amplicon_ids = list(dict.fromkeys(key_amplicon_ids))
+      amplicon_id_nums = {amplicon_id: amplicon_num for amplicon_num, amplicon_id in enumerate(amplicon_ids)}
+      amplicon_nums = np.fromiter((amplicon_id_nums[amplicon_id] for amplicon_id in key_amplicon_ids), dtype = np.int32, count = len(keys))
+      amplicon_ids = [amplicon_id.decode('ascii') for amplicon_id in amplicon_ids]
+    else:
+      seqs = keys
+      amplicon_nums = np.zeros(len(keys), dtype = np.int32)
+      amplicon_ids = ['']
+    counts = np.fromiter(key_counts.values(), dtype = np.int64, count = len(keys))
+    if (len(counts) > 0) and (counts.max() > np.iinfo(np.uint32).max):
+      sys.exit('Read count too large for a SeqCountTable. Exiting.')
+    seqs = np.array(seqs, dtype = f'S{max(1, region_length)}')
+    # sort by seq, then amplicon_num
+    order = np.lexsort((amplicon_nums, seqs))
+    return cls(seqs[order], amplicon_nums[order], amplicon_ids, counts[order].astype(np.uint32), order.astype(np.int64),
+      region_length, int(counts.sum()) if n_read == None else n_read)
+
+  @classmethod
+  def ingest(cls, fastq_filenames, region_length, include_amplicon_id = True, num_workers = parallel_ingest.default_num_workers, max_to_read = None):
+    '''
+    Table of the reads in fastq_filenames (e.g. pre-split chunks of the same run), in order. BGZF files and multiple
+    files are counted by shard in parallel; a single gzip file through a FastqPipeline, which also stops after
+    max_to_read reads, if that is given
+    '''
+    shards = fastq_reader.fastq_shards(fastq_filenames, num_workers)
+    if (max_to_read == None) and (len(shards) > 1):
+      count_shard = functools.partial(parallel_ingest.count_shard_keys, key_slices = [(0, region_length)], include_amplicon_id = include_amplicon_id)
+      (key_counts, n_read, n_skipped) = parallel_ingest.merge_shard_counts(parallel_ingest.map_shards(count_shard, shards, num_workers))
+      return cls.from_key_counts(key_counts, region_length, include_amplicon_id, n_read)
+    key_counts = collections.Counter()
+    n_read = 0
+    for fastq_filename in fastq_filenames:
+      fastq_pipeline = FastqPipeline(fastq_filename)
+      for read_id_lines, sequences in fastq_pipeline.batches():
+        if max_to_read != None:
+          sequences = sequences[0:(max_to_read - n_read)]
+        keys = [sequence[0:region_length] for sequence in sequences]
+        if include_amplicon_id:
+          keys = [key + b':' + amplicon_id for key, amplicon_id in zip(keys, fastq_reader.amplicon_ids(read_id_lines[0:len(keys)]))]
+        key_counts.update(keys)
+        n_read += len(sequences)
+        if (max_to_read != None) and (n_read >= max_to_read):
+          break
+      if (max_to_read != None) and (n_read >= max_to_read):
+        break
+    seq_count_table = cls.from_key_counts(key_counts, region_length, include_amplicon_id, n_read)
+    seq_count_table.ingest_report = fastq_pipeline.report()
+    return seq_count_table
+
+  def save(self, filename, attributes = {}):
+    arrays = {'seqs': self.seqs, 'amplicon_nums': self.amplicon_nums, 'amplicon_ids': array_store.string_array(self.amplicon_ids),
+      'counts': self.counts, 'first_seen': self.first_seen}
+    array_store.save(filename, 'SeqCountTable', arrays, dict(attributes, region_length = self.region_length, n_read = self.n_read), SeqCountTable.kind_version)
+
+  @classmethod
+  def load(cls, filename):
+    '''
+    Table from a file made by save(), with its columns mapped from the file
+    '''
+    (attributes, arrays, kind_version) = array_store.load(filename, 'SeqCountTable')
+    return cls(arrays['seqs'], arrays['amplicon_nums'], array_store.strings(arrays['amplicon_ids']), arrays['counts'], arrays['first_seen'],
+      attributes['region_length'], attributes['n_read'])
+
+  def key_counts(self, key_slices, include_amplicon_id = True, ignore_Ns = False):
+    '''
+    Read counts by key, as parallel_ingest.count_shard_keys would count them from the FASTQ, but as a tuple of
+    (keys, counts, n_skipped): keys a list of tuples of the str slices of the seqs given by key_slices (a list of
+    (start, end) tuples within region_length), followed by the amplicon_id if include_amplicon_id is True, in the
+    order they were first read; counts an int64 array of their read counts; and n_skipped the number of reads
+    skipped for having an N in any key slice, if ignore_Ns is True
+    '''
+    if any(end > self.region_length for start, end in key_slices):
+      sys.exit(f'Key slices {key_slices} reach beyond the {self.region_length} bases counted. Exiting.')
+    seq_bytes = np.asarray(self.seqs).view(np.uint8).reshape(len(self.seqs), -1)
+    key_bytes = [seq_bytes[:, start:end] for start, end in key_slices]
+    counts = np.asarray(self.counts, dtype = np.int64)
+    first_seen = np.asarray(self.first_seen)
+    n_skipped = 0
+    if ignore_Ns:
+      has_N = np.zeros(len(self.seqs), dtype = bool)
+      for key_slice_bytes in key_bytes:
+        has_N |= (key_slice_bytes == ord('N')).any(axis = 1)
+      n_skipped = int(counts[has_N].sum())
+      key_bytes = [key_slice_bytes[~has_N] for key_slice_bytes in key_bytes]
+      counts = counts[~has_N]
+      first_seen = first_seen[~has_N]
+    amplicon_nums = np.asarray(self.amplicon_nums)[~has_N] if ignore_Ns else np.asarray(self.amplicon_nums)
+    if include_amplicon_id:
+      key_bytes.append(amplicon_nums.astype('>i4').view(np.uint8).reshape(-1, 4))
+    if len(counts) == 0:
+      return ([], np.zeros(0, dtype = np.int64), n_skipped)
+    # group the rows with the same key, in the order each key was first read
+    all_key_bytes = np.ascontiguousarray(np.concatenate(key_bytes, axis = 1))
+    (_, key_rows, key_nums) = np.unique(all_key_bytes.view(np.dtype((np.void, all_key_bytes.shape[1]))).ravel(), return_index = True, return_inverse = True)
+    key_nums = key_nums.ravel()
+    key_counts = np.bincount(key_nums, weights = counts, minlength = len(key_rows)).astype(np.int64)
+    key_first_seen = np.full(len(key_rows), np.iinfo(np.int64).max, dtype = np.int64)
+    np.minimum.at(key_first_seen, key_nums, first_seen)
+    order = np.argsort(key_first_seen, kind = 'stable')
+    key_parts = [[part.decode('ascii') for part in key_slice_bytes[key_rows[order]].view(f'S{key_slice_bytes.shape[1]}').ravel().tolist()] \
+      for key_slice_bytes in key_bytes[0:len(key_slices)]]
+    if include_amplicon_id:
+      key_parts.append([self.amplicon_ids[amplicon_num] for amplicon_num in amplicon_nums[key_rows[order]].tolist()])
+    return (list(zip(*key_parts)), key_counts[order], n_skipped)
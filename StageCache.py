@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import time
+
+class StageCache:
+  '''
+  Directory of the artifacts built by each stage of a script, e.g. read counts, then the ReadNgramHash indexing them,
+  then the well_id hash of its umi_well_seqs. Each artifact is keyed on a hash of its stage, all the parameters it
+  is built with, and the keys of the upstream artifacts it is built from, so a change to any of them, however far
+  upstream, gives a new key rather than reusing a stale artifact. Input files are identified by a hash of their
+  content (see file_digest), not their names. A manifest of the parameters and upstream keys is written beside
+  each artifact once it is complete, recording its lineage, so a stage whose own parameters change can be rebuilt
+  from the artifacts upstream of it that are still valid, rather than from the raw reads
+  '''
+
+  digests_filename = 'file-digests.json'
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    os.makedirs(cache_dir, exist_ok = True)
+
+  def file_digest(self, filename):
+    '''
+    SHA-256 of the content of filename. Hashing a large FASTQ takes a while, so digests are remembered in the cache
+    directory, and only recomputed when the file's path, size or modification time change
+    '''
+    file_stat = os.stat(filename)
+    file_identity = f'{os.path.realpath(filename)}:{file_stat.st_size}:{file_stat.st_mtime_ns}'
+    digests_path = os.path.join(self.cache_dir, StageCache.digests_filename)
+    digests = {}
+    if os.path.exists(digests_path):
+      with open(digests_path) as digests_file:
+        digests = json.load(digests_file)
+    if file_identity not in digests:
+      file_hash = hashlib.sha256()
+      with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+          file_hash.update(block)
+      digests[file_identity] = file_hash.hexdigest()
+      _write_json(digests_path, digests)
+    return digests[file_identity]
+
+  def key(self, stage, parameters, upstream = {}):
+    '''
+    Hex key of stage's artifact, built with parameters (a dict of JSON-serialisable values) from the upstream
+    artifacts whose keys are given in upstream (a dict of stage: key)
+    '''
+    key_json = json.dumps({'stage': stage, 'parameters': parameters, 'upstream': upstream}, sort_keys = True)
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+  def filename(self, stage, key, extension = '.arrays'):
+    '''
+    The file stage's artifact with key is (to be) saved in
+    '''
+    return os.path.join(self.cache_dir, f'{stage}_{key[0:16]}{extension}')
+
+  def exists(self, stage, key):
+    '''
+    True if the artifact with key has been completely saved, i.e. its manifest has been recorded
+    '''
+    return os.path.exists(self._manifest_filename(stage, key))
+
+  def record(self, stage, key, parameters, upstream = {}):
+    '''
+    Record the manifest of an artifact, once it has been saved in filename(stage, key)
+    '''
+    manifest = {'stage': stage, 'key': key, 'parameters': parameters, 'upstream': upstream, 'created': time.asctime()}
+    _write_json(self._manifest_filename(stage, key), manifest)
+
+  def manifest(self, stage, key):
+    with open(self._manifest_filename(stage, key)) as manifest_file:
+      return json.load(manifest_file)
+
+  def lineage(self, stage, key):
+    '''
+    List of the manifests of an artifact and of everything upstream of it, most upstream last
+    '''
+    manifests = [self.manifest(stage, key)]
+    for upstream_stage, upstream_key in manifests[0]['upstream'].items():
+      if self.exists(upstream_stage, upstream_key):
+        manifests.extend(self.lineage(upstream_stage, upstream_key))
+    return manifests
+
+  def _manifest_filename(self, stage, key):
+    return self.filename(stage, key, '.json')
+
+def _write_json(filename, data):
+  temporary_filename = filename + '.tmp'
+  with open(temporary_filename, 'w') as json_file:
+    json.dump(data, json_file, indent = 2, sort_keys = True)
+  os.replace(temporary_filename, filename)
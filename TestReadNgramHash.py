@@ -0,0 +1,37 @@
+#! /usr/bin/env python
+
+import sys
+import random
+import Levenshtein
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+from ReadNgramHash import ReadNgramHash
+
+random.seed(1)
+umi_well_seqs = [''.join(random.choice('ACGT') for i in range(20)) for j in range(500)]
+query_umi_well_seq = umi_well_seqs[0]
+# near neighbours of the query, at a range of distances
+for num_changes in (1, 2, 2, 3, 3, 4):
+  changed = list(query_umi_well_seq)
+  for pos in random.sample(range(20), num_changes):
+    changed[pos] = random.choice('ACGT'.replace(changed[pos], ''))
+  umi_well_seqs.append(''.join(changed))
+
+for packed, frozen in ((False, False), (True, False), (True, True)):
+  ngram_hash = ReadNgramHash(20, ngram_length = 4, packed = packed)
+  for umi_well_seq in umi_well_seqs:
+    ngram_hash.insert_umi_well_seq(umi_well_seq)
+  if frozen:
+    ngram_hash.freeze()
+  for dist_measure in (Levenshtein.hamming, Levenshtein.distance):
+    result = ngram_hash.umi_well_seq_distance_query(query_umi_well_seq, 4, dist_measure)
+    print(f'packed: {packed}, frozen: {frozen}, dist_measure: {dist_measure.__name__}')
+    for umi_well_seq, distance in result:
+      print(umi_well_seq, distance)
+    distances = [distance for umi_well_seq, distance in result]
+    if distances != sorted(distances):
+      sys.exit(f'Distances {distances} are not in non-decreasing order. Exiting.')
+    if result != sorted(result, key = lambda match : (match[1], match[0])):
+      sys.exit(f'Matches with the same distance are not in umi_well_seq order. Exiting.')
@@ -3,15 +3,15 @@ class UMIData:
     Information associated with a UMI in Seq Data
     '''
 
-    def __init__(self, umi, well_id, amplicon_id):
+    def __init__(self, umi, well_id, amplicon_id, count = 1):
         self.umi = umi # the UMI to which this data corresponds
-        self.count = 1 # the number of times we have seen this UMI
+        self.count = count # the number of times we have seen this UMI
         # hash of all well_ids seen for this UMI; keys are well_ids,values are hashes with two elements:
         # a well_id count, and a hash with amplicon_ids as keys, and the amplicon_id count as the value
         self.well_ids = {well_id:
           {
-            'count': 1,
-            'amplicon_ids': {amplicon_id: 1}
+            'count': count,
+            'amplicon_ids': {amplicon_id: count}
           }
         }
 
@@ -25,20 +25,20 @@ class UMIData:
         string_rep += ''.join('\t\tAmplicon ID: %s, count: %d\n' % amplicon_id_count for amplicon_id_count in sorted_amplicon_ids)
       return string_rep
 
-    def add_read(self, well_id, amplicon_id):
+    def add_read(self, well_id, amplicon_id, count = 1):
       '''
-      Add information from another read to a UMIData object
+      Add information from another read (or count reads with the same IDs) to a UMIData object
       '''
-      self.count += 1
+      self.count += count
       if well_id in self.well_ids:
-        self.well_ids[well_id]['count'] += 1
+        self.well_ids[well_id]['count'] += count
         if amplicon_id in self.well_ids[well_id]['amplicon_ids']:
-          self.well_ids[well_id]['amplicon_ids'][amplicon_id] += 1
+          self.well_ids[well_id]['amplicon_ids'][amplicon_id] += count
         else:
-          self.well_ids[well_id]['amplicon_ids'][amplicon_id] = 1
+          self.well_ids[well_id]['amplicon_ids'][amplicon_id] = count
       else:
         self.well_ids[well_id] = {
-            'count': 1,
-            'amplicon_ids': {amplicon_id: 1}
+            'count': count,
+            'amplicon_ids': {amplicon_id: count}
           }
 
@@ -1,8 +1,11 @@
 import sys
+import numpy as np
 
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
+import array_store
+from ArrayTrie import ArrayTrie
 from HashTrie import HashTrie
 from UMIData import UMIData
 
@@ -11,92 +14,68 @@ class UMIHashTrie(HashTrie):
     def __init__(self):
       super().__init__()
     
-    def record_read(self, umi_id, well_id, amplicon_id):
+    def record_read(self, umi_id, well_id, amplicon_id, count = 1):
   
       umi_data = self.full_query(umi_id)
       if umi_data:
         umi_data = umi_data[umi_id]['trie_object']
-        umi_data.add_read(well_id, amplicon_id)
+        umi_data.add_read(well_id, amplicon_id, count)
       else:
-        new_umi = UMIData(umi_id, well_id, amplicon_id)
+        new_umi = UMIData(umi_id, well_id, amplicon_id, count)
         self.insert(new_umi.umi, new_umi)
 
-    def _destructive_full_query_dfs_with_errors(self, node, query_word, partial_result, num_errors, max_errors, level):
-        """Do depth first searches until we either reach an end node (meaning
-        have a match), or cannot find the next node (meaning the initial query
-        word is not in the trie)
-        When a word is matched according to the criterion, it is removed from the trie,
-        and this method returns True, signalling to the caller to remove the token that
-        led to the match from the children array
-        """
-        #print('\t'*level, 'query_word: ', query_word)
-        #print('\t'*level, 'node.token: ', node.token)
-        #print('\t'*level, 'partial_result: ', partial_result)
-        #print('\t'*level, 'num_errors: ', num_errors)
-        #print('\t'*level, 'max_errors: ', max_errors, '\n')
-        
-        if num_errors > max_errors:
-            #print('\t'*level, 'Too many errors\n')
-            return False
-        
-        if node.is_end:
-            #print('\t'*level, 'Found end.\n')
-            self.result[partial_result] = {
-                'trie_object': node.trie_object,
-                'num_errors': num_errors
-            }
-            return True # match found so trigger destruction of this node
-            
-        if len(query_word) < 1:
-            #print('\t'*level, 'Empty word.\n')
-            return False
+    def save(self, filename):
+      '''
+      Save the UMIData of every UMI as an array_store file: a table of UMIs, well_ids and amplicon_ids, and a
+      (umi, well_id, amplicon_id, count) row for each combination seen, in the order they were first seen.
+      Unlike pickling the trie, this doesn't recurse through its nodes, which load() rebuilds
+      '''
+      well_id_nums = {}
+      amplicon_id_nums = {}
+      rows = [(umi_num, well_id_nums.setdefault(well_id, len(well_id_nums)), amplicon_id_nums.setdefault(amplicon_id, len(amplicon_id_nums)), count) \
+        for umi_num, umi_data in enumerate(self.entries.values()) \
+        for well_id, well_id_data in umi_data.well_ids.items() \
+        for amplicon_id, count in well_id_data['amplicon_ids'].items()]
+      rows = np.array(rows, dtype = np.int64).reshape(-1, 4)
+      arrays = {'umis': array_store.string_array(self.entries), 'well_ids': array_store.string_array(well_id_nums),
+        'amplicon_ids': array_store.string_array(amplicon_id_nums),
+        'umi_nums': rows[:, 0].astype(np.int32), 'well_id_nums': rows[:, 1].astype(np.int32), 'amplicon_id_nums': rows[:, 2].astype(np.int32),
+        'counts': rows[:, 3].astype(np.uint32)}
+      array_store.save(filename, 'UMIHashTrie', arrays)
 
-        query_token = query_word[0]
-        tokens_to_destroy = [] # note, with inexact matching, there can be more than one path that leads to a match
-        for token in node.children:
-            #print('\t'*level, 'Level: ', level, 'token: ', token, '\n')
-            if token != query_token:
-                error_increment = 1
-            else:
-                error_increment = 0
-            destroy_token = self._destructive_full_query_dfs_with_errors(
-                node = node.children[token],
-                query_word = query_word[1:],
-                partial_result = partial_result + token,
-                num_errors = num_errors + error_increment,
-                max_errors = max_errors,
-                level = level + 1)
-            if destroy_token:
-                tokens_to_destroy.append(token)
-        #print('\t'*level, 'Tokens to destroy:', tokens_to_destroy)
-        for token in tokens_to_destroy:
-          del node.children[token]
-        return(not bool(node.children)) # return true if this node has no children, and thus should be destroyed
+    @classmethod
+    def load(cls, filename):
+      '''
+      A UMIHashTrie from a file made by save(), with the same UMIData, inserted in the same order
+      '''
+      (attributes, arrays, kind_version) = array_store.load(filename, 'UMIHashTrie')
+      umis = array_store.strings(arrays['umis'])
+      well_ids = array_store.strings(arrays['well_ids'])
+      amplicon_ids = array_store.strings(arrays['amplicon_ids'])
+      umi_datas = []
+      for umi in umis:
+        umi_data = UMIData.__new__(UMIData)
+        umi_data.umi = umi
+        umi_data.count = 0
+        umi_data.well_ids = {}
+        umi_datas.append(umi_data)
+      for umi_num, well_id_num, amplicon_id_num, count in zip(arrays['umi_nums'].tolist(), arrays['well_id_nums'].tolist(),
+        arrays['amplicon_id_nums'].tolist(), arrays['counts'].tolist()):
+        umi_data = umi_datas[umi_num]
+        umi_data.count += count
+        well_id_data = umi_data.well_ids.setdefault(well_ids[well_id_num], {'count': 0, 'amplicon_ids': {}})
+        well_id_data['count'] += count
+        well_id_data['amplicon_ids'][amplicon_ids[amplicon_id_num]] = count
+      umi_trie = cls()
+      for umi_data in umi_datas:
+        umi_trie.insert(umi_data.umi, umi_data)
+      return umi_trie
 
     def full_query_with_errors(self, word, max_errors, destructive = False):
         """Given a a query word, retrieve all entries that match the query from the trie,
         with max_errors allowed.
         if destructive is True, when a word is matched (even inexactly), it is removed from the trie.
+        Unlike HashTrie's, this always searches the trie, even with max_errors = 0, so entries
+        already removed by destructive queries are not matched again.
         """
-        
-        #print('word: ', word, '\n')
-        
-        query_token = word[0]
-        num_errors = 0
-        self.result = {}
-        level = 0
-        full_query_dfs = self._destructive_full_query_dfs_with_errors if destructive else self._full_query_dfs_with_errors
-        for token in self.root.children:
-            #print('Level: ', level, 'token: ', token, '\n')
-            if token != query_token:
-                error_increment = 1
-            else:
-                error_increment = 0
-            full_query_dfs(
-                node = self.root.children[token],
-                query_word = word[1:],
-                partial_result = token,
-                num_errors = num_errors + error_increment,
-                max_errors = max_errors,
-                level = level + 1)
-        return self.result
+        return ArrayTrie.full_query_with_errors(self, word, max_errors, destructive)
@@ -0,0 +1,157 @@
+import sys
+import numpy as np
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import packed_seq
+
+class UMISegmentIndex:
+  '''
+  Index of UMIs (all word_length bases) for finding those within a Hamming distance of a query, as an alternative
+  to searching a UMIHashTrie, whose full_query_with_errors results it gives, for the same words, though in the order
+  the words were inserted rather than trie order.
+  For a query with max_errors, the UMIs are split into max_errors + 1 segments: a UMI within max_errors of the query
+  can't differ from it in every segment, so it is equal to the query in at least one (the pigeonhole principle).
+  Each segment has a table of the UMIs sorted by their bases there, in which the query's segment is looked up, and
+  the candidates found are verified with their Hamming distances from the query, computed from their packed bases.
+  Bases are packed by packed_seq.pack_seqs, which takes any base other than ACGT to be an N: equal to another N,
+  and mismatching every other base, as in the trie.
+  The tables are built the first time they are needed for each max_errors, after all the UMIs have been inserted
+  (inserting more means rebuilding them). Destructive queries mark the UMIs they match as no longer alive; as in a
+  UMIHashTrie, they stay in entries. Once more than max_dead_fraction of the UMIs in the tables are dead, the tables
+  are rebuilt with only the live ones, so queries don't keep scanning UMIs that can no longer match
+  '''
+
+  max_dead_fraction = 0.25
+
+  def __init__(self, word_length):
+    if word_length > 32:
+      sys.exit(f'Only UMIs of up to 32 bases can be packed into a UMISegmentIndex, not {word_length}. Exiting.')
+    self.word_length = word_length
+    self.entries = {} # word: trie_object
+    self.word_nums = {} # word: its number, in the order words were inserted
+    self.words = []
+    self.alive = np.zeros(0, dtype = bool)
+    self.table_word_nums = None # numbers of the words in the tables, once built
+    self.packed_words = None # and their packed bases and non-ACGT masks
+    self.packed_others = None
+    self.num_table_dead = 0
+    self.segment_tables = {} # max_errors: list of (shift, mask, sorted segment keys, table positions)
+
+  def __str__(self):
+    return(f'UMISegmentIndex: {len(self.words)} UMIs of {self.word_length} bases, {int(self.alive.sum())} alive, segment tables for max_errors {sorted(self.segment_tables)}')
+
+  @classmethod
+  def from_entries(cls, entries):
+    '''
+    Index of a dict of UMI: trie_object, e.g. the entries of a UMIHashTrie, in the same order
+    '''
+    index = cls(len(next(iter(entries))) if entries else 0)
+    for word, trie_object in entries.items():
+      index.insert(word, trie_object)
+    return index
+
+  def insert(self, word, trie_object = None):
+    '''
+    Insert a UMI into the index. As with a HashTrie, inserting a word already in the index does nothing
+    '''
+    if trie_object == None:
+      trie_object = word # if nothing to store was passed, store the word itself
+    if word in self.entries:
+      return
+    if len(word) != self.word_length:
+      sys.exit(f'UMI {word} is not {self.word_length} bases. Exiting.')
+    self.entries[word] = trie_object
+    self.word_nums[word] = len(self.words)
+    self.words.append(word)
+    self.table_word_nums = None
+
+  def contains(self, word):
+    return word in self.entries
+
+  def full_query(self, word):
+    if word in self.entries:
+      return {word: {
+                'trie_object': self.entries[word],
+                'num_errors': 0
+                }
+              }
+    else:
+      return {}
+
+  def _build(self):
+    '''
+    Pack the live words, for the segment tables to be built from
+    '''
+    self.alive = np.concatenate([self.alive, np.ones(len(self.words) - len(self.alive), dtype = bool)])
+    self.table_word_nums = np.flatnonzero(self.alive)
+    (self.packed_words, self.packed_others) = packed_seq.pack_seqs([self.words[word_num] for word_num in self.table_word_nums.tolist()], self.word_length)
+    self.num_table_dead = 0
+    self.segment_tables = {}
+
+  def _segment_table(self, max_errors):
+    '''
+    (shift, mask, sorted segment keys, table positions) of each of the max_errors + 1 segments of the words. A segment key
+    holds the packed bases of the segment in its upper 32 bits and its non-ACGT mask in the lower, so segments
+    are limited to 16 bases, which leaves exact matches (max_errors 0) to word_nums
+    '''
+    if max_errors not in self.segment_tables:
+      num_segments = max_errors + 1
+      boundaries = [(segment_num*self.word_length)//num_segments for segment_num in range(num_segments + 1)]
+      segment_table = []
+      for start, end in zip(boundaries[:-1], boundaries[1:]):
+        shift = np.uint64(2*(self.word_length - end))
+        mask = np.uint64((1 << (2*(end - start))) - 1)
+        keys = _segment_keys(self.packed_words, self.packed_others, shift, mask)
+        positions = np.argsort(keys, kind = 'stable')
+        segment_table.append((shift, mask, keys[positions], positions))
+      self.segment_tables[max_errors] = segment_table
+    return self.segment_tables[max_errors]
+
+  def full_query_with_errors(self, word, max_errors, destructive = False):
+    '''
+    Given a query word, retrieve all the UMIs within max_errors of it, as a dict of word: {'trie_object', 'num_errors'},
+    in the order they were inserted. If destructive is True, the UMIs matched are removed from later queries
+    '''
+    self.result = {}
+    if (len(word) != self.word_length) or (max_errors < 0) or (len(self.words) == 0):
+      return self.result
+    if (self.table_word_nums is None) or (self.num_table_dead > self.max_dead_fraction*len(self.table_word_nums)):
+      self._build()
+    if max_errors == 0:
+      word_num = self.word_nums.get(word)
+      matches = np.array([] if (word_num == None) or not self.alive[word_num] else [word_num], dtype = np.int64)
+      dists = np.zeros(len(matches), dtype = np.int64)
+    else:
+      (packed_word, packed_other) = packed_seq.pack_seqs([word], self.word_length)
+      candidates = []
+      for shift, mask, sorted_keys, positions in self._segment_table(max_errors):
+        key = _segment_keys(packed_word, packed_other, shift, mask)
+        (start, end) = (np.searchsorted(sorted_keys, key, 'left')[0], np.searchsorted(sorted_keys, key, 'right')[0])
+        candidates.append(positions[start:end])
+      if sum([len(segment_candidates) for segment_candidates in candidates])*16 < len(self.table_word_nums):
+        candidates = np.unique(np.concatenate(candidates))
+      else:
+        # most words are candidates for a wide query, and marking them is quicker than sorting out the duplicates
+        is_candidate = np.zeros(len(self.table_word_nums), dtype = bool)
+        for segment_candidates in candidates:
+          is_candidate[segment_candidates] = True
+        candidates = np.flatnonzero(is_candidate)
+      candidates = candidates[self.alive[self.table_word_nums[candidates]]]
+      dists = packed_seq.hamming_distances(self.packed_words[candidates], self.packed_others[candidates], packed_word, packed_other, self.word_length).astype(np.int64)
+      matches = self.table_word_nums[candidates[dists <= max_errors]]
+      dists = dists[dists <= max_errors]
+    for word_num, dist in zip(matches.tolist(), dists.tolist()):
+      match_word = self.words[word_num]
+      self.result[match_word] = {
+        'trie_object': self.entries[match_word],
+        'num_errors': dist
+      }
+    if destructive:
+      self.alive[matches] = False
+      self.num_table_dead += len(matches)
+    return self.result
+
+def _segment_keys(packed_words, packed_others, shift, mask):
+  return (((packed_words >> shift) & mask) << np.uint64(32)) | ((packed_others >> shift) & mask)
@@ -0,0 +1,421 @@
+import sys
+import itertools
+import Levenshtein
+import numpy as np
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import packed_seq
+
+# bound on the number of base comparisons made at once by assign_all
+max_block_comparisons = 1 << 24
+# well_id_hash uses assign_all for Hamming distance with up to this many well_ids, and the window table above it. On
+# 100k umi_well_seqs, assign_all took 0.34s against 0.69s for the table with 4 well_ids, they crossed over between 64
+# and 96 (depending on the machine), and it took 3.5s against 1.0s with 384, as it compares every well_id at every position
+max_assign_all_well_ids = 64
+
+class WellIDAssigner:
+  '''
+  Assigns umi_well_seqs to the known well_id they contain, within max_dist mismatches (Hamming distance) at up
+  to max_well_id_offset positions either side of well_id_start. A table from every window string within max_dist
+  mismatches of a well_id to its (well_num, dist) entries is built once, so each window is a dict lookup, rather
+  than a seq_target_query for every well_id. Gives exactly the same assignments as calling seq_target_query for each
+  well_id in turn, and keeping the one with the best distance and position miss.
+  assign_all does the same for many umi_well_seqs at once, comparing them with every well_id at every position as arrays.
+  With dist_measure = Levenshtein.distance, well_ids are matched allowing for indels: windows of well_id_length - max_dist
+  to well_id_length + max_dist bases are compared by edit distance, and the difference between the length of the best
+  window and well_id_length is reported as its shift. Candidate well_ids for a window are found SymSpell style, from a
+  table of the strings made by deleting up to max_dist bases from each well_id, looked up with the same deletions
+  from the window, so only the candidates' edit distances are computed. Even so, allowing for indels costs far more
+  than Hamming distance, as every window length at every position has its deletions looked up: assigning 100k
+  umi_well_seqs with well_id_hash took 3.4s against 0.21s with 4 well_ids, 10.6s against 1.2s with 96, and 35s
+  against 1.4s with 384. Only umi_well_seqs without a perfect Hamming match at well_id_start take the edit distance path
+  '''
+
+  alphabet = 'ACGTN' # bases a window can have; any other character is a mismatch
+
+  def __init__(self, well_ids, well_id_start, max_well_id_offset = 4, max_dist = 2, dist_measure = Levenshtein.hamming):
+    self.well_ids = list(well_ids)
+    self.well_id_start = well_id_start
+    self.max_well_id_offset = max_well_id_offset
+    self.max_dist = max_dist
+    self.well_id_length = len(self.well_ids[0]) if self.well_ids else 0
+    if any(len(well_id) != self.well_id_length for well_id in self.well_ids):
+      sys.exit(f'All well_ids must be the same length to be assigned by a WellIDAssigner. Exiting.')
+    if dist_measure not in (Levenshtein.hamming, Levenshtein.distance):
+      sys.exit(f'dist_measure must be Levenshtein.hamming or Levenshtein.distance. Exiting.')
+    self.dist_measure = dist_measure
+    # window -> [(well_num, dist), ...], for every well_id within max_dist of the window, in well_id order
+    self.window_well_ids = {}
+    for well_num, well_id in enumerate(self.well_ids):
+      for dist in range(min(max_dist, self.well_id_length) + 1):
+        for positions in itertools.combinations(range(self.well_id_length), dist):
+          for bases in itertools.product(*[[base for base in self.alphabet if base != well_id[position]] for position in positions]):
+            window = list(well_id)
+            for position, base in zip(positions, bases):
+              window[position] = base
+            self.window_well_ids.setdefault(''.join(window), []).append((well_num, dist))
+    # deletion neighbourhoods: the string left by deleting up to max_dist bases from a well_id -> [well_num, ...]
+    self.deletion_well_nums = {}
+    if self.dist_measure == Levenshtein.distance:
+      for well_num, well_id in enumerate(self.well_ids):
+        for deletion in _deletions(well_id, max_dist):
+          deletion_well_nums = self.deletion_well_nums.setdefault(deletion, [])
+          if well_num not in deletion_well_nums:
+            deletion_well_nums.append(well_num)
+    self._positions = {} # by umi_well_seq length
+    self._deletion_arrays = None # deletion_well_nums as arrays, for assign_all
+
+  def positions(self, seq_length):
+    '''
+    The positions a well_id is looked for at in a umi_well_seq of seq_length, as for seq_target_query
+    '''
+    positions = self._positions.get(seq_length)
+    if positions == None:
+      if self.max_well_id_offset > 0:
+        positions = range(max(0, self.well_id_start - self.max_well_id_offset), min(seq_length - self.well_id_length, self.well_id_start + self.max_well_id_offset))
+      else:
+        positions = [self.well_id_start]
+      self._positions[seq_length] = positions
+    return positions
+
+  def windows(self, seq_length):
+    '''
+    The (position, length) of each window a well_id is compared with, in the order they are tried: each position, with
+    windows of well_id_length only for Hamming distance, and for edit distance from well_id_length out to
+    well_id_length - max_dist and well_id_length + max_dist, shorter first
+    '''
+    if self.dist_measure == Levenshtein.hamming:
+      window_lengths = [self.well_id_length]
+    else:
+      window_lengths = sorted(range(max(1, self.well_id_length - self.max_dist), self.well_id_length + self.max_dist + 1), key = lambda length : (abs(length - self.well_id_length), length))
+    return [(pos, window_length) for pos in self.positions(seq_length) for window_length in window_lengths if pos + window_length <= seq_length]
+
+  def edit_distance_well_ids(self, window):
+    '''
+    List of (well_num, dist) for every well_id within edit distance max_dist of window (which may be of any length).
+    Any such well_id has a deletion of up to max_dist bases in common with the window, so only those are checked
+    '''
+    well_nums = {}
+    for deletion in _deletions(window, self.max_dist):
+      well_nums.update(dict.fromkeys(self.deletion_well_nums.get(deletion, ())))
+    well_id_dists = [(well_num, Levenshtein.distance(self.well_ids[well_num], window)) for well_num in sorted(well_nums)]
+    return [(well_num, dist) for well_num, dist in well_id_dists if dist <= self.max_dist]
+
+  def assign(self, umi_well_seq):
+    '''
+    The (well_id, pos, dist) of the best well_id match in umi_well_seq, or None if there is none within max_dist.
+    A well_id's match is at the first of the positions where it has the least distance. Going through well_ids in order,
+    a match replaces the best so far if it has no greater distance and less position miss, or less distance and no
+    greater position miss, and a perfect match at well_id_start ends the search
+    '''
+    best_match = self.assign_with_shift(umi_well_seq)
+    return best_match[0:3] if best_match != None else None
+
+  def assign_with_shift(self, umi_well_seq):
+    '''
+    The (well_id, pos, dist, shift) of the best well_id match in umi_well_seq, as for assign, with the shift of the bases
+    after the well_id implied by the indels in the match (the window length less well_id_length; always 0 for Hamming distance)
+    '''
+    # the best (pos, dist, shift) of each well_id within max_dist somewhere in umi_well_seq
+    well_matches = {}
+    for pos, window_length in self.windows(len(umi_well_seq)):
+      window = umi_well_seq[pos:(pos + window_length)]
+      if self.dist_measure == Levenshtein.hamming:
+        window_well_ids = self.window_well_ids.get(window, ())
+      else:
+        window_well_ids = self.edit_distance_well_ids(window)
+      for well_num, dist in window_well_ids:
+        well_match = well_matches.get(well_num)
+        if (well_match == None) or (dist < well_match[1]):
+          well_matches[well_num] = (pos, dist, window_length - self.well_id_length)
+    best_match = None
+    best_pos_miss = self.well_id_length + 1
+    best_dist = self.well_id_length + 1
+    for well_num in sorted(well_matches):
+      (this_pos, this_dist, this_shift) = well_matches[well_num]
+      pos_miss = abs(this_pos - self.well_id_start)
+      if (this_dist <= best_dist and pos_miss < best_pos_miss) or (this_dist < best_dist and pos_miss <= best_pos_miss):
+        best_match = (self.well_ids[well_num], this_pos, this_dist, this_shift)
+        best_pos_miss = pos_miss
+        best_dist = this_dist
+        if best_dist == 0 and this_pos == self.well_id_start:
+          break # no need to try other well_ids if we've found a perfect match
+    return best_match
+
+  def assign_all(self, umi_well_seqs):
+    '''
+    Arrays of the well_num (an index into well_ids, or -1 if there is no match), pos, dist and shift that assign_with_shift
+    gives for each of umi_well_seqs (a list of str), computed together. umi_well_seqs are viewed as an (N, seq_length)
+    uint8 array, the windows at each position are packed 2 bits per base, and the Hamming distances of every window to
+    every well_id are found by broadcasting XORs and counting the mismatched bases, in blocks of umi_well_seqs bounded by
+    max_block_comparisons. The best match rule is then applied to all of the (umi_well_seq, well_id) pairs within
+    max_dist at once. For edit distance, only the umi_well_seqs without a perfect match at well_id_start are then
+    matched allowing for indels (see _edit_distance_matches). Only ACGT well_ids can be assigned this way
+    '''
+    well_nums = np.full(len(umi_well_seqs), -1, dtype = np.int64)
+    best_positions = np.full(len(umi_well_seqs), -1, dtype = np.int64)
+    best_dists = np.full(len(umi_well_seqs), self.well_id_length + 1, dtype = np.int64)
+    best_shifts = np.zeros(len(umi_well_seqs), dtype = np.int64)
+    if not self.well_ids:
+      return (well_nums, best_positions, best_dists, best_shifts)
+    if self.well_id_length > 32 or any(packed_seq.pack_seq(well_id) == None for well_id in self.well_ids):
+      sys.exit(f'Only well_ids of up to 32 ACGT bases can be assigned by assign_all. Exiting.')
+    if (self.dist_measure == Levenshtein.distance) and (3*(self.well_id_length + self.max_dist) > 64):
+      sys.exit(f'Only well_ids of up to {64//3 - self.max_dist} bases can be assigned allowing for indels by assign_all. Exiting.')
+    window_dtype = np.uint16 if self.well_id_length <= 8 else (np.uint32 if self.well_id_length <= 16 else np.uint64)
+    packed_well_ids = np.array([packed_seq.pack_seq(well_id) for well_id in self.well_ids], dtype = window_dtype)
+    # 2-bit codes of each byte, and other_bases, which is 1 for anything but ACGT, as that mismatches any well_id base
+    base_codes = np.zeros(256, dtype = window_dtype)
+    base_codes[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(4)
+    other_bases = np.ones(256, dtype = window_dtype)
+    other_bases[np.frombuffer(b'ACGT', dtype = np.uint8)] = 0
+    low_bits = window_dtype(int('01'*self.well_id_length, 2)) # the low bit of each packed base
+    seq_lengths = np.array([len(umi_well_seq) for umi_well_seq in umi_well_seqs], dtype = np.int64)
+    for seq_length in np.unique(seq_lengths).tolist(): # in practice, all umi_well_seqs are the same length
+      positions = np.array(self.positions(seq_length), dtype = np.int64)
+      if len(positions) == 0:
+        continue
+      seq_nums = np.flatnonzero(seq_lengths == seq_length)
+      block_size = max(1, max_block_comparisons // (len(self.well_ids)*len(positions)))
+      for block_start in range(0, len(seq_nums), block_size):
+        block_seq_nums = seq_nums[block_start:(block_start + block_size)]
+        seqs = np.frombuffer(''.join([umi_well_seqs[seq_num] for seq_num in block_seq_nums]).encode('ascii'), dtype = np.uint8).reshape(-1, seq_length)
+        # (position, seq) packed windows, and the bases in them that are not ACGT
+        windows = np.zeros((len(positions), len(block_seq_nums)), dtype = window_dtype)
+        window_others = np.zeros(windows.shape, dtype = window_dtype)
+        for base_num in range(self.well_id_length):
+          window_bases = seqs[:, positions + base_num].T
+          windows = (windows << 2) | base_codes[window_bases]
+          window_others = (window_others << 2) | other_bases[window_bases]
+        # (position, seq, well_id) Hamming distances: a base mismatches if either of its bits differ
+        differences = windows[:, :, np.newaxis] ^ packed_well_ids
+        differences |= differences >> 1
+        differences &= low_bits
+        differences |= window_others[:, :, np.newaxis]
+        dists = packed_seq.popcounts(differences)
+        # the first position of the least distance for each well_id
+        well_dists = dists[0]
+        position_nums = np.zeros(well_dists.shape, dtype = np.int64)
+        for position_num in range(1, len(positions)):
+          position_nums[dists[position_num] < well_dists] = position_num
+          well_dists = np.minimum(well_dists, dists[position_num])
+        (pair_seqs, pair_well_nums) = np.nonzero(well_dists <= self.max_dist) # in seq, then well_id, order
+        pair_positions = positions[position_nums[pair_seqs, pair_well_nums]]
+        pair_dists = well_dists[pair_seqs, pair_well_nums].astype(np.int64)
+        best_pairs = self._best_matches(len(block_seq_nums), pair_seqs, pair_well_nums, pair_positions, pair_dists)
+        matched = best_pairs >= 0
+        well_nums[block_seq_nums[matched]] = pair_well_nums[best_pairs[matched]]
+        best_positions[block_seq_nums[matched]] = pair_positions[best_pairs[matched]]
+        best_dists[block_seq_nums[matched]] = pair_dists[best_pairs[matched]]
+        if self.dist_measure == Levenshtein.distance:
+          # a perfect match at well_id_start is also the best match allowing for indels
+          unsettled = ~((best_dists[block_seq_nums] == 0) & (best_positions[block_seq_nums] == self.well_id_start))
+          unsettled_seq_nums = block_seq_nums[unsettled]
+          (well_nums[unsettled_seq_nums], best_positions[unsettled_seq_nums], best_dists[unsettled_seq_nums], best_shifts[unsettled_seq_nums]) = \
+            self._edit_distance_matches(seqs[unsettled])
+    return (well_nums, best_positions, best_dists, best_shifts)
+
+  def _edit_distance_matches(self, seqs):
+    '''
+    Arrays of the well_num (or -1), pos, dist and shift of the best match allowing for indels in each of seqs, an (N, seq_length)
+    uint8 array. The deletions of every window are packed 3 bits per base (with codes from 1, so the length is implicit)
+    and looked up in the sorted packed deletions of the well_ids, after a bitmap of them has ruled most out. The edit
+    distances of the (seq, window, well_id) candidates found are computed together, with the dynamic programming
+    recurrence over arrays of candidates
+    '''
+    (deletion_keys, deletion_offsets, deletion_well_nums, deletion_bitmap) = self._deletion_lookup()
+    seq_length = seqs.shape[1]
+    windows = self.windows(seq_length)
+    window_positions = np.array([pos for pos, window_length in windows], dtype = np.int64)
+    window_shifts = np.array([window_length - self.well_id_length for pos, window_length in windows], dtype = np.int64)
+    (kept_base_groups, deletion_window_offsets, deletion_window_nums) = _window_deletions(tuple(windows), self.max_dist)
+    num_deletions = len(deletion_window_offsets) - 1
+    well_nums = np.full(len(seqs), -1, dtype = np.int64)
+    best_positions = np.full(len(seqs), -1, dtype = np.int64)
+    best_dists = np.full(len(seqs), self.well_id_length + 1, dtype = np.int64)
+    best_shifts = np.zeros(len(seqs), dtype = np.int64)
+    block_size = max(1, (max_block_comparisons >> 2) // max(1, num_deletions))
+    for block_start in range(0, len(seqs), block_size):
+      codes = _edit_base_codes[seqs[block_start:(block_start + block_size)]]
+      # (seq, deletion) packed keys, for each distinct set of bases kept by deleting up to max_dist from any window
+      keys = []
+      for kept_bases in kept_base_groups:
+        group_keys = np.zeros((len(codes), len(kept_bases)), dtype = np.uint64)
+        for kept_num in range(kept_bases.shape[1]):
+          group_keys <<= np.uint64(3)
+          group_keys |= codes[:, kept_bases[:, kept_num]]
+        keys.append(group_keys)
+      keys = np.concatenate(keys, axis = 1)
+      (hit_seqs, hit_deletions) = np.nonzero(deletion_bitmap[keys % len(deletion_bitmap)])
+      hit_keys = keys[hit_seqs, hit_deletions]
+      lookups = np.minimum(np.searchsorted(deletion_keys, hit_keys), len(deletion_keys) - 1)
+      found = deletion_keys[lookups] == hit_keys
+      hit_seqs, hit_deletions, lookups = hit_seqs[found], hit_deletions[found], lookups[found]
+      # each hit is a candidate for each window with the deletion, and each well_id with the deletion
+      (hit_nums, candidate_windows) = _expand(deletion_window_offsets[hit_deletions], deletion_window_offsets[hit_deletions + 1], deletion_window_nums)
+      (candidate_nums, candidate_well_nums) = _expand(deletion_offsets[lookups[hit_nums]], deletion_offsets[lookups[hit_nums] + 1], deletion_well_nums)
+      candidates = np.unique((hit_seqs[hit_nums[candidate_nums]]*len(windows) + candidate_windows[candidate_nums])*len(self.well_ids) + candidate_well_nums)
+      candidate_well_nums = candidates % len(self.well_ids)
+      candidate_windows = (candidates // len(self.well_ids)) % len(windows)
+      candidate_seqs = candidates // (len(self.well_ids)*len(windows))
+      dists = self._edit_distances(codes, candidate_seqs, candidate_windows, candidate_well_nums, windows)
+      # the first window of the least distance for each (seq, well_id), in (seq, well_id) order
+      close = dists <= self.max_dist
+      candidate_seqs, candidate_windows, candidate_well_nums, dists = candidate_seqs[close], candidate_windows[close], candidate_well_nums[close], dists[close]
+      order = np.lexsort((candidate_windows, dists, candidate_well_nums, candidate_seqs))
+      candidate_seqs, candidate_windows, candidate_well_nums, dists = candidate_seqs[order], candidate_windows[order], candidate_well_nums[order], dists[order]
+      first = np.ones(len(candidate_seqs), dtype = bool)
+      first[1:] = (candidate_seqs[1:] != candidate_seqs[:-1]) | (candidate_well_nums[1:] != candidate_well_nums[:-1])
+      pair_seqs, pair_windows, pair_well_nums, pair_dists = candidate_seqs[first], candidate_windows[first], candidate_well_nums[first], dists[first]
+      best_pairs = self._best_matches(len(codes), pair_seqs, pair_well_nums, window_positions[pair_windows], pair_dists)
+      matched = best_pairs >= 0
+      block_matched = block_start + np.flatnonzero(matched)
+      well_nums[block_matched] = pair_well_nums[best_pairs[matched]]
+      best_positions[block_matched] = window_positions[pair_windows[best_pairs[matched]]]
+      best_dists[block_matched] = pair_dists[best_pairs[matched]]
+      best_shifts[block_matched] = window_shifts[pair_windows[best_pairs[matched]]]
+    return (well_nums, best_positions, best_dists, best_shifts)
+
+  def _deletion_lookup(self):
+    '''
+    deletion_well_nums as (sorted packed deletion keys, offsets, well_nums, bitmap), with the well_nums of keys[i] in
+    well_nums[offsets[i]:offsets[i + 1]], and bitmap[key % len(bitmap)] True for every key
+    '''
+    if self._deletion_arrays == None:
+      deletions = sorted((_pack_edit_bases(deletion), well_nums) for deletion, well_nums in self.deletion_well_nums.items())
+      deletion_keys = np.array([key for key, well_nums in deletions], dtype = np.uint64)
+      deletion_offsets = np.zeros(len(deletions) + 1, dtype = np.int64)
+      np.cumsum([len(well_nums) for key, well_nums in deletions], out = deletion_offsets[1:])
+      deletion_well_nums = np.array([well_num for key, well_nums in deletions for well_num in well_nums], dtype = np.int64)
+      deletion_bitmap = np.zeros(max(1 << 16, 1 << int(64*len(deletion_keys)).bit_length()) - 1, dtype = bool) # about 1/64 full, and odd, to spread the keys
+      deletion_bitmap[deletion_keys % len(deletion_bitmap)] = True
+      self._deletion_arrays = (deletion_keys, deletion_offsets, deletion_well_nums, deletion_bitmap)
+    return self._deletion_arrays
+
+  def _edit_distances(self, codes, candidate_seqs, candidate_windows, candidate_well_nums, windows):
+    '''
+    The edit distance between each candidate well_id and window, computed for all of them at once
+    '''
+    window_positions = np.array([pos for pos, window_length in windows], dtype = np.int64)
+    window_lengths = np.array([window_length for pos, window_length in windows], dtype = np.int64)
+    max_window_length = int(window_lengths.max())
+    # bases past the end of a window are never used, but must be in the seq
+    window_bases = np.arange(max_window_length)
+    window_codes = codes[candidate_seqs[:, np.newaxis], np.minimum(window_positions[candidate_windows][:, np.newaxis] + window_bases, codes.shape[1] - 1)]
+    well_id_codes = _edit_base_codes[np.frombuffer(''.join(self.well_ids).encode('ascii'), dtype = np.uint8).reshape(len(self.well_ids), -1)][candidate_well_nums]
+    candidate_window_lengths = window_lengths[candidate_windows]
+    # dists[:, i] is the distance between the first i bases of the well_id and the window so far
+    dists = np.tile(np.arange(self.well_id_length + 1, dtype = np.int16), (len(candidate_seqs), 1))
+    edit_distances = np.zeros(len(candidate_seqs), dtype = np.int64)
+    for window_base in range(max_window_length):
+      next_dists = np.empty(dists.shape, dtype = np.int16)
+      next_dists[:, 0] = window_base + 1
+      for well_id_base in range(1, self.well_id_length + 1):
+        next_dists[:, well_id_base] = np.minimum(np.minimum(dists[:, well_id_base], next_dists[:, well_id_base - 1]) + 1,
+          dists[:, well_id_base - 1] + (well_id_codes[:, well_id_base - 1] != window_codes[:, window_base]))
+      dists = next_dists
+      ended = candidate_window_lengths == window_base + 1
+      edit_distances[ended] = dists[ended, self.well_id_length]
+    return edit_distances
+
+  def _best_matches(self, num_seqs, pair_seqs, pair_well_nums, pair_positions, pair_dists):
+    '''
+    The best match rule of assign, applied to arrays of (seq, well_id) pairs, in seq then well_id order, with each well_id's
+    best position and distance. Returns the index of the pair each seq is matched with, or -1. The rule is applied to the
+    first pair of each seq, then the second, and so on, as only pairs within max_dist are given, and there are seldom
+    more than a few
+    '''
+    best_pairs = np.full(num_seqs, -1, dtype = np.int64)
+    best_pos_misses = np.full(num_seqs, self.well_id_length + 1, dtype = np.int64)
+    best_dists = np.full(num_seqs, self.well_id_length + 1, dtype = np.int64)
+    searching = np.ones(num_seqs, dtype = bool) # False once a perfect match has been found
+    pair_ranks = np.arange(len(pair_seqs)) - np.searchsorted(pair_seqs, pair_seqs)
+    for rank in range(pair_ranks.max(initial = -1) + 1):
+      pairs = np.flatnonzero(pair_ranks == rank)
+      seq_nums = pair_seqs[pairs]
+      this_positions = pair_positions[pairs]
+      this_dists = pair_dists[pairs]
+      pos_misses = np.abs(this_positions - self.well_id_start)
+      better = searching[seq_nums] & (((this_dists <= best_dists[seq_nums]) & (pos_misses < best_pos_misses[seq_nums])) | \
+        ((this_dists < best_dists[seq_nums]) & (pos_misses <= best_pos_misses[seq_nums])))
+      seq_nums = seq_nums[better]
+      best_pairs[seq_nums] = pairs[better]
+      best_pos_misses[seq_nums] = pos_misses[better]
+      best_dists[seq_nums] = this_dists[better]
+      searching[seq_nums[(this_dists[better] == 0) & (this_positions[better] == self.well_id_start)]] = False
+    return best_pairs
+
+  def well_id_hash(self, umi_well_seqs, include_shifts = False):
+    '''
+    Hash of the (well_id, pos, dist) assigned to each of umi_well_seqs with a well_id match. If include_shifts, the entries
+    are (well_id, pos, dist, shift). The assignments are the same either way, but are made by whichever is quicker: for
+    Hamming distance with more than max_assign_all_well_ids well_ids (e.g. a 384 well plate), assign_with_shift for each
+    umi_well_seq, looking its windows up in the table; otherwise, assign_all for them all together, which is also always
+    far quicker for edit distance than looking up deletions one window at a time
+    '''
+    if (self.dist_measure == Levenshtein.hamming) and (len(self.well_ids) > max_assign_all_well_ids):
+      well_id_hash = {}
+      for umi_well_seq in umi_well_seqs:
+        best_match = self.assign_with_shift(umi_well_seq)
+        if best_match != None:
+          well_id_hash[umi_well_seq] = best_match if include_shifts else best_match[0:3]
+      return well_id_hash
+    umi_well_seqs = list(umi_well_seqs)
+    (well_nums, positions, dists, shifts) = self.assign_all(umi_well_seqs)
+    matched = np.flatnonzero(well_nums >= 0)
+    well_id_matches = zip(matched.tolist(), well_nums[matched].tolist(), positions[matched].tolist(), dists[matched].tolist(), shifts[matched].tolist())
+    if include_shifts:
+      return {umi_well_seqs[seq_num]: (self.well_ids[well_num], position, dist, shift) for seq_num, well_num, position, dist, shift in well_id_matches}
+    return {umi_well_seqs[seq_num]: (self.well_ids[well_num], position, dist) for seq_num, well_num, position, dist, shift in well_id_matches}
+
+# codes of each byte for packing deletions, 3 bits per base, from 1 so that the number of bases is implicit in the packed int
+_edit_base_codes = np.full(256, 5, dtype = np.uint64)
+_edit_base_codes[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(1, 5, dtype = np.uint64)
+
+def _pack_edit_bases(seq):
+  return int(((_edit_base_codes[np.frombuffer(seq.encode('ascii'), dtype = np.uint8)]) << (3*np.arange(len(seq) - 1, -1, -1, dtype = np.uint64))).sum(dtype = np.uint64))
+
+def _deletions(seq, max_deletions):
+  '''
+  The distinct strs made by deleting up to max_deletions characters from seq (including seq itself)
+  '''
+  deletions = {seq: None}
+  for num_deletions in range(1, min(max_deletions, len(seq) - 1) + 1):
+    for deleted in itertools.combinations(range(len(seq)), num_deletions):
+      deletions[''.join(base for position, base in enumerate(seq) if position not in deleted)] = None
+  return list(deletions)
+
+_window_deletion_arrays = {}
+
+def _window_deletions(windows, max_deletions):
+  '''
+  The distinct sets of seq positions kept by deleting up to max_deletions bases from any of windows ((pos, length) tuples),
+  as a list of (num_sets, num_kept) arrays, one for each num_kept, and CSR (offsets, window_nums) arrays of the windows
+  each set (numbered through the arrays in turn) is a deletion of
+  '''
+  window_deletions = _window_deletion_arrays.get((windows, max_deletions))
+  if window_deletions == None:
+    kept_base_windows = {}
+    for window_num, (pos, window_length) in enumerate(windows):
+      for num_deletions in range(min(max_deletions, window_length - 1) + 1):
+        for kept_bases in itertools.combinations(range(pos, pos + window_length), window_length - num_deletions):
+          kept_base_windows.setdefault(kept_bases, []).append(window_num)
+    kept_base_sets = sorted(kept_base_windows, key = len)
+    kept_base_groups = [np.array([kept_bases for kept_bases in kept_base_sets if len(kept_bases) == num_kept], dtype = np.int64) \
+      for num_kept in sorted(set(map(len, kept_base_sets)))]
+    window_offsets = np.zeros(len(kept_base_sets) + 1, dtype = np.int64)
+    np.cumsum([len(kept_base_windows[kept_bases]) for kept_bases in kept_base_sets], out = window_offsets[1:])
+    window_nums = np.array([window_num for kept_bases in kept_base_sets for window_num in kept_base_windows[kept_bases]], dtype = np.int64)
+    window_deletions = (kept_base_groups, window_offsets, window_nums)
+    _window_deletion_arrays[(windows, max_deletions)] = window_deletions
+  return window_deletions
+
+def _expand(starts, ends, values):
+  '''
+  For CSR slices values[starts[i]:ends[i]], arrays of the slice number i and the value, for every value in every slice
+  '''
+  lengths = ends - starts
+  slice_nums = np.repeat(np.arange(len(starts)), lengths)
+  return (slice_nums, values[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())])
@@ -0,0 +1,137 @@
+'''
+Versioned binary file format for the indexes and hashes the scripts cache between runs, in place of pickle.
+A file is a fixed-size prefix (magic, format version, header length and data offset), a JSON header giving the
+kind of object stored, its own version and attributes, and the dtype, shape and offset of each array, then the
+arrays themselves, each aligned to array_alignment bytes. Arrays are read back with np.memmap, so opening a file is
+almost instant, and pages are only read from disk as they are used. Strings are stored as fixed-width bytes arrays
+(see string_array), so they can be mapped the same way
+'''
+
+import json
+import os
+import struct
+import sys
+import numpy as np
+
+magic = b'RNAXBCAS' # RNAseq-extract-bar-codes array store
+format_version = 1
+array_alignment = 64
+_prefix = struct.Struct('<8sIIQ') # magic, format_version, header length, offset of the first array
+
+def save(filename, kind, arrays, attributes = {}, kind_version = 1):
+  '''
+  Save a dict of arrays (name: np.ndarray) and a dict of JSON-serialisable attributes as an object of the given kind.
+  The file is written under a temporary name and then renamed, so an interrupted save never leaves a partial file
+  '''
+  array_layouts = {}
+  offset = 0
+  for array_name, array in arrays.items():
+    array = np.asarray(array)
+    if array.dtype.hasobject:
+      sys.exit(f'Cannot save object array {array_name} to {filename}. Exiting.')
+    array_layouts[array_name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+    offset += -(-array.nbytes//array_alignment)*array_alignment
+  header = json.dumps({'kind': kind, 'kind_version': kind_version, 'attributes': attributes, 'arrays': array_layouts}).encode('utf-8')
+  data_offset = -(-(_prefix.size + len(header))//array_alignment)*array_alignment
+  temporary_filename = filename + '.tmp'
+  with open(temporary_filename, 'wb') as array_store_file:
+    array_store_file.write(_prefix.pack(magic, format_version, len(header), data_offset))
+    array_store_file.write(header)
+    for array_name, array in arrays.items():
+      array_store_file.seek(data_offset + array_layouts[array_name]['offset'])
+      array_store_file.write(np.ascontiguousarray(array).tobytes())
+    array_store_file.truncate(data_offset + offset)
+  os.replace(temporary_filename, filename)
+
+def load(filename, kind = None):
+  '''
+  (attributes, arrays, kind_version) of the object saved in filename, with each array a read-only np.memmap of the file.
+  Exits if the file is not an array store, is a later format version than this one, or not of the given kind
+  '''
+  (attributes, array_layouts, data_offset, saved_kind, kind_version) = _read_header(filename)
+  if (kind != None) and (saved_kind != kind):
+    sys.exit(f'{filename} holds a {saved_kind}, not a {kind}. Exiting.')
+  arrays = {}
+  for array_name, array_layout in array_layouts.items():
+    shape = tuple(array_layout['shape'])
+    dtype = np.dtype(array_layout['dtype'])
+    if int(np.prod(shape))*dtype.itemsize == 0:
+      arrays[array_name] = np.zeros(shape, dtype = dtype) # an empty region can't be mapped
+    else:
+      arrays[array_name] = np.memmap(filename, dtype = dtype, mode = 'r', offset = data_offset + array_layout['offset'], shape = shape)
+  return (attributes, arrays, kind_version)
+
+def is_array_store(filename):
+  '''
+  True if filename exists and starts with an array store's magic
+  '''
+  if not os.path.exists(filename):
+    return False
+  with open(filename, 'rb') as array_store_file:
+    return array_store_file.read(len(magic)) == magic
+
+def _read_header(filename):
+  with open(filename, 'rb') as array_store_file:
+    prefix = array_store_file.read(_prefix.size)
+    if (len(prefix) < _prefix.size) or (prefix[0:len(magic)] != magic):
+      sys.exit(f'{filename} is not an array store file. Exiting.')
+    (_, file_format_version, header_length, data_offset) = _prefix.unpack(prefix)
+    if file_format_version > format_version:
+      sys.exit(f'{filename} is array store format version {file_format_version}, but only versions up to {format_version} can be read. Exiting.')
+    header = json.loads(array_store_file.read(header_length).decode('utf-8'))
+  return (header['attributes'], header['arrays'], data_offset, header['kind'], header['kind_version'])
+
+def string_array(strings):
+  '''
+  Fixed-width bytes array of an iterable of ASCII strs (shorter ones are padded with NULs, which strings() drops)
+  '''
+  encoded_strings = [string.encode('ascii') for string in strings]
+  return np.array(encoded_strings, dtype = f'S{max([1] + [len(encoded_string) for encoded_string in encoded_strings])}')
+
+def strings(array):
+  '''
+  List of the strs in a bytes array made by string_array
+  '''
+  return [encoded_string.decode('ascii') for encoded_string in array.tolist()]
+
+def save_seq_hash(filename, kind, seq_hash, attributes = {}):
+  '''
+  Save a dict of str keys (e.g. umi_well_seqs) to values that are all strs, or all tuples of the same number of str or
+  int fields, such as a well_id hash. Each str field is stored as a table of its distinct values, and an index into it
+  '''
+  values = list(seq_hash.values())
+  tuple_values = (len(values) > 0) and isinstance(values[0], tuple)
+  columns = list(zip(*values)) if tuple_values else ([values] if len(values) > 0 else [])
+  arrays = {'seqs': string_array(seq_hash)}
+  column_types = []
+  for column_num, column in enumerate(columns):
+    if all(isinstance(value, str) for value in column):
+      column_strings = list(dict.fromkeys(column))
+      string_nums = {string: string_num for string_num, string in enumerate(column_strings)}
+      arrays[f'column_{column_num}_strings'] = string_array(column_strings)
+      arrays[f'column_{column_num}'] = np.fromiter((string_nums[value] for value in column), dtype = np.int32, count = len(column))
+      column_types.append('str')
+    elif all(isinstance(value, (int, np.integer)) for value in column):
+      arrays[f'column_{column_num}'] = np.array(column, dtype = np.int64)
+      column_types.append('int')
+    else:
+      sys.exit(f'Field {column_num} of the values to save to {filename} must be all strs or all ints. Exiting.')
+  save(filename, kind, arrays, dict(attributes, tuple_values = tuple_values, column_types = column_types))
+
+def load_seq_hash(filename, kind = None):
+  '''
+  (seq_hash, attributes) as saved by save_seq_hash
+  '''
+  (attributes, arrays, kind_version) = load(filename, kind)
+  columns = []
+  for column_num, column_type in enumerate(attributes['column_types']):
+    if column_type == 'str':
+      column_strings = strings(arrays[f'column_{column_num}_strings'])
+      columns.append([column_strings[string_num] for string_num in arrays[f'column_{column_num}'].tolist()])
+    else:
+      columns.append(arrays[f'column_{column_num}'].tolist())
+  seqs = strings(arrays['seqs'])
+  if len(columns) == 0:
+    return ({}, attributes)
+  values = zip(*columns) if attributes['tuple_values'] else columns[0]
+  return (dict(zip(seqs, values)), attributes)
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import random
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import squtils as sq
+import fastq_reader
+from FastqReadData import FastqReadData
+from ReadNgramHash import ReadNgramHash
+
+# Compares the ReadNgramHash index_schemes: posting entries per umi_well_seq, build and query time, and the recall
+# of umi_well_seq_query for queries made by substituting 1 to 3 bases of a stored umi_well_seq, at the
+# min_similarity_fraction extract-bar-codes-ngrams.py uses by default, which each scheme scales to tolerate the same
+# number of substitutions
+
+if (len(sys.argv) < 2) or (len(sys.argv) > 4):
+  sys.exit('A command line argument specifying the fastq.gz file to read umi_well_seqs from is required, followed by an optional number of queries, and an optional min_similarity_fraction. Exiting.')
+fastq_filename = sys.argv[1]
+num_queries = int(sys.argv[2]) if len(sys.argv) >= 3 else 1000
+min_similarity_fraction = float(sys.argv[3]) if len(sys.argv) == 4 else 0.7
+max_mismatches = 3
+max_umi_well_seqs = 100000
+
+sq.log(f'Reading umi_well_seqs from {fastq_filename}...')
+umi_well_seqs = {}
+for read_id_lines, sequences in fastq_reader.read_fastq_batches(fastq_filename):
+  for sequence in sequences:
+    umi_well_seq = sequence[0:FastqReadData.seq_length]
+    if b'N' not in umi_well_seq:
+      umi_well_seqs[umi_well_seq.decode('ascii')] = None
+  if len(umi_well_seqs) >= max_umi_well_seqs:
+    break
+umi_well_seqs = list(umi_well_seqs)[0:max_umi_well_seqs]
+print(f'{len(umi_well_seqs)} distinct umi_well_seqs')
+
+# queries: stored umi_well_seqs with num_mismatches random substitutions
+random.seed(1)
+queries = []
+for num_mismatches in range(1, max_mismatches + 1):
+  for source_umi_well_seq in random.sample(umi_well_seqs, min(num_queries, len(umi_well_seqs))):
+    query = list(source_umi_well_seq)
+    for position in random.sample(range(len(query)), num_mismatches):
+      query[position] = random.choice([base for base in 'ACGT' if base != query[position]])
+    queries.append((num_mismatches, source_umi_well_seq, ''.join(query)))
+
+print(f'scheme\tposting entries per umi_well_seq\tbuild time (s)\tquery time (ms)\tmean matches\t' + \
+  '\t'.join(f'recall {num_mismatches} mismatches' for num_mismatches in range(1, max_mismatches + 1)))
+for index_scheme in ReadNgramHash.index_schemes:
+  start_time = time.perf_counter()
+  read_ngram_hash = ReadNgramHash(FastqReadData.seq_length, index_scheme = index_scheme)
+  for umi_well_seq in umi_well_seqs:
+    read_ngram_hash.insert_umi_well_seq(umi_well_seq)
+  build_time = time.perf_counter() - start_time
+  num_postings = sum(len(ngram_entries) for ngram_entries in read_ngram_hash.ngram_hash.values())
+  num_found = [0]*(max_mismatches + 1)
+  num_matches = 0
+  start_time = time.perf_counter()
+  for num_mismatches, source_umi_well_seq, query in queries:
+    matches = read_ngram_hash.umi_well_seq_query(query, min_similarity_fraction)
+    num_matches += len(matches)
+    num_found[num_mismatches] += any(match_umi_well_seq == source_umi_well_seq for match_umi_well_seq, similarity in matches)
+  query_time = time.perf_counter() - start_time
+  num_queries_each = len(queries)//max_mismatches
+  print(f'{index_scheme}\t{num_postings/len(umi_well_seqs):.1f}\t{build_time:.2f}\t{1000*query_time/len(queries):.3f}\t{num_matches/len(queries):.1f}\t' + \
+    '\t'.join(f'{num_found[num_mismatches]/num_queries_each:.3f}' for num_mismatches in range(1, max_mismatches + 1)))
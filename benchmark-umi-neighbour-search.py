@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import pickle
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import squtils as sq
+import array_store
+from UMIHashTrie import UMIHashTrie
+from UMISegmentIndex import UMISegmentIndex
+
+# Compares UMIHashTrie.full_query_with_errors with UMISegmentIndex's for max_errors 1 to 8: the time per query,
+# the mean number of matches, and whether both find the same UMIs at the same distances for every query.
+# Queries are the most common UMIs, as count-nearest-neighbours-in-umi-trie.py makes them
+
+if (len(sys.argv) < 2) or (len(sys.argv) > 3):
+  sys.exit('A command line argument specifying the umi-trie .arrays (or .pkl) file to query is required, followed by an optional number of queries. Exiting.')
+umi_trie_filename = sys.argv[1]
+num_queries = int(sys.argv[2]) if len(sys.argv) == 3 else 200
+max_max_errors = 8
+
+sq.log(f'Reading UMIHashTrie from {umi_trie_filename}...')
+if array_store.is_array_store(umi_trie_filename):
+  umi_trie = UMIHashTrie.load(umi_trie_filename)
+else: # pickled by an earlier extract-bar-codes-UMITrie.py
+  umi_trie_file = open(umi_trie_filename, 'rb')
+  umi_trie = pickle.load(umi_trie_file)
+  umi_trie_file.close()
+queries = [umi for umi, umi_data in sorted(umi_trie.entries.items(), key = lambda entry : entry[1].count, reverse = True)[0:num_queries]]
+print(f'{len(umi_trie.entries)} UMIs, {len(queries)} queries')
+
+start_time = time.perf_counter()
+umi_segment_index = UMISegmentIndex.from_entries(umi_trie.entries)
+for max_errors in range(1, max_max_errors + 1):
+  umi_segment_index.full_query_with_errors(queries[0], max_errors) # builds the segment tables for max_errors
+print(f'UMISegmentIndex built in {time.perf_counter() - start_time:.2f}s')
+
+print('max_errors\ttrie query time (ms)\tsegment index query time (ms)\tspeed-up\tmean matches\tsame matches')
+for max_errors in range(1, max_max_errors + 1):
+  start_time = time.perf_counter()
+  trie_results = [umi_trie.full_query_with_errors(query, max_errors) for query in queries]
+  trie_time = time.perf_counter() - start_time
+  start_time = time.perf_counter()
+  index_results = [umi_segment_index.full_query_with_errors(query, max_errors) for query in queries]
+  index_time = time.perf_counter() - start_time
+  same_matches = all({umi: match['num_errors'] for umi, match in trie_result.items()} == {umi: match['num_errors'] for umi, match in index_result.items()} \
+    for trie_result, index_result in zip(trie_results, index_results))
+  num_matches = sum(len(trie_result) for trie_result in trie_results)
+  print(f'{max_errors}\t{1000*trie_time/len(queries):.3f}\t{1000*index_time/len(queries):.3f}\t{trie_time/index_time:.1f}\t{num_matches/len(queries):.1f}\t{same_matches}')
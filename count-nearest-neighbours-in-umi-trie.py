@@ -7,18 +7,23 @@ import collections
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
+import array_store
 from UMIHashTrie import UMIHashTrie
+from UMISegmentIndex import UMISegmentIndex
 from UMIData import UMIData
 
 if len(sys.argv) != 2:
-    sys.exit('A single command line argument specifying the umi-trie .pkl file to process is required. Exiting.')
+    sys.exit('A single command line argument specifying the umi-trie .arrays (or .pkl) file to process is required. Exiting.')
 # first and only command line argument is the fastq.gz file to process
 umi_trie_filename = sys.argv[1]
 
 # load UMIHashTrie from file
-umi_trie_file = open(umi_trie_filename, 'rb')
-umi_trie = pickle.load(umi_trie_file)
-umi_trie_file.close()
+if array_store.is_array_store(umi_trie_filename):
+  umi_trie = UMIHashTrie.load(umi_trie_filename)
+else: # pickled by an earlier extract-bar-codes-UMITrie.py
+  umi_trie_file = open(umi_trie_filename, 'rb')
+  umi_trie = pickle.load(umi_trie_file)
+  umi_trie_file.close()
 
 # get UMIs in descending order of count
 sorted_umis = sorted(umi_trie.entries.items(), key = lambda x : x[1].count, reverse = True)
@@ -80,11 +85,15 @@ num_neighbours_file = open(num_neighbours_filename, 'w')
 # print header
 num_neighbours_file.write('UMI,count,' + ','.join(dist_headers) + '\n')
 
+# wide destructive queries are much quicker in a UMISegmentIndex of the UMIs, which finds the same neighbours as the trie
+use_segment_index = True
+umi_index = UMISegmentIndex.from_entries(umi_trie.entries) if use_segment_index else umi_trie
+
 # compute distances one distance slice at a time, since is destructive (i.e. an n+1_neighbour of a centre could be the n_neighbour of another)
 distance_cols = []
 for dist in range(1, max_neighbours + 1):
   print(f'Finding %d-neighbours, and destroying...' % dist)
-  matches_col = [umi_trie.full_query_with_errors(sorted_umis[row][0], dist, destructive = True) for row in range(max_row)]
+  matches_col = [umi_index.full_query_with_errors(sorted_umis[row][0], dist, destructive = True) for row in range(max_row)]
   distances_col = [[x['num_errors'] for x in matches.values() if x['num_errors'] != 0] for matches in matches_col]
   dist_counts_col = [str(len(matches)) for matches in distances_col] # no need to count separately as destruction means there can't be any closer than dist
   distance_cols.append(dist_counts_col)
@@ -5,29 +5,34 @@ import os # for os.path.join(...), for examnple
 import time
 import pickle
 import collections
-import numpy as np
-from scipy.spatial.distance import pdist, squareform
 import Levenshtein # By far the fastest library tried for this - including for Hamming distance. Trued textdistance, scipy.spatial.distance.hamming
 
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
+import array_store
+import distance_matrices
+import parallel_ingest
 from UMIHashTrie import UMIHashTrie
 from UMIData import UMIData
 
 if len(sys.argv) != 2:
-    sys.exit('A single command line argument specifying the umi-trie .pkl file to process is required. Exiting.')
+    sys.exit('A single command line argument specifying the umi-trie .arrays (or .pkl) file to process is required. Exiting.')
 # first and only command line argument is the fastq.gz file to process
 umi_trie_filename = sys.argv[1]
+num_workers = parallel_ingest.default_num_workers # processes computing tiles of the distance matrices
 
 def log(s):
   print(time.asctime() + ":", s)
   
 # load UMIHashTrie from file
 log('Loading UMIHashTrie from ' + umi_trie_filename)
-umi_trie_file = open(umi_trie_filename, 'rb')
-umi_trie = pickle.load(umi_trie_file)
-umi_trie_file.close()
+if array_store.is_array_store(umi_trie_filename):
+  umi_trie = UMIHashTrie.load(umi_trie_filename)
+else: # pickled by an earlier extract-bar-codes-UMITrie.py
+  umi_trie_file = open(umi_trie_filename, 'rb')
+  umi_trie = pickle.load(umi_trie_file)
+  umi_trie_file.close()
 
 # get UMIs in descending order of count
 log('Sorting UMIs')
@@ -38,31 +43,26 @@ umi_counts = [(x[0], x[1].count) for x in sorted_umis]
 
 # find the last row with at least min_count UMI
 min_count = 100 # from eyeballing a plot, at present
-max_row_limit = 40000
 if umi_counts[-1][1] < min_count:
   max_row = [n for n, x in enumerate( [x[1] for x in umi_counts] ) if x < min_count][0]
 else:
   max_row = len(sorted_umis)
-if max_row > max_row_limit:
-  max_row = max_row_limit # process was killed after ~ 3hrs because too big on MacBookPro with max_row = 105947.
-  # 20000: 24 mins for Hamming, 11 for Levenshtein
-  # 30000: 24 mins for Hamming, 27 for Levenshtein
-  # 40000: 22 mins for Hamming, 51 for Levenshtein
-  # 50000: x mins for Hamming, x for Levenshtein - failed
+# max_row was limited to 40000 when the matrices were computed with pdist and squareform in memory: the process was
+# killed after ~ 3hrs because too big on MacBookPro with max_row = 105947.
+# 20000: 24 mins for Hamming, 11 for Levenshtein
+# 30000: 24 mins for Hamming, 27 for Levenshtein
+# 40000: 22 mins for Hamming, 51 for Levenshtein
+# 50000: x mins for Hamming, x for Levenshtein - failed
+# distance_matrices now writes them a tile at a time into the .npy files, so there is no limit
 
 # max_row = 4 # test
 umis = [umi for (umi, count) in umi_counts if not 'N' in umi]
 
 umi_trie = None # make memory available to GC
-# compute distance matrices for UMIs, and save them to .npy files
-umis_array = np.array(umis).reshape(-1, 1)[1:max_row, ] # we need a 2D array for pdist
+# compute distance matrices for UMIs, and save them to .npy files, as uint8
+umis = umis[1:max_row]
 log(f'Computing UMI Hamming distance matrix for %d UMIs' % max_row)
-umi_hamming_distance_matrix = pdist(umis_array, lambda umi1, umi2 : Levenshtein.hamming(umi1[0], umi2[0])) # need to wrap the distance function
-np.save(umi_trie_filename + '_hamming.npy', squareform(umi_hamming_distance_matrix))
-umi_hamming_distance_matrix = None # make memory available to GC
+distance_matrices.save_distance_matrix(umi_trie_filename + '_hamming.npy', umis, Levenshtein.hamming, num_workers)
 log(f'Computing UMI Levenshtein distance matrix for %d UMIs' % max_row)
-umi_levenshtein_distance_matrix = pdist(umis_array, lambda umi1, umi2 : Levenshtein.distance(umi1[0], umi2[0])) # need to wrap the distance function
-np.save(umi_trie_filename + '_levenshtein.npy', squareform(umi_levenshtein_distance_matrix))
-umi_levenshtein_distance_matrix = None # make memory available to GC
-umis_array = None
-
+distance_matrices.save_distance_matrix(umi_trie_filename + '_levenshtein.npy', umis, Levenshtein.distance, num_workers)
+log('Done')
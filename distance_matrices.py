@@ -0,0 +1,86 @@
+import multiprocessing
+import sys
+import numpy as np
+import Levenshtein
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import packed_seq
+import parallel_ingest
+
+# rows and columns of the tiles of the matrix that each worker computes and writes at a time: a 4096 x 4096 tile is
+# 16MB of uint8 distances (computed in packed_seq's smaller tiles, or a row at a time for Levenshtein distances), so
+# memory use depends on the tile length and number of workers, not the number of seqs
+tile_length = 4096
+
+_worker_matrix = None # the memory-mapped matrix file each worker process writes its tiles into
+_worker_seqs = None
+_worker_packed_seqs = None
+_worker_dist_measure = None
+
+def save_distance_matrix(npy_filename, seqs, dist_measure = Levenshtein.hamming, num_workers = parallel_ingest.default_num_workers):
+  '''
+  Save the square matrix of the distances between each of seqs, with dist_measure (Levenshtein.hamming, for seqs all
+  the same length, or Levenshtein.distance), as a uint8 .npy file. The file is created with
+  np.lib.format.open_memmap, and the tiles on and above the diagonal are computed by a pool of num_workers
+  processes, each writing its tiles (and their transposes below the diagonal) straight into the file, so the
+  matrix is never held in memory. Hamming distances are computed by packed_seq's vectorised functions; Levenshtein
+  distances a pair at a time
+  '''
+  if dist_measure not in (Levenshtein.hamming, Levenshtein.distance):
+    sys.exit(f'dist_measure must be Levenshtein.hamming or Levenshtein.distance. Exiting.')
+  if max([len(seq) for seq in seqs], default = 0) > np.iinfo(np.uint8).max:
+    sys.exit(f'Only seqs of up to {np.iinfo(np.uint8).max} bases have distances that fit in a uint8 matrix. Exiting.')
+  matrix = np.lib.format.open_memmap(npy_filename, mode = 'w+', dtype = np.uint8, shape = (len(seqs), len(seqs)))
+  matrix.flush()
+  matrix = None # each worker maps the file itself
+  tiles = [(row_start, col_start) for row_start in range(0, len(seqs), tile_length) for col_start in range(row_start, len(seqs), tile_length)]
+  # packed once here, and shared with the workers by fork
+  packed_seqs = packed_seq.pack_seqs(seqs, len(seqs[0])) if (dist_measure == Levenshtein.hamming) and (len(seqs) > 0) else None
+  worker_args = (npy_filename, seqs, packed_seqs, dist_measure)
+  if (num_workers <= 1) or (len(tiles) <= 1):
+    _attach_worker(*worker_args)
+    for tile in tiles:
+      _write_tile(tile)
+    _detach_worker()
+    return
+  # fork, as for parallel_ingest.map_shards, which also means seqs and packed_seqs are not pickled to be passed to the workers
+  with multiprocessing.get_context('fork').Pool(min(num_workers, len(tiles)), initializer = _attach_worker, initargs = worker_args) as pool:
+    for tile in pool.imap_unordered(_write_tile, tiles):
+      pass
+  # the workers' changes to the file are written back by the OS, even though they aren't flushed when they exit
+
+def _attach_worker(npy_filename, seqs, packed_seqs, dist_measure):
+  global _worker_matrix, _worker_seqs, _worker_packed_seqs, _worker_dist_measure
+  _worker_matrix = np.lib.format.open_memmap(npy_filename, mode = 'r+')
+  _worker_seqs = seqs
+  _worker_packed_seqs = packed_seqs
+  _worker_dist_measure = dist_measure
+
+def _detach_worker():
+  global _worker_matrix, _worker_seqs, _worker_packed_seqs
+  _worker_matrix.flush()
+  _worker_matrix = None
+  _worker_seqs = None
+  _worker_packed_seqs = None
+
+def _write_tile(tile):
+  '''
+  Compute the tile of the matrix starting at (row_start, col_start), and write it, and its transpose, into the file
+  '''
+  (row_start, col_start) = tile
+  row_end = min(row_start + tile_length, len(_worker_seqs))
+  col_end = min(col_start + tile_length, len(_worker_seqs))
+  if _worker_dist_measure == Levenshtein.hamming:
+    (codes, others) = _worker_packed_seqs
+    tile_dists = packed_seq.hamming_block((codes[row_start:row_end], others[row_start:row_end]), (codes[col_start:col_end], others[col_start:col_end]), len(_worker_seqs[0]))
+  else:
+    col_seqs = _worker_seqs[col_start:col_end]
+    tile_dists = np.empty((row_end - row_start, col_end - col_start), dtype = np.uint8)
+    for row_num, row_seq in enumerate(_worker_seqs[row_start:row_end]):
+      tile_dists[row_num] = [Levenshtein.distance(row_seq, col_seq) for col_seq in col_seqs]
+  _worker_matrix[row_start:row_end, col_start:col_end] = tile_dists
+  if col_start != row_start:
+    _worker_matrix[col_start:col_end, row_start:row_end] = tile_dists.T
+  return tile
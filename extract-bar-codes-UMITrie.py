@@ -1,19 +1,19 @@
 #! /usr/bin/env python
 
-import gzip
-import re
 import sys
-import pickle
 
 project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
+import array_store
+import parallel_ingest
+from SeqCountTable import SeqCountTable
 from UMIHashTrie import UMIHashTrie
 from UMIData import UMIData
 
 if len(sys.argv) != 2:
-    sys.exit('A single command line argument specifying the fastq.gz file to process is required. Exiting.')
-# first and only command line argument is the fastq.gz file to process
+    sys.exit('A single command line argument specifying the fastq.gz file to process, or a SeqCountTable file from ingest-fastq.py, is required. Exiting.')
+# first and only command line argument is the fastq.gz file to process, or a SeqCountTable
 fastq_filename = sys.argv[1]
 
 # constants
@@ -22,44 +22,23 @@ umi_length = 16
 well_id_start = 16
 well_id_length = 8
 
-report_every = 100000
+# Count the reads of each distinct barcode region x amplicon_id, unless that has already been done by ingest-fastq.py
+if array_store.is_array_store(fastq_filename):
+    seq_count_table = SeqCountTable.load(fastq_filename)
+else:
+    seq_count_table = SeqCountTable.ingest([fastq_filename], well_id_start + well_id_length - 1, num_workers = parallel_ingest.default_num_workers)
+(keys, counts, n_skipped) = seq_count_table.key_counts([(umi_start, umi_start + umi_length - 1), (well_id_start, well_id_start + well_id_length - 1)])
 
 # create empty UMIHashTrie to store and search all id count data
 umi_trie = UMIHashTrie()
 
-# Go through FASTQ, one four-line block at a time
-n_read = 0
-with gzip.open(fastq_filename, 'r') as fastq_file:
-    while True: # Loop until we don't find another seq_id_line
-        seq_id_line: str = fastq_file.readline().decode('ascii').rstrip()
-        if not seq_id_line:
-            break
-        # Check the four lines
-        if seq_id_line[0] != '@':
-            sys.exit("Expected first line of a read, beginning with @. '" + seq_id_line[0] + "' seen. Exiting.")
-        sequence: str = fastq_file.readline().decode('ascii').rstrip()
-        plus_line: str = fastq_file.readline().decode('ascii').rstrip()
-        if plus_line[0] != '+':
-            sys.exit("Expected third line of a read, beginning with '+'. '" + seq_id_line[0] + "' seen. Exiting.")
-        quality: str = fastq_file.readline().decode('ascii').rstrip()
-        amplicon_match = re.search(':([^:]+)$', seq_id_line)
-        if amplicon_match == None:
-            sys.exit('No amplicon ID found at end of sequence ID line:\n' + seq_id_line + '\nExiting.')
-        # Extract the IDs
-        amplicon_id: str = amplicon_match.group(1)
-        umi = sequence[umi_start:(umi_start + umi_length - 1)]
-        well_id = sequence[well_id_start:(well_id_start + well_id_length - 1)]
-        # add to UMIHashTrie
-        umi_trie.record_read(umi, well_id, amplicon_id)
-        # write a progress indicator
-        n_read += 1
-        if (n_read % report_every) == 0:
-            print(f'%d reads added to the UMIHashTrie' % n_read)
+# add the reads of each (umi, well_id, amplicon_id), in the order first seen, which gives the same UMIHashTrie as adding them one at a time
+for (umi, well_id, amplicon_id), count in zip(keys, counts.tolist()):
+    umi_trie.record_read(umi, well_id, amplicon_id, count)
+print(f'{int(counts.sum())} reads added to the UMIHashTrie')
 
-# save UMITrie data structure with pickle
-umi_trie_filename = fastq_filename + '_UMIHashTrie.pkl'
+# save UMITrie data structure as an array store, which UMIHashTrie.load reads back without unpickling every node
+umi_trie_filename = fastq_filename + '_UMIHashTrie.arrays'
 print(f'Saving UMIHashTrie to %s...' % umi_trie_filename)
-umi_trie_file = open(umi_trie_filename, 'wb')
-pickle.dump(umi_trie, umi_trie_file)
-umi_trie_file.close()
+umi_trie.save(umi_trie_filename)
 
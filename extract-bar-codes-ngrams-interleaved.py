@@ -17,8 +17,10 @@ project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
 import squtils as sq
+import array_store
 from InterleavedUMIReadData import InterleavedUMIReadData
 from ReadNgramHash import ReadNgramHash, seq_target_query
+from SeqCountTable import SeqCountTable
 
 ###############################################################################
 
@@ -29,8 +31,8 @@ def highlight_well_id(umi_well_seq, position, mismatch):
 
 ###############################################################################
 if (len(sys.argv)) < 2 or (len(sys.argv) > 3):
-  sys.exit('A single command line argument specifying the fastq.gz file to process is required, followed by an optional argument specifying experimental metadata. Exiting.')
-# first and only command line argument is the fastq.gz file to process
+  sys.exit('A single command line argument specifying the fastq.gz file to process, or a SeqCountTable of it from an earlier run, is required, followed by an optional argument specifying experimental metadata. Exiting.')
+# first and only command line argument is the fastq.gz file to process, or a SeqCountTable of it
 read_filename = sys.argv[1]
 if len(sys.argv) == 3:
   metadata_filename = sys.argv[2]
@@ -55,69 +57,85 @@ else:
 
 ### Read Interleaved reads
 interleaved_read_ngrams = ReadNgramHash(InterleavedUMIReadData.seq_length) # create an object so we can access the ngram_length
-interleaved_read_ngram_hash_filename = f'{read_filename}_ReadNgramHash_{interleaved_read_ngrams.ngram_length}_{InterleavedUMIReadData.umi_well_padding}.pkl'
+interleaved_read_ngram_hash_filename = f'{read_filename}_ReadNgramHash_{interleaved_read_ngrams.ngram_length}_{InterleavedUMIReadData.umi_well_padding}.arrays'
+pickled_interleaved_read_ngram_hash_filename = f'{read_filename}_ReadNgramHash_{interleaved_read_ngrams.ngram_length}_{InterleavedUMIReadData.umi_well_padding}.pkl' # from earlier runs
 if os.path.exists(interleaved_read_ngram_hash_filename):
   sq.log(f'Reading data from {interleaved_read_ngram_hash_filename}...')
-  interleaved_read_ngram_hash_file = open(interleaved_read_ngram_hash_filename, 'rb')
+  interleaved_read_ngrams = ReadNgramHash.load(interleaved_read_ngram_hash_filename)
+elif os.path.exists(pickled_interleaved_read_ngram_hash_filename):
+  sq.log(f'Reading data from {pickled_interleaved_read_ngram_hash_filename}...')
+  interleaved_read_ngram_hash_file = open(pickled_interleaved_read_ngram_hash_filename, 'rb')
   interleaved_read_ngrams = pickle.load(interleaved_read_ngram_hash_file)
   interleaved_read_ngram_hash_file.close()
 else:
-  sq.log(f'Building ReadNgramHash from {read_filename}...')
-  # Go through FASTQ file, one four-line block at a time
-  ignore_Ns = True
-  n_read = 0
-  n_skipped = 0
-  report_every = 100000
-  max_to_read = None # None for no limit :)
-  # max_to_read = 1000 # For testing
-  if max_to_read and (max_to_read < report_every):
-    report_every = max_to_read
-  print(f'InterleavedUMIReadData.seq_length: {InterleavedUMIReadData.seq_length}')
+  seq_count_table_filename = f'{read_filename}_SeqCountTable_{InterleavedUMIReadData.seq_length}.arrays'
+  if array_store.is_array_store(read_filename):
+    sq.log(f'Reading data from {read_filename}...')
+    seq_count_table = SeqCountTable.load(read_filename)
+  elif os.path.exists(seq_count_table_filename):
+    sq.log(f'Reading data from {seq_count_table_filename}...')
+    seq_count_table = SeqCountTable.load(seq_count_table_filename)
+  else:
+    sq.log(f'Counting umi_well_seqs in {read_filename}...')
+    # Go through the file, one line per read, counting the reads of each umi_well_seq in the order they were first seen
+    n_read = 0
+    report_every = 100000
+    max_to_read = None # None for no limit :)
+    # max_to_read = 1000 # For testing
+    if max_to_read and (max_to_read < report_every):
+      report_every = max_to_read
+    umi_well_seq_counts = collections.Counter()
+    with gzip.open(read_filename, 'r') as read_file:
+      while (max_to_read == None) or (n_read < max_to_read): # Loop until we don't find another read_line, or have reached max_to_read
+        read_line = read_file.readline()
+        if not read_line.rstrip():
+          break
+        # Extract R1 from ihe line, discarding padding 'N's
+        R1_seq = read_line.split()[1]
+        umi_well_seq_counts[R1_seq[0:InterleavedUMIReadData.seq_length]] += 1
+        # write a progress indicator
+        n_read += 1
+        if (n_read % report_every) == 0:
+          print(f'%d items read from read_filename' % n_read)
+    seq_count_table = SeqCountTable.from_key_counts(umi_well_seq_counts, InterleavedUMIReadData.seq_length, include_amplicon_id = False)
+    sq.log(f'Saving SeqCountTable to {seq_count_table_filename}...')
+    seq_count_table.save(seq_count_table_filename, {'fastq_filenames': [read_filename]})
+  print(seq_count_table)
+  # index the umi_well_seqs in the order they were first seen, which gives exactly the same ReadNgramHash as
+  # inserting the reads one at a time
+  sq.log(f'Building ReadNgramHash from {len(seq_count_table)} umi_well_seqs...')
+  (umi_well_seqs, umi_well_seq_read_counts, _) = seq_count_table.key_counts([(0, InterleavedUMIReadData.seq_length)], include_amplicon_id = False)
   interleaved_read_ngrams = ReadNgramHash(InterleavedUMIReadData.seq_length);
-  print(f'interleaved_read_ngrams.seq_length: {interleaved_read_ngrams.seq_length}')
-  with gzip.open(read_filename, 'r') as read_file:
-    while (max_to_read == None) or (n_read < max_to_read): # Loop until we don't find another read_line, or have reached max_to_read
-      read_line: str = read_file.readline().decode('ascii').rstrip()
-      if not read_line:
-        break
-      # Extract R1 from ihe line
-      R1_seq = read_line.split()[1]
-      # create a InterleavedUMIReadData object
-      interleaved_read = InterleavedUMIReadData(R1_seq)
-      # # add to ngram hash
-      interleaved_read_ngrams.insert(interleaved_read)
-      # write a progress indicator
-      n_read += 1
-      if (n_read % report_every) == 0:
-        print(f'%d items read from read_filename (%d skipped)' % (n_read, n_skipped))
-  
-  # save ReadNgramHash data structure with pickle
+  for (umi_well_seq,), count in zip(umi_well_seqs, umi_well_seq_read_counts.tolist()):
+    interleaved_read_ngrams.insert_umi_well_seq(umi_well_seq, count)
+
+  # save ReadNgramHash data structure as an array store (which freezes it), so later runs can map it straight back in
   sq.log(f'Saving ReadNgramHash to %s...' % interleaved_read_ngram_hash_filename)
-  interleaved_read_ngram_hash_file = open(interleaved_read_ngram_hash_filename, 'wb')
-  pickle.dump(interleaved_read_ngrams, interleaved_read_ngram_hash_file)
-  interleaved_read_ngram_hash_file.close()
+  interleaved_read_ngrams.save(interleaved_read_ngram_hash_filename)
 
 ### Load or build well_id hash
 max_well_id_offset = 4
 max_dist = 2
-interleaved_well_id_hash_filename = f'{read_filename}_InterleavedWellIDHash_{max_well_id_offset}_{max_dist}.pkl'
+interleaved_well_id_hash_filename = f'{read_filename}_InterleavedWellIDHash_{max_well_id_offset}_{max_dist}.arrays'
+pickled_interleaved_well_id_hash_filename = f'{read_filename}_InterleavedWellIDHash_{max_well_id_offset}_{max_dist}.pkl' # from earlier runs
 if os.path.exists(interleaved_well_id_hash_filename):
   sq.log(f'Reading data from {interleaved_well_id_hash_filename}...')
-  interleaved_well_id_hash_file = open(interleaved_well_id_hash_filename, 'rb')
+  (interleaved_well_id_hash, _) = array_store.load_seq_hash(interleaved_well_id_hash_filename, 'InterleavedWellIDHash')
+elif os.path.exists(pickled_interleaved_well_id_hash_filename):
+  sq.log(f'Reading data from {pickled_interleaved_well_id_hash_filename}...')
+  interleaved_well_id_hash_file = open(pickled_interleaved_well_id_hash_filename, 'rb')
   interleaved_well_id_hash = pickle.load(interleaved_well_id_hash_file)
   interleaved_well_id_hash_file.close()
 else:
   sq.log(f'Building interleaved_well_id_hash')
   # exhaustive looping is fine, as we need to visit every umi_well_seq, and the number of well_ids is low (i.e. 4)
   interleaved_well_id_hash = {}
-  for umi_well_seq in interleaved_read_ngrams.umi_well_seq_hash:
+  for umi_well_seq in interleaved_read_ngrams.umi_well_seqs():
     (umi, well_id) = InterleavedUMIReadData.extract_umi_and_well_id(umi_well_seq)
     interleaved_well_id_hash[umi_well_seq] = well_id
   # save well_id hash data structure
   sq.log(f'Saving interleaved_well_id_hash to %s...' % interleaved_well_id_hash_filename)
-  interleaved_well_id_hash_file = open(interleaved_well_id_hash_filename, 'wb')
-  pickle.dump(interleaved_well_id_hash, interleaved_well_id_hash_file)
-  interleaved_well_id_hash_file.close()
+  array_store.save_seq_hash(interleaved_well_id_hash_filename, 'InterleavedWellIDHash', interleaved_well_id_hash)
 
 ### Summary
 print(f'interleaved_read_ngrams.umi_well_seq_hash: {len(interleaved_read_ngrams.umi_well_seq_hash)} items')        
@@ -154,7 +172,7 @@ print('\n'.join(f'\t{dist}: {well_id_distance_counts[dist]}' for dist in sorted(
 ### Tests
 
 sq.log(f'Sorting umi_well_seqs')
-sorted_umi_well_seqs = sorted(interleaved_read_ngrams.umi_well_seq_hash, key = lambda umi_well_seq : interleaved_read_ngrams.num_reads(umi_well_seq), reverse = True)#[0:10]
+sorted_umi_well_seqs = sorted(interleaved_read_ngrams.umi_well_seqs(), key = lambda umi_well_seq : interleaved_read_ngrams.num_reads(umi_well_seq), reverse = True)#[0:10]
 # find matchs for all umi_well_seqs
 query_num = 1
 for umi_well_seq in sorted_umi_well_seqs:
@@ -1,10 +1,8 @@
 #! /usr/bin/env python
 
-import gzip
-import re
 import sys
 import os
-import pickle
+import time
 import colorama
 colorama.init()
 import numpy as np
@@ -17,8 +15,15 @@ project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
 sys.path.insert(0, project_dir)
 
 import squtils as sq
+import array_store
+import parallel_ingest
+from NgramQueryPool import NgramQueryPool
 from FastqReadData import FastqReadData
-from ReadNgramHash import ReadNgramHash, seq_target_query
+from ReadNgramHash import ReadNgramHash
+from SeqCountTable import SeqCountTable
+from WellIDAssigner import WellIDAssigner
+from StageCache import StageCache
+import PrimerFilter
 
 ###############################################################################
 
@@ -60,118 +65,115 @@ else:
   well_ids = []
   known_well_id_counts_hash = {}
 
-### TODO these should come from a configuration file
-exclude_seqs = {'RdRP':'GACCATTTCACAGATC', 'Egene':'ACGCTATTAACTATTAACGTACCTGT', 'GAPDH':'CTTCTCATGGTTCACACCCA'} # primer dimer black-lisr
+### Primer dimer black-list
+exclude_seqs_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exclude-seqs.csv')
+if not os.path.exists(exclude_seqs_filename):
+  sys.exit(f'Black-list of primer dimer sequences {exclude_seqs_filename} not found. Exiting.')
+exclude_seqs = PrimerFilter.read_exclude_seqs(exclude_seqs_filename)
 min_exclude_frac = 0.8
-###
+exclude_at_ingest = True # False removes black-listed sequences from the built ReadNgramHash instead, e.g. to compare timings
 
 ngram_length = ReadNgramHash(0).ngram_length # create a dummy object so we can access default ngram_length
+pack_umi_well_seqs = False # store umi_well_seqs and ngrams as 2-bit packed ints, to save memory on large plates
 # ngram_length = 4
+ignore_Ns = True
+max_to_read = None # None for no limit :)
+# max_to_read = 100000 # For testing
+umi_well_seq_length = FastqReadData.seq_length
+
+### Stage cache. Each stage's artifact is keyed on its parameters and the keys of the artifacts it is built from, so
+# changing e.g. ngram_length re-indexes the stored read counts, rather than reading the FASTQ file again
+stage_cache = StageCache(f'{fastq_filename}_cache')
+# the first command line argument may instead be a SeqCountTable already made from the FASTQ file by ingest-fastq.py
+seq_count_table_given = array_store.is_array_store(fastq_filename)
+seq_count_table_parameters = {'input': stage_cache.file_digest(fastq_filename), 'region_length': umi_well_seq_length, 'max_to_read': max_to_read}
+seq_count_table_key = stage_cache.key('SeqCountTable', seq_count_table_parameters)
+ngram_hash_parameters = {'ignore_Ns': ignore_Ns, 'ngram_length': ngram_length, 'packed': pack_umi_well_seqs, 'exclude_seqs': exclude_seqs, 'min_exclude_frac': min_exclude_frac}
+ngram_hash_upstream = {'SeqCountTable': seq_count_table_key}
+ngram_hash_key = stage_cache.key('ReadNgramHash', ngram_hash_parameters, ngram_hash_upstream)
+
 ### Read FASTQ reads
-fastq_read_ngrams = ReadNgramHash(FastqReadData.seq_length) # create an object so we can access the ngram_length
-fastq_read_ngram_hash_filename = f'{fastq_filename}_ReadNgramHash_{ngram_length}_{FastqReadData.umi_well_padding}.pkl'
-if os.path.exists(fastq_read_ngram_hash_filename):
+fastq_read_ngram_hash_filename = stage_cache.filename('ReadNgramHash', ngram_hash_key)
+if stage_cache.exists('ReadNgramHash', ngram_hash_key):
   sq.log(f'Reading data from {fastq_read_ngram_hash_filename}...')
-  fastq_read_ngram_hash_file = open(fastq_read_ngram_hash_filename, 'rb')
-  fastq_read_ngrams = pickle.load(fastq_read_ngram_hash_file)
-  fastq_read_ngram_hash_file.close()
+  fastq_read_ngrams = ReadNgramHash.load(fastq_read_ngram_hash_filename)
 else:
-  sq.log(f'Building ReadNgramHash from {fastq_filename}...')
-  # Go through FASTQ file, one four-line block at a time
-  ignore_Ns = True
-  n_read = 0
-  n_skipped = 0
-  n_excluded = 0
-  report_every = 100000
-  max_to_read = None # None for no limit :)
-  # max_to_read = 100000 # For testing
-  if max_to_read and (max_to_read < report_every):
-    report_every = max_to_read
-  fastq_read_ngrams = ReadNgramHash(seq_length = FastqReadData.seq_length, ngram_length = ngram_length);
-  with gzip.open(fastq_filename, 'r') as fastq_file:
-    while (max_to_read == None) or (n_read < max_to_read): # Loop until we don't find another read_id_line, or have reached max_to_read
-      read_id_line: str = fastq_file.readline().decode('ascii').rstrip()
-      if not read_id_line:
-        break
-      # Check the four lines
-      if read_id_line[0] != '@':
-        sys.exit("Expected first line of a read, beginning with @. '" + read_id_line[0] + "' seen. Exiting.")
-      sequence: str = fastq_file.readline().decode('ascii').rstrip()
-      plus_line: str = fastq_file.readline().decode('ascii').rstrip()
-      if plus_line[0] != '+':
-        sys.exit("Expected third line of a read, beginning with '+'. '" + read_id_line[0] + "' seen. Exiting.")
-      quality: str = fastq_file.readline().decode('ascii').rstrip()
-      n_read += 1 # count all valid reads, even though some may be skipped or excluded below
-      # create a FastqReadData object
-      fastq_read = FastqReadData(read_id_line, sequence, quality)
-      # bail out if we're ignoring Ns in the IDs, and there is one
-      if ignore_Ns and ('N' in fastq_read.umi_well_seq):
-        n_skipped += 1
-        continue
-      fastq_read_ngrams.insert(fastq_read)
-      # write a progress indicator
-      if (n_read % report_every) == 0:
-        print(f'{n_read} items read from {fastq_filename}. {n_skipped} reads with Ns skipped)')
-  print(f'Finished: {n_read} items read from {fastq_filename}. {n_skipped} reads with Ns skipped')
-  
-  # Removed black-listed sequences. Experiments show that it is faster to do this *after* the index has been built
-  sq.log(f'Removing black-listed sequences...')
-  excluded_seq_counts = {seq_name:0 for seq_name in exclude_seqs}
-  for seq_name in exclude_seqs:
-    print(f'Checking {exclude_seqs[seq_name]}:')
-    exclude_matches = fastq_read_ngrams.seq_ngram_query(exclude_seqs[seq_name], min_similarity_fraction = 0.8)
-    num_matches = sum([fastq_read_ngrams.num_reads(umi_well_seq) for umi_well_seq, offset in exclude_matches])
-    print(f'\t{num_matches} matches found. Deleting them from fastq_read_ngrams hash.')
-    for umi_well_seq, similarity in exclude_matches:
-      fastq_read_ngrams.delete(umi_well_seq)
+  seq_count_table_filename = stage_cache.filename('SeqCountTable', seq_count_table_key)
+  if seq_count_table_given:
+    sq.log(f'Reading data from {fastq_filename}...')
+    seq_count_table = SeqCountTable.load(fastq_filename)
+  elif stage_cache.exists('SeqCountTable', seq_count_table_key):
+    sq.log(f'Reading data from {seq_count_table_filename}...')
+    seq_count_table = SeqCountTable.load(seq_count_table_filename)
+  else:
+    # count the reads of each distinct umi_well_seq x amplicon_id, as ingest-fastq.py does, so the table is only made once
+    sq.log(f'Counting umi_well_seqs in {fastq_filename}...')
+    num_workers = parallel_ingest.default_num_workers # only BGZF input (e.g. from bgzip) can be split into shards
+    seq_count_table = SeqCountTable.ingest([fastq_filename], umi_well_seq_length, num_workers = num_workers, max_to_read = max_to_read)
+    if seq_count_table.ingest_report != None:
+      print(f'Ingest pipeline stages:\n{seq_count_table.ingest_report}')
+    sq.log(f'Saving SeqCountTable to {seq_count_table_filename}...')
+    seq_count_table.save(seq_count_table_filename, {'fastq_filenames': [fastq_filename]})
+    stage_cache.record('SeqCountTable', seq_count_table_key, seq_count_table_parameters)
+  (umi_well_seqs, umi_well_seq_read_counts, n_skipped) = seq_count_table.key_counts([(0, umi_well_seq_length)], include_amplicon_id = False, ignore_Ns = ignore_Ns)
+  print(f'Finished: {seq_count_table.n_read} items read from {fastq_filename}. {n_skipped} reads with Ns skipped')
+  umi_well_seq_counts = {umi_well_seq: count for (umi_well_seq,), count in zip(umi_well_seqs, umi_well_seq_read_counts.tolist())}
+
+  # index the umi_well_seqs in the order they were first seen, which gives exactly the same ReadNgramHash as
+  # inserting the reads one at a time
+  sq.log(f'Building ReadNgramHash from {len(umi_well_seq_counts)} umi_well_seqs...')
+  fastq_read_ngrams = ReadNgramHash(seq_length = umi_well_seq_length, ngram_length = ngram_length, packed = pack_umi_well_seqs);
+  if exclude_at_ingest:
+    # drop umi_well_seqs matching the black-list before they are indexed
+    primer_filter = PrimerFilter.PrimerFilter(exclude_seqs, ngram_length, min_exclude_frac)
+    keep = primer_filter.exclude(list(umi_well_seq_counts), list(umi_well_seq_counts.values()))
+    umi_well_seq_counts = {umi_well_seq: count for (umi_well_seq, count), keep_umi_well_seq in zip(umi_well_seq_counts.items(), keep) if keep_umi_well_seq}
+    print(f'Black-listed sequences excluded at ingest:\n{primer_filter.report()}')
+  for umi_well_seq, count in umi_well_seq_counts.items():
+    fastq_read_ngrams.insert_umi_well_seq(umi_well_seq, count)
+  if not exclude_at_ingest:
+    # Remove black-listed sequences from the built index, which gives the same ReadNgramHash as excluding them at ingest
+    sq.log(f'Removing black-listed sequences...')
+    start_time = time.perf_counter()
+    for seq_name in exclude_seqs:
+      print(f'Checking {exclude_seqs[seq_name]}:')
+      exclude_matches = fastq_read_ngrams.seq_ngram_query(exclude_seqs[seq_name], min_similarity_fraction = min_exclude_frac)
+      num_matches = sum([fastq_read_ngrams.num_reads(umi_well_seq) for umi_well_seq, offset in exclude_matches])
+      print(f'\t{num_matches} matches found. Deleting them from fastq_read_ngrams hash.')
+      for umi_well_seq, similarity in exclude_matches:
+        fastq_read_ngrams.delete(umi_well_seq)
+    print(f'Black-listed sequences removed in {time.perf_counter() - start_time:.2f}s')
 
-  # save ReadNgramHash data structure with pickle
+  # save ReadNgramHash data structure as an array store (which freezes it), so later runs can map it straight back in
   sq.log(f'Saving ReadNgramHash to %s...' % fastq_read_ngram_hash_filename)
-  fastq_read_ngram_hash_file = open(fastq_read_ngram_hash_filename, 'wb')
-  pickle.dump(fastq_read_ngrams, fastq_read_ngram_hash_file)
-  fastq_read_ngram_hash_file.close()
+  fastq_read_ngrams.save(fastq_read_ngram_hash_filename)
+  stage_cache.record('ReadNgramHash', ngram_hash_key, ngram_hash_parameters, ngram_hash_upstream)
 
 ### Load or build well_id hash
 max_well_id_offset = 4
 max_dist = 2
-fastq_well_id_hash_filename = f'{fastq_filename}_FastqWellIDHash_{max_well_id_offset}_{max_dist}_{FastqReadData.umi_well_padding}.pkl'
-if os.path.exists(fastq_well_id_hash_filename):
+# Levenshtein.distance also finds well_ids shifted by insertions or deletions in the UMI, but takes about 8-25x as long
+# to build the well_id hash (10.6s against 1.2s for 100k umi_well_seqs and 96 well_ids; see WellIDAssigner)
+well_id_dist_measure = Levenshtein.hamming
+# the well_id hash only depends on which umi_well_seqs were indexed, not how (e.g. ngram_length), so is keyed on what decides those
+well_id_hash_parameters = {'well_ids': well_ids, 'well_id_start': FastqReadData.well_id_start, 'max_well_id_offset': max_well_id_offset, 'max_dist': max_dist,
+  'dist_measure': well_id_dist_measure.__name__, 'ignore_Ns': ignore_Ns, 'exclude_seqs': exclude_seqs, 'min_exclude_frac': min_exclude_frac}
+well_id_hash_upstream = {'SeqCountTable': seq_count_table_key}
+well_id_hash_key = stage_cache.key('WellIDHash', well_id_hash_parameters, well_id_hash_upstream)
+fastq_well_id_hash_filename = stage_cache.filename('WellIDHash', well_id_hash_key)
+if stage_cache.exists('WellIDHash', well_id_hash_key):
   sq.log(f'Reading data from {fastq_well_id_hash_filename}...')
-  fastq_well_id_hash_file = open(fastq_well_id_hash_filename, 'rb')
-  fastq_well_id_hash = pickle.load(fastq_well_id_hash_file)
-  fastq_well_id_hash_file.close()
+  (fastq_well_id_hash, _) = array_store.load_seq_hash(fastq_well_id_hash_filename, 'WellIDHash')
 else:
   sq.log(f'Building fastq_well_id_hash')
-  # exhaustive looping is fine, as we need to visit every umi_well_seq, and the number of well_ids is low (i.e. 4)
-  fastq_well_id_hash = {}
-  for umi_well_seq in fastq_read_ngrams.umi_well_seq_hash:
-    best_well_id = None
-    best_pos = None
-    best_pos_miss = FastqReadData.well_id_length + 1
-    best_dist = FastqReadData.well_id_length + 1
-    for well_id in well_ids:
-      (this_pos, this_dist) = seq_target_query(well_id, umi_well_seq, FastqReadData.well_id_start, max_well_id_offset) # , dist_measure = Levenshtein.distance)
-      pos_miss = abs(this_pos - FastqReadData.well_id_start)
-      # if umi_well_seq == 'CATAGTCACTCAGGTCTTGATGGGCAAATCTT':
-      #   if best_pos != None:
-      #     print(highlight_well_id(umi_well_seq, best_pos, best_dist))
-      #   print(f'best_well_id = {best_well_id}, best_pos = {best_pos}, best_pos_miss = {best_pos_miss}, best_dist = {best_dist}')
-      #   print(f'well_id = {well_id}, this_pos = {this_pos}, pos_miss = {pos_miss}, this_dist = {this_dist}')
-      if (this_dist <= max_dist) and ((this_dist <= best_dist and pos_miss < best_pos_miss) or (this_dist < best_dist and pos_miss <= best_pos_miss)): # TODO consider weighting position over distance
-        best_pos = this_pos
-        best_pos_miss = pos_miss
-        best_dist = this_dist
-        best_well_id = well_id
-        if best_dist == 0 and best_pos == FastqReadData.well_id_start:
-          break # no need to try other well_ids if we've found a perfect match
-    if best_dist <= max_dist:
-      fastq_well_id_hash[umi_well_seq] = (best_well_id, best_pos, best_dist)
+  # every window within max_dist of a well_id is looked up in a precomputed table, rather than comparing each well_id at each position
+  well_id_assigner = WellIDAssigner(well_ids, FastqReadData.well_id_start, max_well_id_offset, max_dist, well_id_dist_measure)
+  fastq_well_id_hash = well_id_assigner.well_id_hash(fastq_read_ngrams.umi_well_seqs())
 
   # save well_id hash data structure
   sq.log(f'Saving fastq_well_id_hash to %s...' % fastq_well_id_hash_filename)
-  fastq_well_id_hash_file = open(fastq_well_id_hash_filename, 'wb')
-  pickle.dump(fastq_well_id_hash, fastq_well_id_hash_file)
-  fastq_well_id_hash_file.close()
+  array_store.save_seq_hash(fastq_well_id_hash_filename, 'WellIDHash', fastq_well_id_hash)
+  stage_cache.record('WellIDHash', well_id_hash_key, well_id_hash_parameters, well_id_hash_upstream)
 
 ### Summary 
 print(f'fastq_read_ngrams.umi_well_seq_hash: {len(fastq_read_ngrams.umi_well_seq_hash)} items')        
@@ -213,90 +215,111 @@ use_histogram_intersection = True
 require_good_well_ids = True
 delete_matches_from_hash = True
 min_exact_match_well_id_frac = 0.5
+freeze_ngram_index = True # query a compact array-backed index, now that all reads have been inserted
+max_posting_fraction = 0.25 # ngrams in more umi_well_seqs than this are skipped by queries where they can be, without changing matches
+if freeze_ngram_index:
+  sq.log(f'Freezing ngram index')
+  fastq_read_ngrams.freeze(max_posting_fraction = max_posting_fraction)
 sq.log(f'Sorting umi_well_seqs')
-sorted_umi_well_seqs = sorted(fastq_read_ngrams.umi_well_seq_hash, key = lambda umi_well_seq : fastq_read_ngrams.num_reads(umi_well_seq), reverse = True)#[0:10]
+sorted_umi_well_seqs = sorted(fastq_read_ngrams.umi_well_seqs(), key = lambda umi_well_seq : fastq_read_ngrams.num_reads(umi_well_seq), reverse = True)#[0:10]
 num_umi_well_seqs = len(sorted_umi_well_seqs)
 # find matchs for all umi_well_seqs
+query_block_size = 256 # number of queries scored together by each query_many call
+num_query_workers = parallel_ingest.default_num_workers # query workers share the frozen index; they need freeze_ngram_index
 query_num = 1
 matched_umi_well_seq = {} # hash we will use the exclude items already matched
-for umi_well_seq in sorted_umi_well_seqs:
-  print(f'num umi_well_seqs seen: {len(matched_umi_well_seq)}/{num_umi_well_seqs}')
-  if umi_well_seq in matched_umi_well_seq:
-    print(f'Skipping {umi_well_seq}. Already seen')
-    continue # many will already have been matches to earlier queries
-  sq.log(f'Querying with {umi_well_seq}...')
-  if use_histogram_intersection:
-    ngram_matches = fastq_read_ngrams.umi_well_seq_query_with_histogram_intersection(umi_well_seq, min_similarity_fraction = min_similarity_fraction)
-  else:
-    ngram_matches = fastq_read_ngrams.umi_well_seq_query(umi_well_seq, min_similarity_fraction = min_similarity_fraction)
-  # remove matches we have already seen
-  ngram_matches = [(match_umi_well_seq, num_ngram_matches) for match_umi_well_seq, num_ngram_matches in ngram_matches if match_umi_well_seq not in matched_umi_well_seq]
-  # mark remaining matches as seen
-  matched_umi_well_seq.update({match_umi_well_seq:1 for match_umi_well_seq, num_ngram_matches in ngram_matches})
-  num_total_matches = sum([fastq_read_ngrams.num_reads(match_umi_well_seq) for match_umi_well_seq, num_ngram_matches in ngram_matches])
-  print(f'Num. times histogram intersection made a difference: {fastq_read_ngrams.hist_match_diff}/{fastq_read_ngrams.num_hist_ints}')
-  print(f'num_total_matches: {num_total_matches}')
-  ### check if most of the matches have good well_ids
-  mode_well_id = None
-  if require_good_well_ids:
-    if not umi_well_seq in fastq_well_id_hash:
-      print(f'Query {umi_well_seq} not in fastq_well_id_hash')
-    match_well_ids_and_counts = [(fastq_well_id_hash[match_umi_well_seq], fastq_read_ngrams.num_reads(match_umi_well_seq)) \
-      for match_umi_well_seq, num_ngram_matches in ngram_matches if match_umi_well_seq in fastq_well_id_hash] # must check key, as reads without a good enough well_id match don't make it into fastq_well_id_hash
-    if len(match_well_ids_and_counts) == 0:
-      print(f'Skipping: no matches in fastq_well_id_hash')
-      for match in ngram_matches:
-        fastq_read_ngrams.delete(match[0])
-      continue
-    match_well_ids = set(match_well_id_and_count[0][0] for match_well_id_and_count in match_well_ids_and_counts)
-    # initialise hash of hashes 
-    well_id_dist_counts = {match_well_id:{} for match_well_id in match_well_ids}
-    for well_id_dist_count in well_id_dist_counts:
-      well_id_dist_counts[well_id_dist_count] = {dist:0 for dist in range(FastqReadData.well_id_length)}
-    # compute counts
-    for match_well_id_and_count in match_well_ids_and_counts:
-      well_id_dist_counts[match_well_id_and_count[0][0]][match_well_id_and_count[0][2]] += match_well_id_and_count[1]
-    # find the distance with the maximum count for each matched well_id
-    max_dist_counts = [(well_id, dist, well_id_dist_counts[well_id][dist]) for well_id, dist in \
-      [ (well_id, max(well_id_dist_counts[well_id], key = lambda dist: well_id_dist_counts[well_id][dist])) for well_id in well_id_dist_counts] ]
-    mode_well_id, mode_well_id_dist, mode_well_id_count = max(max_dist_counts, key = lambda max_dist_count: max_dist_count[2])
-    if mode_well_id_dist == 0:
-      exact_match_well_id_frac = mode_well_id_count/num_total_matches
+max_match_distance = None # if set, match umi_well_seqs within this Hamming distance of each query, rather than by ngram similarity
+if max_match_distance == None:
+  query_pool = NgramQueryPool(fastq_read_ngrams, num_workers = num_query_workers, block_size = query_block_size)
+  # matches for each query come back in order, with any deleted since they were found already removed
+  query_results = query_pool.umi_well_seq_queries(sorted_umi_well_seqs, min_similarity_fraction = min_similarity_fraction, skip = matched_umi_well_seq.__contains__)
+else:
+  query_pool = None
+  query_results = (None if umi_well_seq in matched_umi_well_seq else fastq_read_ngrams.umi_well_seq_distance_query(umi_well_seq, max_match_distance) \
+    for umi_well_seq in sorted_umi_well_seqs)
+try:
+  for umi_well_seq, ngram_matches in zip(sorted_umi_well_seqs, query_results):
+    print(f'num umi_well_seqs seen: {len(matched_umi_well_seq)}/{num_umi_well_seqs}')
+    if umi_well_seq in matched_umi_well_seq:
+      print(f'Skipping {umi_well_seq}. Already seen')
+      continue # many will already have been matches to earlier queries
+    sq.log(f'Querying with {umi_well_seq}...')
+    if use_histogram_intersection and (max_match_distance == None):
+      ngram_matches = fastq_read_ngrams.histogram_intersection_matches(umi_well_seq, ngram_matches, min_similarity_fraction = min_similarity_fraction)
+    # remove matches we have already seen
+    ngram_matches = [(match_umi_well_seq, num_ngram_matches) for match_umi_well_seq, num_ngram_matches in ngram_matches if match_umi_well_seq not in matched_umi_well_seq]
+    # mark remaining matches as seen
+    matched_umi_well_seq.update({match_umi_well_seq:1 for match_umi_well_seq, num_ngram_matches in ngram_matches})
+    num_total_matches = sum([fastq_read_ngrams.num_reads(match_umi_well_seq) for match_umi_well_seq, num_ngram_matches in ngram_matches])
+    print(f'Num. times histogram intersection made a difference: {fastq_read_ngrams.hist_match_diff}/{fastq_read_ngrams.num_hist_ints}')
+    print(f'num_total_matches: {num_total_matches}')
+    ### check if most of the matches have good well_ids
+    mode_well_id = None
+    if require_good_well_ids:
+      if not umi_well_seq in fastq_well_id_hash:
+        print(f'Query {umi_well_seq} not in fastq_well_id_hash')
+      match_well_ids_and_counts = [(fastq_well_id_hash[match_umi_well_seq], fastq_read_ngrams.num_reads(match_umi_well_seq)) \
+        for match_umi_well_seq, num_ngram_matches in ngram_matches if match_umi_well_seq in fastq_well_id_hash] # must check key, as reads without a good enough well_id match don't make it into fastq_well_id_hash
+      if len(match_well_ids_and_counts) == 0:
+        print(f'Skipping: no matches in fastq_well_id_hash')
+        for match in ngram_matches:
+          fastq_read_ngrams.delete(match[0])
+        continue
+      match_well_ids = set(match_well_id_and_count[0][0] for match_well_id_and_count in match_well_ids_and_counts)
+      # initialise hash of hashes 
+      well_id_dist_counts = {match_well_id:{} for match_well_id in match_well_ids}
+      for well_id_dist_count in well_id_dist_counts:
+        well_id_dist_counts[well_id_dist_count] = {dist:0 for dist in range(FastqReadData.well_id_length)}
+      # compute counts
+      for match_well_id_and_count in match_well_ids_and_counts:
+        well_id_dist_counts[match_well_id_and_count[0][0]][match_well_id_and_count[0][2]] += match_well_id_and_count[1]
+      # find the distance with the maximum count for each matched well_id
+      max_dist_counts = [(well_id, dist, well_id_dist_counts[well_id][dist]) for well_id, dist in \
+        [ (well_id, max(well_id_dist_counts[well_id], key = lambda dist: well_id_dist_counts[well_id][dist])) for well_id in well_id_dist_counts] ]
+      mode_well_id, mode_well_id_dist, mode_well_id_count = max(max_dist_counts, key = lambda max_dist_count: max_dist_count[2])
+      if mode_well_id_dist == 0:
+        exact_match_well_id_frac = mode_well_id_count/num_total_matches
+      else:
+        exact_match_well_id_frac = 0
+      print(f'Fraction of exact well_id matches: {exact_match_well_id_frac}')
+      if exact_match_well_id_frac < min_exact_match_well_id_frac:
+        print(f'Skipping: exact_match_well_id_frac = {exact_match_well_id_frac}')
+        for match in ngram_matches:
+          fastq_read_ngrams.delete(match[0])
+        continue
+    # sort matches by total number of times each inexact match seen
+    ngram_matches = sorted(ngram_matches, key = lambda ngram_match : fastq_read_ngrams.num_reads(ngram_match[0]), reverse = True)
+    num_exact_matches = fastq_read_ngrams.num_reads(umi_well_seq)
+    num_inexact_matches = num_total_matches - num_exact_matches
+    if mode_well_id != None:
+      mode_well_id_string = highlight_well_id(mode_well_id, 0, 0)
     else:
-      exact_match_well_id_frac = 0
-    print(f'Fraction of exact well_id matches: {exact_match_well_id_frac}')
-    if exact_match_well_id_frac < min_exact_match_well_id_frac:
-      print(f'Skipping: exact_match_well_id_frac = {exact_match_well_id_frac}')
-      for match in ngram_matches:
-        fastq_read_ngrams.delete(match[0])
-      continue
-  # sort matches by total number of times each inexact match seen
-  ngram_matches = sorted(ngram_matches, key = lambda ngram_match : fastq_read_ngrams.num_reads(ngram_match[0]), reverse = True)
-  num_exact_matches = fastq_read_ngrams.num_reads(umi_well_seq)
-  num_inexact_matches = num_total_matches - num_exact_matches
-  if mode_well_id != None:
-    mode_well_id_string = highlight_well_id(mode_well_id, 0, 0)
-  else:
-    mode_well_id_string = f'{" "*(FastqReadData.well_id_length + 1)}'
-  prefix = f'{query_num}. Query: '
-  suffix = f'  Mode Well ID: {mode_well_id_string} Exact: {num_exact_matches} Inexact: {num_inexact_matches}'
-  if umi_well_seq in fastq_well_id_hash:
-    umi_well_seq_string = highlight_well_id(umi_well_seq, fastq_well_id_hash[umi_well_seq][1], fastq_well_id_hash[umi_well_seq][2])
-  else:
-    umi_well_seq_string = umi_well_seq
-  print(f'{prefix}{umi_well_seq_string}{suffix}')
-  padding_len = len(prefix)
-  for match in ngram_matches:
-    if match[0] in fastq_well_id_hash:
-      match_umi_well_seq_string = highlight_well_id(match[0], fastq_well_id_hash[match[0]][1], fastq_well_id_hash[match[0]][2])
-      well_id_string = fastq_well_id_hash[match[0]][0]
+      mode_well_id_string = f'{" "*(FastqReadData.well_id_length + 1)}'
+    prefix = f'{query_num}. Query: '
+    suffix = f'  Mode Well ID: {mode_well_id_string} Exact: {num_exact_matches} Inexact: {num_inexact_matches}'
+    if umi_well_seq in fastq_well_id_hash:
+      umi_well_seq_string = highlight_well_id(umi_well_seq, fastq_well_id_hash[umi_well_seq][1], fastq_well_id_hash[umi_well_seq][2])
     else:
-      match_umi_well_seq_string = match[0]
-      well_id_string = f'{" "*(FastqReadData.well_id_length + 1)}'
-    print(f'{" "*padding_len}{match_umi_well_seq_string}: {fastq_read_ngrams.num_reads(match[0]):5} {well_id_string} (sim.: {match[1]})')
-    if delete_matches_from_hash:
-      fastq_read_ngrams.delete(match[0])
-  query_num += 1
+      umi_well_seq_string = umi_well_seq
+    print(f'{prefix}{umi_well_seq_string}{suffix}')
+    padding_len = len(prefix)
+    for match in ngram_matches:
+      if match[0] in fastq_well_id_hash:
+        match_umi_well_seq_string = highlight_well_id(match[0], fastq_well_id_hash[match[0]][1], fastq_well_id_hash[match[0]][2])
+        well_id_string = fastq_well_id_hash[match[0]][0]
+      else:
+        match_umi_well_seq_string = match[0]
+        well_id_string = f'{" "*(FastqReadData.well_id_length + 1)}'
+      print(f'{" "*padding_len}{match_umi_well_seq_string}: {fastq_read_ngrams.num_reads(match[0]):5} {well_id_string} (sim.: {match[1]})')
+      if delete_matches_from_hash:
+        fastq_read_ngrams.delete(match[0])
+    query_num += 1
+finally:
+  if query_pool != None:
+    query_pool.close() # also stops the workers if clustering stops early
 print(f'Finished: num umi_well_seqs seen: {len(matched_umi_well_seq)}/{num_umi_well_seqs}')
+if freeze_ngram_index:
+  print(fastq_read_ngrams.ngram_index.stop_list_report())
+print(f'ngram histogram cache: {fastq_read_ngrams.ngram_histogram_cache_hits} hits, {fastq_read_ngrams.ngram_histogram_cache_misses} misses, {len(fastq_read_ngrams.ngram_histogram_cache)} items')
 
 
@@ -1,54 +1,38 @@
 #! /usr/bin/env python
 
-import gzip
-import re
 import sys
+import numpy as np
 
-if len(sys.argv) != 2:
-    sys.exit('A single command line argument specifying the fastq.gz file to process is required. Exiting.')
-# first and only command line argument is the fastq.gz file to process
-fastq_filename = sys.argv[1]
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import array_store
+import parallel_ingest
+from SeqCountTable import SeqCountTable
+
+if len(sys.argv) < 2:
+    sys.exit('A command line argument specifying the fastq.gz file to process is required, optionally followed by further fastq.gz files (e.g. pre-split chunks of the same run), or a SeqCountTable file from ingest-fastq.py. Exiting.')
+# command line arguments are the fastq.gz file(s) to process, in order, or a SeqCountTable
+fastq_filenames = sys.argv[1:]
 
 # constants
 umi_start = 0
 umi_length = 16
 well_id_start = 16
 well_id_length = 8
+num_workers = parallel_ingest.default_num_workers # BGZF input (e.g. from bgzip) and multiple input files are read in parallel
 
-# create empty dictionary for counts
-counts = {}
-
-# Go through FASTQ, one four-line block at a time
-with gzip.open(fastq_filename, 'r') as fastq_file:
-    while True: # Loop until we don't find another seq_id_line
-        seq_id_line: str = fastq_file.readline().decode('ascii').rstrip()
-        if not seq_id_line:
-            break
-        if seq_id_line[0] != '@':
-            sys.exit("Expected first line of a read, beginning with @. '" + seq_id_line[0] + "' seen. Exiting.")
-        sequence: str = fastq_file.readline().decode('ascii').rstrip()
-        plus_line: str = fastq_file.readline().decode('ascii').rstrip()
-        if plus_line[0] != '+':
-            sys.exit("Expected third line of a read, beginning with '+'. '" + seq_id_line[0] + "' seen. Exiting.")
-        quality: str = fastq_file.readline().decode('ascii').rstrip()
-        amplicon_match = re.search(':([^:]+)$', seq_id_line)
-        if amplicon_match == None:
-            sys.exit('No amplicon ID found at end of sequence ID line:\n' + seq_id_line + '\nExiting.')
-        amplicon_id: str = amplicon_match.group(1)
-        umi = sequence[umi_start:(umi_start + umi_length - 1)]
-        well_id = sequence[well_id_start:(well_id_start + well_id_length - 1)]
-        counts_key = umi + ':' + well_id + ':' + amplicon_id
-        if counts_key in counts:
-            counts[counts_key] += 1
-        else:
-            counts[counts_key] = 1
+# Count the reads of each distinct barcode region x amplicon_id, unless that has already been done by ingest-fastq.py.
+# FASTQ shards are read in parallel, and the counts keep the order keys were first seen, as if reading serially
+if array_store.is_array_store(fastq_filenames[0]):
+    seq_count_table = SeqCountTable.load(fastq_filenames[0])
+else:
+    seq_count_table = SeqCountTable.ingest(fastq_filenames, well_id_start + well_id_length - 1, num_workers = num_workers)
+(keys, counts, n_skipped) = seq_count_table.key_counts([(umi_start, umi_start + umi_length - 1), (well_id_start, well_id_start + well_id_length - 1)])
 
 # Print result as a csv file
 # TODO use a proper csv writer for this
 print('UMI,Well_ID,Amplicon_ID,Count')
-sorted_keys = sorted(counts, key = counts.get, reverse = True)
-for key in sorted_keys:
-    ids_match = re.search('^([^:]+):([^:]+):([^:]+)$', key)
-    if ids_match == None:
-        sys.exit('counts key does not match expected format. Exiting.')
-    print(ids_match.group(1) + ',' + ids_match.group(2) + ',' + ids_match.group(3) + ',' + str(counts[key]))
+for key_num in np.argsort(-counts, kind = 'stable'): # most reads first, then in the order first seen
+    (umi, well_id, amplicon_id) = keys[key_num]
+    print(umi + ',' + well_id + ',' + amplicon_id + ',' + str(counts[key_num]))
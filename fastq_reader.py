@@ -0,0 +1,201 @@
+import gzip
+import struct
+import sys
+from operator import methodcaller
+
+# Decompressed bytes pulled from the gzip stream at a time. Large blocks keep the per-read
+# Python work down to a handful of list operations per block.
+default_block_size = 1 << 22 # 4 MiB
+
+# BGZF files (as written by bgzip) are a series of gzip members of at most 64 KiB, each recording its own
+# compressed size in a 'BC' extra field, so they can be split into shards without decompressing them
+_bgzf_header = struct.Struct('<4BI2BH2BHH') # ID1 ID2 CM FLG MTIME XFL OS XLEN SI1 SI2 SLEN BSIZE
+min_shard_length = 1 << 24 # 16 MiB of decompressed FASTQ; reads are far shorter than this
+
+_is_read_id_line = methodcaller('startswith', b'@')
+_is_plus_line = methodcaller('startswith', b'+')
+
+def split_fastq_block(block):
+  '''
+  Split a block of FASTQ data into complete four-line records using bytes operations only.
+  Returns a tuple of (read_id_lines, sequences, remainder), where read_id_lines and sequences
+  are lists of bytes, and remainder is the trailing partial record (if any), which should be
+  prepended to the next block
+  '''
+  if b'\r' in block:
+    block = block.replace(b'\r', b'')
+  lines = block.split(b'\n')
+  num_complete = (len(lines) - 1) & ~3 # the last element is a partial line, or b'' if the block ends with a newline
+  read_id_lines = lines[0:num_complete:4]
+  sequences = lines[1:num_complete:4]
+  if not all(map(_is_read_id_line, read_id_lines)):
+    bad_line = next(line for line in read_id_lines if not line.startswith(b'@'))
+    sys.exit("Expected first line of a read, beginning with @. '" + bad_line[0:1].decode('ascii', 'replace') + "' seen. Exiting.")
+  if not all(map(_is_plus_line, lines[2:num_complete:4])):
+    bad_line = next(line for line in lines[2:num_complete:4] if not line.startswith(b'+'))
+    sys.exit("Expected third line of a read, beginning with '+'. '" + bad_line[0:1].decode('ascii', 'replace') + "' seen. Exiting.")
+  remainder = b'\n'.join(lines[num_complete:])
+  return (read_id_lines, sequences, remainder)
+
+def read_fastq_stream_batches(fastq_stream, block_size = default_block_size):
+  '''
+  Generator yielding batches of FASTQ records from an open binary stream of decompressed FASTQ data.
+  Each batch is a tuple of two lists of bytes: (read_id_lines, sequences). Quality lines are discarded
+  '''
+  remainder = b''
+  while True:
+    block = fastq_stream.read(block_size)
+    if not block:
+      break
+    read_id_lines, sequences, remainder = split_fastq_block(remainder + block)
+    if read_id_lines:
+      yield (read_id_lines, sequences)
+  yield from final_fastq_batch(remainder)
+
+def final_fastq_batch(remainder):
+  '''
+  Yield the last read from the remainder left by split_fastq_block at the end of the data, if the data
+  ended without a trailing newline
+  '''
+  if remainder.strip():
+    read_id_lines, sequences, remainder = split_fastq_block(remainder + b'\n')
+    if remainder.strip():
+      sys.exit('Incomplete read at end of FASTQ data:\n' + remainder.decode('ascii', 'replace') + '\nExiting.')
+    yield (read_id_lines, sequences)
+
+def read_fastq_batches(fastq_filename, block_size = default_block_size):
+  '''
+  Generator yielding batches of (read_id_lines, sequences) from a gzipped FASTQ file.
+  See read_fastq_stream_batches
+  '''
+  with gzip.open(fastq_filename, 'rb') as fastq_file:
+    yield from read_fastq_stream_batches(fastq_file, block_size)
+
+def bgzf_blocks(fastq_filename):
+  '''
+  Return a list of (compressed_offset, decompressed_length) tuples for each block of a BGZF file,
+  or None if fastq_filename is not BGZF compressed
+  '''
+  blocks = []
+  with open(fastq_filename, 'rb') as raw_file:
+    offset = 0
+    while True:
+      raw_file.seek(offset)
+      header = raw_file.read(_bgzf_header.size)
+      if not header:
+        break
+      if len(header) < _bgzf_header.size:
+        return None
+      (id1, id2, cm, flg, mtime, xfl, os_id, xlen, si1, si2, slen, bsize) = _bgzf_header.unpack(header)
+      if (id1, id2, cm, flg & 4, si1, si2, slen) != (31, 139, 8, 4, 66, 67, 2):
+        return None
+      raw_file.seek(offset + bsize + 1 - 4) # ISIZE is the last four bytes of the block
+      (isize,) = struct.unpack('<I', raw_file.read(4))
+      blocks.append((offset, isize))
+      offset += bsize + 1
+  return blocks
+
+def fastq_shards(fastq_filenames, num_shards):
+  '''
+  Split gzipped FASTQ input into independent shards for parallel processing, in input order.
+  Each file (e.g. pre-split chunk files) is at least one shard. BGZF files are further split, on block
+  boundaries, into up to num_shards shards of roughly equal decompressed size.
+  Shards are (fastq_filename, compressed_offset, decompressed_length) tuples, with
+  decompressed_length None for a whole file. See read_fastq_shard_batches
+  '''
+  shards = []
+  for fastq_filename in fastq_filenames:
+    blocks = bgzf_blocks(fastq_filename) if num_shards > 1 else None
+    if not blocks:
+      shards.append((fastq_filename, 0, None))
+      continue
+    total_length = sum(isize for offset, isize in blocks)
+    shard_length = max(min_shard_length, -(-total_length // num_shards))
+    shard_offset = 0
+    length = 0
+    for offset, isize in blocks:
+      if length >= shard_length:
+        shards.append((fastq_filename, shard_offset, length))
+        shard_offset = offset
+        length = 0
+      length += isize
+    shards.append((fastq_filename, shard_offset, length))
+  return shards
+
+def read_fastq_shard_batches(shard, block_size = default_block_size):
+  '''
+  Generator yielding batches of (read_id_lines, sequences) from one shard returned by fastq_shards.
+  A read belongs to the shard its first byte falls in, so reads straddling a shard boundary are
+  completed by reading on into the next shard, and skipped by the next shard
+  '''
+  (fastq_filename, compressed_offset, decompressed_length) = shard
+  with open(fastq_filename, 'rb') as raw_file:
+    raw_file.seek(compressed_offset)
+    with gzip.GzipFile(fileobj = raw_file, mode = 'rb') as fastq_stream:
+      if decompressed_length == None:
+        yield from read_fastq_stream_batches(fastq_stream, block_size)
+      else:
+        yield from _read_fastq_shard_stream_batches(fastq_stream, decompressed_length, compressed_offset > 0, block_size)
+
+def _read_fastq_shard_stream_batches(fastq_stream, shard_length, skip_partial_read, block_size):
+  # Reads starting exactly on the shard boundary belong to the earlier shard, so a shard other than
+  # the first always skips its first (possibly partial) line before looking for the start of a read
+  unread = shard_length
+  remainder = b''
+  while unread > 0:
+    block = fastq_stream.read(min(block_size, unread))
+    if not block:
+      break
+    unread -= len(block)
+    data = remainder + block
+    if skip_partial_read:
+      read_start = _first_read_start(data)
+      if read_start == None:
+        if unread > 0:
+          remainder = data
+          continue
+        sys.exit(f'Could not find the start of a read in a {shard_length} byte FASTQ shard. Exiting.')
+      data = data[read_start:]
+      skip_partial_read = False
+    read_id_lines, sequences, remainder = split_fastq_block(data)
+    if read_id_lines:
+      yield (read_id_lines, sequences)
+  if skip_partial_read:
+    return
+  # complete the read that starts in this shard and ends in the next one, or the one starting on the boundary
+  num_lines_needed = 4 - remainder.count(b'\n')
+  remainder += b''.join(fastq_stream.readline() for line in range(num_lines_needed))
+  read_id_lines, sequences, remainder = split_fastq_block(remainder)
+  if read_id_lines:
+    yield (read_id_lines, sequences)
+  yield from final_fastq_batch(remainder)
+
+def _first_read_start(data):
+  '''
+  Byte offset of the first read in data that starts part way through a FASTQ file, or None if there is
+  not yet enough data to tell. A read starts on a line beginning with '@' that is followed two lines later
+  by a line beginning with '+'. A quality line may begin with '@', but is then followed two lines later by
+  a sequence line, which cannot begin with '+'
+  '''
+  line_start = data.find(b'\n') + 1
+  if line_start == 0:
+    return None
+  while True:
+    second_line_start = data.find(b'\n', line_start) + 1
+    third_line_start = data.find(b'\n', second_line_start) + 1 if second_line_start else 0
+    if (third_line_start == 0) or (data.find(b'\n', third_line_start) < 0):
+      return None
+    if data.startswith(b'@', line_start) and data.startswith(b'+', third_line_start):
+      return line_start
+    line_start = second_line_start
+
+def amplicon_ids(read_id_lines):
+  '''
+  Extract the amplicon IDs (the text after the last ':') from a batch of FASTQ read ID lines, as bytes
+  '''
+  batch_amplicon_ids = [read_id_line[read_id_line.rfind(b':') + 1:] for read_id_line in read_id_lines]
+  # a missing ':' leaves the whole read ID line, which starts with '@'; a trailing ':' leaves b''
+  if (b'' in batch_amplicon_ids) or any(map(_is_read_id_line, batch_amplicon_ids)):
+    bad_line = next(read_id_line for read_id_line, amplicon_id in zip(read_id_lines, batch_amplicon_ids) if amplicon_id == b'' or amplicon_id.startswith(b'@'))
+    sys.exit('No amplicon ID found at end of sequence ID line:\n' + bad_line.decode('ascii', 'replace') + '\nExiting.')
+  return batch_amplicon_ids
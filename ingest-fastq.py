@@ -0,0 +1,32 @@
+#! /usr/bin/env python
+
+import sys
+
+project_dir = "/Users/davids/git/WEHI_CoViD_RNAseq/RNAseq-extract-bar-codes"
+sys.path.insert(0, project_dir)
+
+import squtils as sq
+import parallel_ingest
+from FastqReadData import FastqReadData
+from SeqCountTable import SeqCountTable
+
+# Reads a FASTQ run once, and saves the read counts of each distinct barcode region x amplicon_id as a SeqCountTable,
+# which the extract-bar-codes scripts can be given instead of the fastq.gz file(s)
+
+if len(sys.argv) < 2:
+  sys.exit('A command line argument specifying the fastq.gz file to process is required, optionally followed by further fastq.gz files (e.g. pre-split chunks of the same run). Exiting.')
+# command line arguments are the fastq.gz file(s) to process, in order
+fastq_filenames = sys.argv[1:]
+
+# the barcode region must cover the keys of every script: the UMI, well_id and padding that extract-bar-codes-ngrams.py uses is the longest
+region_length = FastqReadData.seq_length
+num_workers = parallel_ingest.default_num_workers # BGZF input (e.g. from bgzip) and multiple input files are read in parallel
+seq_count_table_filename = f'{fastq_filenames[0]}_SeqCountTable_{region_length}.arrays'
+
+sq.log(f'Counting reads in {", ".join(fastq_filenames)}...')
+seq_count_table = SeqCountTable.ingest(fastq_filenames, region_length, num_workers = num_workers)
+if seq_count_table.ingest_report != None:
+  print(f'Ingest pipeline stages:\n{seq_count_table.ingest_report}')
+print(seq_count_table)
+sq.log(f'Saving SeqCountTable to {seq_count_table_filename}...')
+seq_count_table.save(seq_count_table_filename, {'fastq_filenames': fastq_filenames})
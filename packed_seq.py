@@ -0,0 +1,132 @@
+'''
+2-bit packing of ACGT sequences into Python ints, first base most significant, so that a 32 base
+umi_well_seq fits in 64 bits, and ngrams of a packed sequence can be cut out with shifts and masks.
+Sequences containing any other character (e.g. N) cannot be packed, and callers keep them as str.
+Lists of sequences can also be packed into NumPy uint64 arrays, with Ns marked, for vectorised Hamming distances
+'''
+
+import sys
+import numpy as np
+
+_to_base4_digits = str.maketrans('ACGT', '0123')
+_bases = 'ACGT'
+# str for every byte value, i.e. every run of 4 packed bases, for unpacking
+_byte_to_bases = [_bases[byte >> 6] + _bases[(byte >> 4) & 3] + _bases[(byte >> 2) & 3] + _bases[byte & 3] for byte in range(256)]
+
+def pack_seq(seq):
+  '''
+  Pack an ACGT str into an int, 2 bits per base. Returns None if seq contains any other character
+  '''
+  if (not seq) or seq.strip('ACGT'): # anything left after stripping ACGT from the ends means another character
+    return None
+  return int(seq.translate(_to_base4_digits), 4)
+
+def unpack_seq(packed, seq_length):
+  '''
+  Unpack an int made by pack_seq back into a str of seq_length bases
+  '''
+  num_bytes = (seq_length + 3) >> 2
+  seq = ''.join([_byte_to_bases[byte] for byte in packed.to_bytes(num_bytes, 'big')])
+  return seq[(num_bytes << 2) - seq_length:] # drop the leading 'A's that padded the first byte
+
+def ngram_ids(packed, seq_length, ngram_length, num_ngrams):
+  '''
+  The packed ngrams of length ngram_length, at offsets 0 to num_ngrams - 1, of a packed sequence of seq_length bases.
+  Each ngram id is the same int that pack_seq gives for the ngram's str
+  '''
+  mask = (1 << (2*ngram_length)) - 1
+  shift = 2*(seq_length - ngram_length)
+  return [(packed >> (shift - 2*offset)) & mask for offset in range(num_ngrams)]
+
+_byte_popcounts = np.array([bin(byte).count('1') for byte in range(256)], dtype = np.uint8)
+
+def popcounts(array):
+  '''
+  Array of the number of 1 bits in each element of an unsigned integer array, e.g. of XORs of packed sequences
+  '''
+  if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+    return np.bitwise_count(array)
+  array = np.ascontiguousarray(array)
+  return _byte_popcounts[array.view(np.uint8)].reshape(array.shape + (array.itemsize,)).sum(axis = -1, dtype = np.uint8)
+
+# 2-bit codes of each byte, as pack_seq packs ACGT, and other_bases, which is 1 for anything but ACGT
+_base_codes = np.zeros(256, dtype = np.uint64)
+_base_codes[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(4, dtype = np.uint64)
+_other_bases = np.ones(256, dtype = np.uint64)
+_other_bases[np.frombuffer(b'ACGT', dtype = np.uint8)] = 0
+
+tile_length = 256 # rows and columns of the tiles of distance matrices, so each tile's arrays fit in cache
+
+def pack_seqs(seqs, seq_length):
+  '''
+  Pack a list of seqs, all seq_length (up to 32) bases, into a tuple of uint64 arrays (codes, others), for the
+  Hamming distance functions below. codes packs each seq as pack_seq does, but with any base other than ACGT packed
+  as A; others has the low bit of each of those bases set, so they are taken to be Ns: equal to an N, and
+  mismatching every other base
+  '''
+  if seq_length > 32:
+    sys.exit(f'Only seqs of up to 32 bases can be packed into uint64s, not {seq_length}. Exiting.')
+  bases = np.frombuffer(''.join(seqs).encode('ascii'), dtype = np.uint8).reshape(len(seqs), seq_length)
+  codes = np.zeros(len(seqs), dtype = np.uint64)
+  others = np.zeros(len(seqs), dtype = np.uint64)
+  for base_num in range(seq_length):
+    codes = (codes << np.uint64(2)) | _base_codes[bases[:, base_num]]
+    others = (others << np.uint64(2)) | _other_bases[bases[:, base_num]]
+  return (codes, others)
+
+def hamming_distances(codes1, others1, codes2, others2, seq_length):
+  '''
+  uint8 array of the Hamming distances between seqs packed by pack_seqs, broadcast as NumPy broadcasts the arrays
+  '''
+  # a base mismatches if either of its bits differ, or only one of the two is not ACGT
+  differences = codes1 ^ codes2
+  differences |= differences >> np.uint64(1)
+  differences &= np.uint64(int('01'*seq_length, 2)) # the low bit of each packed base
+  differences |= others1 ^ others2
+  return popcounts(differences)
+
+def hamming_one_vs_all(packed_seqs, packed_query, seq_length):
+  '''
+  uint8 array of the Hamming distances of the query from each of packed_seqs, both packed by pack_seqs
+  '''
+  (codes, others) = packed_seqs
+  (query_codes, query_others) = packed_query
+  return hamming_distances(codes, others, query_codes[0], query_others[0], seq_length)
+
+def hamming_block(packed_seqs1, packed_seqs2, seq_length, out = None):
+  '''
+  uint8 matrix of the Hamming distances of each of packed_seqs1 (rows) from each of packed_seqs2 (columns), both packed
+  by pack_seqs, computed a tile at a time, into out if that is given (e.g. a memory-mapped array)
+  '''
+  (codes1, others1) = packed_seqs1
+  (codes2, others2) = packed_seqs2
+  if out is None:
+    out = np.empty((len(codes1), len(codes2)), dtype = np.uint8)
+  for row_start in range(0, len(codes1), tile_length):
+    row_end = row_start + tile_length
+    row_codes = codes1[row_start:row_end, np.newaxis]
+    row_others = others1[row_start:row_end, np.newaxis]
+    for col_start in range(0, len(codes2), tile_length):
+      col_end = col_start + tile_length
+      out[row_start:row_end, col_start:col_end] = hamming_distances(row_codes, row_others, codes2[col_start:col_end], others2[col_start:col_end], seq_length)
+  return out
+
+def hamming_all_vs_all(packed_seqs, seq_length, out = None):
+  '''
+  Square uint8 matrix of the Hamming distances between each of packed_seqs, packed by pack_seqs, as hamming_block,
+  but computing only the tiles on and above the diagonal, and copying them below it
+  '''
+  (codes, others) = packed_seqs
+  if out is None:
+    out = np.empty((len(codes), len(codes)), dtype = np.uint8)
+  for row_start in range(0, len(codes), tile_length):
+    row_end = row_start + tile_length
+    row_codes = codes[row_start:row_end, np.newaxis]
+    row_others = others[row_start:row_end, np.newaxis]
+    for col_start in range(row_start, len(codes), tile_length):
+      col_end = col_start + tile_length
+      tile = hamming_distances(row_codes, row_others, codes[col_start:col_end], others[col_start:col_end], seq_length)
+      out[row_start:row_end, col_start:col_end] = tile
+      if col_start != row_start:
+        out[col_start:col_end, row_start:row_end] = tile.T
+  return out
@@ -0,0 +1,62 @@
+import collections
+import multiprocessing
+import os
+
+import fastq_reader
+
+# worker processes to use for ingest. Scaling flattens out once decompression saturates the disk
+default_num_workers = min(16, os.cpu_count() or 1)
+
+def map_shards(shard_function, shards, num_workers = default_num_workers):
+  '''
+  Generator yielding shard_function(shard) for each shard, in shard order, computed by a pool of
+  num_workers processes (or in this process if there is only one worker, or only one shard).
+  shard_function must be picklable, i.e. a module level function, or a functools.partial of one
+  '''
+  if (num_workers <= 1) or (len(shards) <= 1):
+    yield from map(shard_function, shards)
+    return
+  # fork, so workers don't re-run the calling script (which has no __main__ guard), as spawn would
+  with multiprocessing.get_context('fork').Pool(min(num_workers, len(shards))) as pool:
+    yield from pool.imap(shard_function, shards)
+
+def merge_shard_counts(shard_results):
+  '''
+  Merge the (counts, n_read, n_skipped) results of count_shard_keys into a single (counts, n_read, n_skipped) tuple.
+  Shards must be given in input order, so that keys end up in the order they were first seen in the whole input,
+  exactly as if it had been read serially
+  '''
+  counts = collections.Counter()
+  n_read = 0
+  n_skipped = 0
+  for shard_counts, shard_n_read, shard_n_skipped in shard_results:
+    counts.update(shard_counts)
+    n_read += shard_n_read
+    n_skipped += shard_n_skipped
+  return (counts, n_read, n_skipped)
+
+def count_shard_keys(shard, key_slices, include_amplicon_id = True, ignore_Ns = False):
+  '''
+  Count the reads in one shard from fastq_reader.fastq_shards by key. Keys are bytes: the slices of each
+  read's sequence given by key_slices, a list of (start, end) tuples, joined with ':', followed by
+  ':' and the amplicon ID if include_amplicon_id is True.
+  If ignore_Ns is True, reads with an N in any of the key slices are skipped.
+  Returns a tuple of (counts, n_read, n_skipped), where counts is a Counter, in the order keys were first seen
+  '''
+  counts = collections.Counter()
+  n_read = 0
+  n_skipped = 0
+  for read_id_lines, sequences in fastq_reader.read_fastq_shard_batches(shard):
+    n_read += len(sequences)
+    key_parts = [[sequence[start:end] for sequence in sequences] for start, end in key_slices]
+    keys = key_parts[0] if len(key_parts) == 1 else list(map(b':'.join, zip(*key_parts)))
+    if ignore_Ns:
+      has_N = [b'N' in key for key in keys]
+      if any(has_N):
+        keys = [key for key, skip in zip(keys, has_N) if not skip]
+        read_id_lines = [read_id_line for read_id_line, skip in zip(read_id_lines, has_N) if not skip]
+        n_skipped += sum(has_N)
+    if include_amplicon_id:
+      keys = [key + b':' + amplicon_id for key, amplicon_id in zip(keys, fastq_reader.amplicon_ids(read_id_lines))]
+    counts.update(keys)
+  return (counts, n_read, n_skipped)